@@ -0,0 +1,494 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Benchmark inp2json.py on synthetic INP files.
+
+Each case is a recording duration along with an output format. For each case,
+a synthetic INP file and a matching input port reference file are generated
+(see inpsynth.py; generated files are kept in the work directory and reused
+by later runs) and converted by inp2json.py in a child process, a number of
+times. The wall time, the time per processing stage (reference lookup,
+decompression, decoding and serialization, as measured by
+inp2json.py --profile-report), the throughput and the peak memory usage (the
+maximum resident set size of the child process) are reported, each the best
+of all repetitions.
+
+Results can be saved as a baseline, and compared against a baseline of the
+same benchmark parameters: should any time or the peak memory usage exceed
+the baseline by more than the tolerance, each regression is reported and the
+exit status is 1. Baselines are only meaningful on the machine they have been
+recorded on.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import inp2json  # pylint: disable=wrong-import-position
+import inpsynth  # pylint: disable=wrong-import-position
+
+INP2JSON_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "inp2json.py"
+)
+WORK_DIR_DEF = os.path.join(tempfile.gettempdir(), "inp2json-bench")
+BASELINE_PATH_DEF = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "baseline.json"
+)
+MINUTES_DEF = [1.0, 10.0, 60.0]
+OUTPUT_FORMATS_DEF = ["json"]
+REPEAT_DEF = 3
+TOLERANCE_DEF = 0.2
+MEMORY_TOLERANCE_DEF = 0.1
+
+# Reported stage -> stage of the inp2json.py profile report.
+STAGES = (
+    ("lookup", "load_ports_ref"),
+    ("decompress", "decompress"),
+    ("decode", "decode"),
+    ("serialize", "write_output"),
+)
+# Differences below these are considered noise, whatever the tolerance.
+TIME_NOISE_FLOOR = 0.1  # seconds
+MEMORY_NOISE_FLOOR = 2.0  # MiB
+
+
+def synth_params(_args):
+    """Return the parameters of the synthetic input files."""
+    return {
+        "ports": _args.ports,
+        "analog": _args.analog,
+        "players": _args.players,
+        "shmupmame_compat": _args.shmupmame_compat,
+        "density": _args.density,
+        "frame_rate": _args.frame_rate,
+        "ref_format": _args.ref_format,
+        "ref_machines": _args.ref_machines,
+        "seed": _args.seed,
+    }
+
+
+def prepare_inputs(work_dir, params, frames_count):
+    """
+    Generate the INP file and the input port reference file of a case.
+
+    Files are named after a hash of the parameters, so that files generated
+    by an earlier run are reused. Return the paths of both files.
+    """
+    key = hashlib.sha256(
+        json.dumps([params, frames_count], sort_keys=True).encode()
+    ).hexdigest()[:16]
+    inp_path = os.path.join(work_dir, f"{inpsynth.SYSNAME_DEF}-{key}.inp")
+    ref_path = os.path.join(work_dir, f"{inpsynth.SYSNAME_DEF}-{key}.ref")
+    if os.path.exists(inp_path) and os.path.exists(ref_path):
+        return inp_path, ref_path
+
+    ports_ref = inpsynth.make_ports_ref(
+        params["ports"], params["analog"], params["players"]
+    )
+    # Write to temporary paths first, so that an interrupted run does not
+    # leave incomplete files behind to be reused.
+    inpsynth.write_inp(
+        inp_path + ".tmp",
+        ports_ref,
+        frames_count,
+        shmupmame_compat=params["shmupmame_compat"],
+        frame_rate=params["frame_rate"],
+        density=params["density"],
+        seed=params["seed"],
+    )
+    inpsynth.write_ports_ref(
+        ref_path + ".tmp",
+        inpsynth.iter_machines(inpsynth.SYSNAME_DEF, ports_ref, params["ref_machines"]),
+        params["ref_format"],
+    )
+    os.replace(inp_path + ".tmp", inp_path)
+    os.replace(ref_path + ".tmp", ref_path)
+    return inp_path, ref_path
+
+
+def run_inp2json(inp_path, ref_path, output_format, shmupmame_compat, report_path):
+    """
+    Convert an INP file using inp2json.py in a child process.
+
+    The output is discarded. Return the wall time in seconds, the peak
+    memory usage of the child process in MiB and the profile report. Raise
+    RuntimeError if the conversion fails.
+    """
+    cmd = [
+        sys.executable,
+        INP2JSON_PATH,
+        "-i",
+        inp_path,
+        "-m",
+        ref_path,
+        "-f",
+        output_format,
+        "-o",
+        os.devnull,
+        "--profile-report",
+        report_path,
+    ]
+    if shmupmame_compat:
+        cmd.append("-s")
+    with open(os.devnull, "wb") as devnull, tempfile.TemporaryFile() as errors:
+        started = time.perf_counter()
+        # pylint: disable-next=consider-using-with
+        proc = subprocess.Popen(cmd, stdout=devnull, stderr=errors)
+        # Unlike Popen.wait, os.wait4 returns the resource usage of this very
+        # child process.
+        _, status, rusage = os.wait4(proc.pid, 0)
+        wall_seconds = time.perf_counter() - started
+        proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+        if proc.returncode:
+            errors.seek(0)
+            message = errors.read().decode(errors="replace").strip().splitlines()
+            raise RuntimeError(
+                f"inp2json.py failed: {message[-1] if message else status}"
+            )
+
+    with open(report_path, "rb") as f:
+        report = json.load(f)
+    # ru_maxrss is in KiB on Linux, but in bytes on macOS.
+    peak_rss = rusage.ru_maxrss / (1 << 20 if sys.platform == "darwin" else 1 << 10)
+    return wall_seconds, peak_rss, report
+
+
+def run_case(inp_path, ref_path, output_format, shmupmame_compat, repeat, work_dir):
+    """
+    Benchmark one case; return its results as a dict.
+
+    Each time and the peak memory usage is the minimum over `repeat` runs.
+    """
+    results = None
+    report_path = os.path.join(work_dir, "report.json")
+    for _ in range(repeat):
+        wall_seconds, peak_rss, report = run_inp2json(
+            inp_path, ref_path, output_format, shmupmame_compat, report_path
+        )
+        run_results = {
+            "wall_seconds": wall_seconds,
+            "stages": {
+                name: report["stages"].get(stage, {}).get("seconds", 0.0)
+                for name, stage in STAGES
+            },
+            "peak_rss_mib": peak_rss,
+        }
+        if results is None:
+            results = run_results
+            results["frames"] = report["counters"].get("frames", 0)
+            results["payload_bytes"] = report["counters"].get("decompressed_bytes", 0)
+            continue
+        results["wall_seconds"] = min(results["wall_seconds"], wall_seconds)
+        results["peak_rss_mib"] = min(results["peak_rss_mib"], peak_rss)
+        for name, seconds in run_results["stages"].items():
+            results["stages"][name] = min(results["stages"][name], seconds)
+
+    wall_seconds = results["wall_seconds"]
+    results["frames_per_second"] = results["frames"] / wall_seconds
+    results["payload_mib_per_second"] = (
+        results["payload_bytes"] / (1 << 20) / wall_seconds
+    )
+    return results
+
+
+def case_name(minutes, output_format):
+    """Return the name of the case of a recording duration and an output format."""
+    return f"{minutes:g}min-{output_format}"
+
+
+def print_results(cases):
+    """Print the results of all cases as a table."""
+    header = (
+        ["case", "frames", "wall s"]
+        + [f"{name} s" for name, _ in STAGES]
+        + ["frames/s", "MiB/s", "peak MiB"]
+    )
+    rows = [header]
+    for name, results in cases.items():
+        rows.append(
+            [name, str(results["frames"]), f"{results['wall_seconds']:.3f}"]
+            + [f"{results['stages'][stage]:.3f}" for stage, _ in STAGES]
+            + [
+                f"{results['frames_per_second']:.0f}",
+                f"{results['payload_mib_per_second']:.1f}",
+                f"{results['peak_rss_mib']:.1f}",
+            ]
+        )
+    widths = [max(len(row[col]) for row in rows) for col in range(len(header))]
+    for row in rows:
+        print(
+            "  ".join(
+                cell.ljust(width) if col == 0 else cell.rjust(width)
+                for col, (cell, width) in enumerate(zip(row, widths))
+            )
+        )
+
+
+def find_regressions(cases, baseline_cases, tolerance, memory_tolerance):
+    """
+    Compare results against a baseline.
+
+    Return a list of (case, metric, value, baseline value) tuples, one per
+    regression. Cases missing from the baseline are skipped.
+    """
+    regressions = []
+    for name, results in cases.items():
+        baseline = baseline_cases.get(name)
+        if baseline is None:
+            continue
+        metrics = [("wall", results["wall_seconds"], baseline["wall_seconds"])]
+        metrics.extend(
+            (stage, results["stages"][stage], baseline["stages"].get(stage, 0.0))
+            for stage, _ in STAGES
+        )
+        for metric, value, baseline_value in metrics:
+            if (
+                value > baseline_value * (1 + tolerance)
+                and value - baseline_value > TIME_NOISE_FLOOR
+            ):
+                regressions.append((name, f"{metric} s", value, baseline_value))
+        value, baseline_value = results["peak_rss_mib"], baseline["peak_rss_mib"]
+        if (
+            value > baseline_value * (1 + memory_tolerance)
+            and value - baseline_value > MEMORY_NOISE_FLOOR
+        ):
+            regressions.append((name, "peak MiB", value, baseline_value))
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=sys.modules[__name__].__doc__)
+    parser.add_argument(
+        "--minutes",
+        action="extend",
+        nargs="+",
+        type=float,
+        help="Durations of the synthetic recordings in emulated minutes, e.g. "
+        "'1 60 180' for up to a three-hour replay. (default: "
+        f"{' '.join(f'{minutes:g}' for minutes in MINUTES_DEF)})",
+    )
+    parser.add_argument(
+        "-f",
+        "--output-format",
+        action="extend",
+        nargs="+",
+        type=str,
+        choices=inp2json.OUTPUT_FORMATS,
+        help="Output formats to benchmark (see inp2json.py -f). "
+        f"(default: {' '.join(OUTPUT_FORMATS_DEF)})",
+    )
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        type=int,
+        default=REPEAT_DEF,
+        help=f"Number of runs per case; the best one counts. (default: {REPEAT_DEF})",
+    )
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        default=BASELINE_PATH_DEF,
+        help="Path of the baseline to compare against, if it exists. "
+        "(default: baseline.json next to this script)",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        default=False,
+        help="Save the results as the baseline instead of comparing against it.",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=TOLERANCE_DEF,
+        help="Relative slowdown of any time over the baseline that counts as a "
+        f"regression. (default: {TOLERANCE_DEF})",
+    )
+    parser.add_argument(
+        "--memory-tolerance",
+        type=float,
+        default=MEMORY_TOLERANCE_DEF,
+        help="Relative increase of the peak memory usage over the baseline that "
+        f"counts as a regression. (default: {MEMORY_TOLERANCE_DEF})",
+    )
+    parser.add_argument(
+        "--results",
+        type=str,
+        help="Path to write the results to as JSON. (default: do not write them)",
+    )
+    parser.add_argument(
+        "--work-dir",
+        type=str,
+        default=WORK_DIR_DEF,
+        help=f"Directory to keep the generated input files in. (default: {WORK_DIR_DEF})",
+    )
+    parser.add_argument(
+        "--ports",
+        type=int,
+        default=inpsynth.PORTS_COUNT_DEF,
+        help=f"Number of ports. (default: {inpsynth.PORTS_COUNT_DEF})",
+    )
+    parser.add_argument(
+        "--analog",
+        type=int,
+        default=inpsynth.ANALOG_FIELDS_COUNT_DEF,
+        help="Number of analog fields, at most two per port. "
+        f"(default: {inpsynth.ANALOG_FIELDS_COUNT_DEF})",
+    )
+    parser.add_argument(
+        "--players",
+        type=int,
+        default=inpsynth.PLAYER_COUNT_DEF,
+        help=f"Number of players. (default: {inpsynth.PLAYER_COUNT_DEF})",
+    )
+    parser.add_argument(
+        "-s",
+        "--shmupmame-compat",
+        action="store_true",
+        default=False,
+        help="Add the extra ports of MAME Plus based forks and convert using "
+        "inp2json.py -s.",
+    )
+    parser.add_argument(
+        "--density",
+        type=float,
+        default=inpsynth.DENSITY_DEF,
+        help="Fraction of frames in which the inputs of a port change. "
+        f"(default: {inpsynth.DENSITY_DEF})",
+    )
+    parser.add_argument(
+        "--frame-rate",
+        type=float,
+        default=inpsynth.FRAME_RATE_DEF,
+        help=f"Frames per emulated second. (default: {inpsynth.FRAME_RATE_DEF:g})",
+    )
+    parser.add_argument(
+        "--ref-format",
+        type=str,
+        choices=("lines", "index"),
+        default="lines",
+        help="Format of the input port reference file. (default: lines)",
+    )
+    parser.add_argument(
+        "--ref-machines",
+        type=int,
+        default=inpsynth.REF_MACHINES_DEF,
+        help="Number of filler machines in the input port reference file. "
+        f"(default: {inpsynth.REF_MACHINES_DEF})",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=inpsynth.SEED_DEF,
+        help=f"Seed of the pseudo-random inputs. (default: {inpsynth.SEED_DEF})",
+    )
+    _args = parser.parse_args()
+    if _args.minutes is None:
+        _args.minutes = MINUTES_DEF
+    if _args.output_format is None:
+        _args.output_format = OUTPUT_FORMATS_DEF
+    if _args.repeat < 1:
+        parser.error("-r/--repeat must be at least 1")
+    return _args
+
+
+def main(_args):
+    params = synth_params(_args)
+    baseline = None
+    if not _args.save_baseline and os.path.exists(_args.baseline):
+        try:
+            with open(_args.baseline, "rb") as f:
+                baseline = json.load(f)
+        except (OSError, ValueError) as e:
+            print(
+                f"Fatal: could not read baseline '{_args.baseline}': {e}",
+                file=sys.stderr,
+            )
+            return 1
+        if baseline.get("synth") != params:
+            print(
+                f"Fatal: baseline '{_args.baseline}' has been recorded using "
+                f"different input parameters: {baseline.get('synth')}",
+                file=sys.stderr,
+            )
+            return 1
+
+    cases = {}
+    try:
+        os.makedirs(_args.work_dir, exist_ok=True)
+        for minutes in _args.minutes:
+            frames_count = round(minutes * 60 * _args.frame_rate)
+            print(f"Preparing {frames_count} frames ({minutes:g} minutes) ...")
+            inp_path, ref_path = prepare_inputs(_args.work_dir, params, frames_count)
+            for output_format in _args.output_format:
+                name = case_name(minutes, output_format)
+                print(f"Running {name} ...")
+                cases[name] = run_case(
+                    inp_path,
+                    ref_path,
+                    output_format,
+                    _args.shmupmame_compat,
+                    _args.repeat,
+                    _args.work_dir,
+                )
+    except (OSError, ValueError, RuntimeError) as e:
+        print(f"Fatal: {e}", file=sys.stderr)
+        return 1
+
+    print_results(cases)
+    document = {
+        "synth": params,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cases": cases,
+    }
+    for path in [_args.results] + ([_args.baseline] if _args.save_baseline else []):
+        if not path:
+            continue
+        try:
+            with open(path, "w", encoding="utf8") as f:
+                json.dump(document, f, indent=2)
+        except OSError as e:
+            print(f"Fatal: could not write '{path}': {e}", file=sys.stderr)
+            return 1
+    if _args.save_baseline:
+        print(f"Saved baseline to '{_args.baseline}'")
+        return 0
+    if baseline is None:
+        print("No baseline to compare against; see --save-baseline")
+        return 0
+
+    missing = [name for name in cases if name not in baseline["cases"]]
+    if missing:
+        print(f"Not in the baseline: {', '.join(missing)}")
+    regressions = find_regressions(
+        cases, baseline["cases"], _args.tolerance, _args.memory_tolerance
+    )
+    for name, metric, value, baseline_value in regressions:
+        print(
+            f"REGRESSION {name} {metric}: {value:.3f} vs. {baseline_value:.3f} "
+            f"({(value / baseline_value - 1) * 100 if baseline_value else float('inf'):+.0f}%)",
+            file=sys.stderr,
+        )
+    if regressions:
+        print(
+            f"Fatal: {len(regressions)} regressions against baseline "
+            f"'{_args.baseline}'",
+            file=sys.stderr,
+        )
+        return 1
+
+    print(f"No regressions against baseline '{_args.baseline}'")
+    return 0
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    sys.exit(main(args))
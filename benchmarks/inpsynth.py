@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Generate synthetic INP files and matching input port reference files.
+
+The INP files are valid as far as inp2json.py is concerned: a MAME INP header
+(format version 3.0) followed by a zlib-compressed payload of frame records,
+laid out according to the input port reference data of the game. Port, analog
+field and player counts, extra ports of MAME Plus based forks (see inp2json.py
+-s), frame count, frame rate and input density are configurable; inputs are
+pseudo-random, but reproducible given the seed.
+
+Reference files hold the synthetic game along with any number of filler
+machines, so that looking the game up costs about as much as in a reference
+file generated from a full MAME build.
+"""
+
+import argparse
+import gzip
+import json
+import os
+import random
+import struct
+import sys
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import inp2json  # pylint: disable=wrong-import-position
+
+SYSNAME_DEF = "synthgame"
+MAME_VERSION_DEF = "0.250"
+MAME_CONFIG_DEF = "10"
+BASETIME_DEF = 1600000000
+PORTS_COUNT_DEF = 4
+ANALOG_FIELDS_COUNT_DEF = 0
+PLAYER_COUNT_DEF = 2
+FRAME_RATE_DEF = 60.0
+DENSITY_DEF = 0.05
+REF_MACHINES_DEF = 2000
+SEED_DEF = 1
+
+BUTTONS_PER_PORT = 8
+# Frames are generated and compressed in batches of this many frames.
+BATCH_FRAMES = 4096
+CURSPEED = 100
+ANALOG_DEFVALUE = 0x80
+
+
+def make_ports_ref(
+    ports_count=PORTS_COUNT_DEF,
+    analog_fields_count=ANALOG_FIELDS_COUNT_DEF,
+    player_count=PLAYER_COUNT_DEF,
+):
+    """
+    Return the input port reference data of a synthetic game.
+
+    Each port has BUTTONS_PER_PORT active-low buttons of one player (players
+    take turns) and a coin input in its low 16 bits. Analog fields take the
+    upper bytes of the ports, the first ports first, so there may be at most
+    two of them per port.
+    """
+    if analog_fields_count > 2 * ports_count:
+        raise ValueError("at most two analog fields per port are supported")
+    ports_ref = {}
+    for port_idx in range(ports_count):
+        player = port_idx % player_count if player_count else None
+        fields = {}
+        for button_idx in range(BUTTONS_PER_PORT):
+            mask = 1 << button_idx
+            fields[str(mask)] = {
+                "analog": False,
+                "type": f"P{player + 1}_BUTTON{button_idx + 1}"
+                if player is not None
+                else f"BUTTON{button_idx + 1}",
+                "defvalue": mask,
+                "specific_name": None,
+                "player": player,
+            }
+        fields[str(1 << BUTTONS_PER_PORT)] = {
+            "analog": False,
+            "type": "COIN1",
+            "defvalue": 1 << BUTTONS_PER_PORT,
+            "specific_name": None,
+            "player": None,
+        }
+        for analog_idx in range(port_idx, analog_fields_count, ports_count):
+            mask = 0xFF << (16 + 8 * (analog_idx // ports_count))
+            fields[str(mask)] = {
+                "analog": True,
+                "type": "AD_STICK_X" if analog_idx < ports_count else "AD_STICK_Y",
+                "defvalue": ANALOG_DEFVALUE * (mask // 0xFF),
+                "specific_name": None,
+                "player": player,
+            }
+        ports_ref[f":IN{port_idx}"] = {
+            "fields": fields,
+            "legacy_order": ports_count - port_idx,
+        }
+    return ports_ref
+
+
+def iter_machines(sysname, ports_ref, filler_machines_count):
+    """
+    Yield the (sysname, ports) pairs of a reference file.
+
+    The synthetic game is preceded by `filler_machines_count` machines of
+    varying layouts, many of which share their definition, like clones do.
+    """
+    for machine_idx in range(filler_machines_count):
+        yield f"filler{machine_idx:05d}", make_ports_ref(
+            1 + machine_idx % 8, machine_idx % 3, 1 + machine_idx % 2
+        )
+    yield sysname, ports_ref
+
+
+def write_ports_ref(
+    path,
+    machines,
+    ref_format="lines",
+    mame_build=MAME_VERSION_DEF,
+    mame_config=MAME_CONFIG_DEF,
+):
+    """
+    Write an input port reference file holding the (sysname, ports) pairs of `machines`.
+
+    `ref_format` is "lines" for the gzipped JSON lines format or "index" for
+    the indexed format (see inp2json.write_ports_ref_index).
+    """
+    if ref_format == "index":
+        with open(path, "wb") as f:
+            inp2json.write_ports_ref_index(f, mame_build, mame_config, machines)
+        return
+
+    with gzip.open(path, "wt", encoding="utf8") as f:
+        f.write(json.dumps({"mame_build": mame_build, "mame_config": mame_config}))
+        f.write("\n")
+        for sysname, ports in machines:
+            f.write(f"{sysname}\0{json.dumps(ports)}\n")
+
+
+def make_header(
+    sysname=SYSNAME_DEF, mame_version=MAME_VERSION_DEF, basetime=BASETIME_DEF
+):
+    """Return the header of an INP file of format version 3.0."""
+    header = bytearray(inp2json.HEADER_BYTES)
+    header[:8] = b"MAMEINP\0"
+    header[
+        inp2json.OFFS_BASETIME : inp2json.OFFS_BASETIME + inp2json.BASETIME_BYTES
+    ] = basetime.to_bytes(inp2json.BASETIME_BYTES, "little")
+    header[inp2json.OFFS_MAJVERSION] = 3
+    header[inp2json.OFFS_MINVERSION] = 0
+    sysname_bytes = sysname.encode("ascii")[: inp2json.SYSNAME_BYTES]
+    header[
+        inp2json.OFFS_SYSNAME : inp2json.OFFS_SYSNAME + len(sysname_bytes)
+    ] = sysname_bytes
+    appdesc = f"MAME {mame_version} (synthetic)".encode("ascii")[
+        : inp2json.APPDESC_BYTES
+    ]
+    header[inp2json.OFFS_APPDESC : inp2json.OFFS_APPDESC + len(appdesc)] = appdesc
+    return bytes(header)
+
+
+def iter_payload(
+    ports_ref,
+    frames_count,
+    shmupmame_compat=False,
+    frame_rate=FRAME_RATE_DEF,
+    density=DENSITY_DEF,
+    seed=SEED_DEF,
+):
+    """
+    Yield the uncompressed payload of a synthetic INP file in chunks.
+
+    `ports_ref` is the input port reference data in the order of ports
+    within the payload. For each port, inputs change in about `density` of
+    the frames; each button is then pressed with a probability of 1/4. Analog
+    fields drift by a small random amount whenever their port changes; as in
+    MAME, their values follow the digital values of their port.
+    """
+    rnd = random.Random(seed)
+    frame_struct = struct.Struct(inp2json.FRAME_STRUCT_FMT)
+    digital_struct = struct.Struct(inp2json.DIGITAL_STRUCT_FMT)
+    analog_struct = struct.Struct(inp2json.ANALOG_STRUCT_FMT)
+    period = round(10**18 / frame_rate)
+
+    ports = []
+    for port in ports_ref.values():
+        defvalue = 0
+        button_masks = []
+        analog_count = 0
+        for mask, field in port["fields"].items():
+            mask = int(mask)
+            defvalue |= field["defvalue"] & mask
+            if field["analog"]:
+                analog_count += 1
+            else:
+                button_masks.append(mask)
+        ports.append((defvalue, button_masks, analog_count))
+    custom_ports_count = (
+        inp2json.calc_player_count(ports_ref) if shmupmame_compat else 0
+    )
+    custom_ports = digital_struct.pack(0, 0) * custom_ports_count
+
+    digital = [0] * len(ports)
+    accums = [[0] * analog_count for _, _, analog_count in ports]
+    time = 0
+    for batch_start in range(0, frames_count, BATCH_FRAMES):
+        buf = bytearray()
+        for _ in range(min(BATCH_FRAMES, frames_count - batch_start)):
+            seconds, attoseconds = divmod(time, 10**18)
+            buf += frame_struct.pack(seconds, attoseconds, CURSPEED)
+            for port_idx, (defvalue, button_masks, _) in enumerate(ports):
+                port_accums = accums[port_idx]
+                previous = list(port_accums)
+                if rnd.random() < density:
+                    digital[port_idx] = sum(
+                        mask for mask in button_masks if rnd.random() < 0.25
+                    )
+                    for analog_idx in range(len(port_accums)):
+                        port_accums[analog_idx] += rnd.randint(-64, 64)
+                buf += digital_struct.pack(defvalue, digital[port_idx])
+                for accum, prev in zip(port_accums, previous):
+                    buf += analog_struct.pack(
+                        accum & 0xFFFFFFFF, prev & 0xFFFFFFFF, 100, False
+                    )
+            buf += custom_ports
+            time += period
+        yield bytes(buf)
+
+
+def write_inp(
+    path,
+    ports_ref,
+    frames_count,
+    sysname=SYSNAME_DEF,
+    mame_version=MAME_VERSION_DEF,
+    shmupmame_compat=False,
+    frame_rate=FRAME_RATE_DEF,
+    density=DENSITY_DEF,
+    seed=SEED_DEF,
+):
+    """
+    Write a synthetic INP file (see iter_payload).
+
+    The payload is compressed incrementally, so that memory usage does not
+    depend on the frame count. Ports are ordered as MAME `mame_version`
+    orders them. Return the size of the uncompressed payload.
+    """
+    ports_ref = inp2json.sort_ports_ref(ports_ref, mame_version)
+    compressor = zlib.compressobj()
+    payload_size = 0
+    with open(path, "wb") as f:
+        f.write(make_header(sysname, mame_version))
+        for chunk in iter_payload(
+            ports_ref, frames_count, shmupmame_compat, frame_rate, density, seed
+        ):
+            payload_size += len(chunk)
+            f.write(compressor.compress(chunk))
+        f.write(compressor.flush())
+    return payload_size
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=sys.modules[__name__].__doc__)
+    parser.add_argument(
+        "-o",
+        "--output-path",
+        type=str,
+        required=True,
+        help="Path to write the INP file to.",
+    )
+    parser.add_argument(
+        "-m",
+        "--inputport-ref-path",
+        type=str,
+        help="Path to write the matching input port reference file to. "
+        "(default: do not write one)",
+    )
+    parser.add_argument(
+        "--ref-format",
+        type=str,
+        choices=("lines", "index"),
+        default="lines",
+        help="Format of the input port reference file: gzipped JSON lines or "
+        "indexed. (default: lines)",
+    )
+    parser.add_argument(
+        "--ref-machines",
+        type=int,
+        default=REF_MACHINES_DEF,
+        help="Number of filler machines in the input port reference file. "
+        f"(default: {REF_MACHINES_DEF})",
+    )
+    parser.add_argument(
+        "-n",
+        "--frames",
+        type=int,
+        help="Number of frames. (default: as many as --minutes take)",
+    )
+    parser.add_argument(
+        "--minutes",
+        type=float,
+        default=1.0,
+        help="Duration of the recording in emulated minutes, if -n/--frames is not "
+        "given. (default: 1)",
+    )
+    parser.add_argument(
+        "--frame-rate",
+        type=float,
+        default=FRAME_RATE_DEF,
+        help=f"Frames per emulated second. (default: {FRAME_RATE_DEF:g})",
+    )
+    parser.add_argument(
+        "--ports",
+        type=int,
+        default=PORTS_COUNT_DEF,
+        help=f"Number of ports. (default: {PORTS_COUNT_DEF})",
+    )
+    parser.add_argument(
+        "--analog",
+        type=int,
+        default=ANALOG_FIELDS_COUNT_DEF,
+        help="Number of analog fields, at most two per port. "
+        f"(default: {ANALOG_FIELDS_COUNT_DEF})",
+    )
+    parser.add_argument(
+        "--players",
+        type=int,
+        default=PLAYER_COUNT_DEF,
+        help=f"Number of players. (default: {PLAYER_COUNT_DEF})",
+    )
+    parser.add_argument(
+        "-s",
+        "--shmupmame-compat",
+        action="store_true",
+        default=False,
+        help="Add the extra ports of MAME Plus based forks (see inp2json.py -s).",
+    )
+    parser.add_argument(
+        "--density",
+        type=float,
+        default=DENSITY_DEF,
+        help="Fraction of frames in which the inputs of a port change. "
+        f"(default: {DENSITY_DEF})",
+    )
+    parser.add_argument(
+        "--mame-version",
+        type=str,
+        default=MAME_VERSION_DEF,
+        help=f"MAME build version to put into the header. (default: {MAME_VERSION_DEF})",
+    )
+    parser.add_argument(
+        "--sysname",
+        type=str,
+        default=SYSNAME_DEF,
+        help=f"Name of the game. (default: {SYSNAME_DEF})",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=SEED_DEF,
+        help=f"Seed of the pseudo-random inputs. (default: {SEED_DEF})",
+    )
+    _args = parser.parse_args()
+    if _args.frames is None:
+        _args.frames = round(_args.minutes * 60 * _args.frame_rate)
+    return _args
+
+
+def main(_args):
+    try:
+        ports_ref = make_ports_ref(_args.ports, _args.analog, _args.players)
+        payload_size = write_inp(
+            _args.output_path,
+            ports_ref,
+            _args.frames,
+            _args.sysname,
+            _args.mame_version,
+            _args.shmupmame_compat,
+            _args.frame_rate,
+            _args.density,
+            _args.seed,
+        )
+        if _args.inputport_ref_path:
+            write_ports_ref(
+                _args.inputport_ref_path,
+                iter_machines(_args.sysname, ports_ref, _args.ref_machines),
+                _args.ref_format,
+                _args.mame_version,
+            )
+    except (OSError, ValueError, inp2json.UnsupportedMameVersionError) as e:
+        print(f"Fatal: {e}", file=sys.stderr)
+        return 1
+
+    print(
+        f"Wrote {_args.frames} frames ({payload_size} bytes uncompressed) "
+        f"to '{_args.output_path}'"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    sys.exit(main(args))
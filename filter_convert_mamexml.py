@@ -4,17 +4,32 @@
 
 It takes a MAME info XML document (generated via MAME's `-listxml` cli option),
 picks out input ports and associated fields for each machine, converts the
-result to JSON and writes it to stdout.
+result to JSON and writes it to stdout (or, in the indexed format, to a file).
+In streaming mode, each machine is written as soon as it has been parsed, so
+that `mame -listxml | filter_convert_mamexml.py -s - --stream -o ref.gz` runs
+in constant memory. Large documents can be split into chunks at machine
+boundaries that are parsed in parallel.
 """
 
 import argparse
 import collections
+import concurrent.futures
+import contextlib
+import functools
+import gzip
+import itertools
 import json
 import logging
+import mmap
+import os
+import re
 import sys
 import xml
 import xml.etree.ElementTree as ET
-from typing import TypedDict
+import xml.parsers.expat
+from typing import BinaryIO, TextIO, TypedDict
+
+import inp2json
 
 
 class InputFieldDto(TypedDict):
@@ -30,7 +45,28 @@ class InputPortDto(TypedDict):
     legacy_order: int | None
 
 
+class MameInfoDto(TypedDict):
+    mame_build: str
+    mame_config: str
+
+
 LOGLEVEL_DEF = "INFO"
+OUTPUT_FORMATS = ("lines", "indexed")
+OUTPUT_FORMAT_DEF = "lines"
+PARSERS = ("expat", "etree")
+PARSER_DEF = "expat"
+JOBS_DEF = 1
+XML_READ_SIZE = 1 << 20
+# Upper bound of the size of the chunks parsed by worker processes
+XML_CHUNK_SIZE = 4 << 20
+MAME_START_TAG_RE = re.compile(rb"<mame[\s>]")
+MACHINE_START_TAG_RE = re.compile(rb"<machine[\s>]")
+MAME_END_TAG = b"</mame>"
+# Starting tags of the elements MameMetadataCollector handles, without their
+# closing '>' or '/>'. MAME escapes '>' in attribute values.
+INPUT_START_TAG_RE = re.compile(
+    rb"<(?:nonanalog|analog|port|machine|mame)(?=[\s/>])[^>]*(?<!/)"
+)
 logger = logging.getLogger(__name__)
 
 
@@ -41,7 +77,57 @@ def parse_args() -> argparse.Namespace:
         "--source-path",
         type=str,
         required=True,
-        help="Path to a MAME info XML file.",
+        help="Path to a MAME info XML file. Use '-' to read it from stdin.",
+    )
+    parser.add_argument(
+        "-f",
+        "--output-format",
+        type=str,
+        choices=OUTPUT_FORMATS,
+        default=OUTPUT_FORMAT_DEF,
+        help="Format of the generated input port reference data. 'lines' writes JSON "
+        "lines to stdout, meant to be piped through gzip. 'indexed' writes a file "
+        "with one compressed record per machine and a sysname index, which "
+        "inp2json.py can look up without scanning the whole file; requires "
+        f"-o/--output-path. (default: {OUTPUT_FORMAT_DEF})",
+    )
+    parser.add_argument(
+        "-o",
+        "--output-path",
+        type=str,
+        help="Path to write the input port reference data to. With the 'lines' "
+        "output format, a path ending in '.gz' is written gzipped. (default: stdout, "
+        "only possible with the 'lines' output format)",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        default=False,
+        help="Write each machine as soon as it has been parsed instead of collecting "
+        "all machines first, so that memory usage does not depend on the size of "
+        "the XML document. Should a machine occur more than once, the first "
+        "occurrence is kept, whereas otherwise, the last one is.",
+    )
+    parser.add_argument(
+        "-p",
+        "--parser",
+        type=str,
+        choices=PARSERS,
+        default=PARSER_DEF,
+        help="XML parser to use. 'expat' scans the document for the starting tags "
+        "of the elements needed and only parses those, 'etree' builds an "
+        "ElementTree element for each element and checks the whole document. Both "
+        f"produce the same output. (default: {PARSER_DEF})",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=JOBS_DEF,
+        help="Number of worker processes. If greater than 1, the XML document is "
+        "split into chunks at machine boundaries, which are parsed in parallel using "
+        "the expat parser; the output stays the same. Requires -s/--source-path to "
+        f"be a path to a file. (default: {JOBS_DEF})",
     )
     parser.add_argument(
         "-l",
@@ -55,17 +141,24 @@ def parse_args() -> argparse.Namespace:
 
 def load_and_parse_xmldoc(
     path: str,
-) -> None | collections.abc.Generator[xml.etree.ElementTree.Element, None, None]:
+) -> (
+    None
+    | collections.abc.Generator[tuple[str, xml.etree.ElementTree.Element], None, None]
+):
     """
     Try to load and parse an XML document from a file system path.
 
-    Return None on failure.
-    Else, return an iterator that incrementally parses the XML
-    document into elements. Elements are returned once their starting tags have
-    been parsed, so any text contents and tail attributes are skipped.
+    A path of '-' denotes stdin. Return None on failure.
+    Else, return an iterator that incrementally parses the XML document into
+    (event, element) tuples. A "start" event is returned once the starting
+    tag of an element has been parsed, so any text contents, tail attributes
+    and children are missing at that point; an "end" event is returned once
+    the whole element has been parsed.
     """
     try:
-        tree_iter = ET.iterparse(path, ["start"])
+        tree_iter = ET.iterparse(
+            sys.stdin.buffer if path == "-" else path, ["start", "end"]
+        )
     except OSError:
         logger.exception("Could not open XML document %s", path)
         return None
@@ -73,157 +166,534 @@ def load_and_parse_xmldoc(
         logger.exception("Could not parse XML document %s", path)
         return None
 
-    return (elem for _, elem in tree_iter)
+    return tree_iter
 
 
-def pick_mame_metadata(
-    elem_iter: collections.abc.Iterable[xml.etree.ElementTree.Element],
-) -> tuple[str, str, dict[str, dict[str, InputPortDto]]]:
+class MameMetadataCollector:
+    """
+    Single out pertinent information from the elements of a MAME info XML
+    document, as they are being parsed.
+
+    `start` is to be called with the tag and attributes of each element once
+    its starting tag has been parsed, in document order, and `end_machine`
+    once a machine element has been parsed completely. The MAME build version
+    and mameconfig version are stored in `mame_info` once they have been
+    encountered. Each complete machine is appended to `machines` as a pair of
+    the machine name and a dict containing every input field for each input
+    port; the caller is expected to take them out of there.
+
+    A machine is also regarded as complete once the next one starts, so that
+    calling `end_machine` for the last one is enough.
     """
-    Single out pertinent information from a parsed MAME info XML document.
 
-    Returns MAME build version, mameconfig version, and a dict containing
-    every input field for each input port for each machine found.
-    """
-    # We could change this into a generator in order to improve resource
-    # efficiency, but that would make the bookkeeping to see if we encounter
-    # the same machine/ports/fields multiple times less pragmatic/partially
-    # counteract the improved efficiency again.
-    # Since this script is a helper that should only have to be run in order
-    # to adopt updated MAME metadata from upstream, which should be needed
-    # relatively rarely, we opt for bookkeeping and against a generator here.
-    mame_build = ""
-    mame_config = ""
-    machine_name = None
-    inputport_tag = None
-    machines: dict[str, dict[str, InputPortDto]] = {}
-
-    for elem in elem_iter:
-        if elem.tag == "mame":
-            mame_build = elem.get("build", "")
-            mame_config = elem.get("mameconfig", "")
-        elif elem.tag == "machine":
-            machine_name = elem.get("name")
-            if not machine_name:
-                logger.warning("No machine name, skipping")
-            elif elem.get("runnable") == "no":
-                # Non-runnable machines are expected to be (constituent) devices,
-                # as opposed to (full) game drivers. This is distinct from
-                # emulation status/quality, which can be gleaned from the
-                # 'driver' element instead.
-                logger.warning("Machine %s not runnable, skipping", machine_name)
-            else:
-                if machines.get(machine_name):
-                    logger.warning(
-                        "Machine %s already seen, overiding existing entry",
-                        machine_name,
-                    )
-                machines[machine_name] = {}
-        elif machine_name and elem.tag == "port":
-            if inputport_tag := elem.get("tag"):
-                if machines[machine_name].get(inputport_tag):
+    def __init__(self, mame_info: MameInfoDto):
+        self.mame_info = mame_info
+        self.machines: list[tuple[str, dict[str, InputPortDto]]] = []
+        self._machine_name: str | None = None
+        self._inputport_tag: str | None = None
+        self._ports: dict[str, InputPortDto] | None = None
+
+    def end_machine(self) -> None:
+        """Finish the machine currently being parsed, if any."""
+        if self._machine_name and self._ports is not None:
+            self.machines.append((self._machine_name, self._ports))
+        self._machine_name = None
+        self._ports = None
+
+    def start(self, tag: str, attrs: dict[str, str]) -> None:
+        """Handle the starting tag of an element."""
+        ports = self._ports
+        inputport_tag = self._inputport_tag
+        machine_name = self._machine_name
+
+        # Fields are by far the most frequent elements, so they come first.
+        if tag in ("nonanalog", "analog"):
+            if ports is not None and inputport_tag:
+                self._field(tag, attrs, ports[inputport_tag]["fields"])
+        elif tag == "port":
+            if ports is None:
+                pass
+            elif inputport_tag := attrs.get("tag"):
+                self._inputport_tag = inputport_tag
+                if ports.get(inputport_tag):
                     logger.warning(
                         "Port %s %s already seen, overiding existing entry",
                         machine_name,
                         inputport_tag,
                     )
-                machines[machine_name][inputport_tag] = {
+                ports[inputport_tag] = {
                     "fields": {},
-                    "legacy_order": int(elem.get("_alloc_order", ""))
-                    if elem.get("_alloc_order") is not None
+                    "legacy_order": int(attrs.get("_alloc_order", ""))
+                    if attrs.get("_alloc_order") is not None
                     else None,
                 }
             else:
+                self._inputport_tag = inputport_tag
                 logger.warning("No input port tag, skipping")
-        elif machine_name and inputport_tag and elem.tag in ("nonanalog", "analog"):
-            # Currently, analog fields are unsupported by inp2json, but if we
-            # encounter one here, we pass it on nevertheless. This way, INP
-            # files of games that have analog fields can still be traversed
-            # correctly (and any digital fields can still be processed).
-            if inputfield_mask := int(elem.get("mask", 0)):
-                if machines[machine_name][inputport_tag]["fields"].get(inputfield_mask):
-                    logger.warning(
-                        "Field %s %s %s already seen, overiding existing entry",
-                        machine_name,
-                        inputport_tag,
-                        inputfield_mask,
-                    )
-                try:
-                    inputfield_type = elem.get("type")
-                    if inputfield_type is None:
-                        raise KeyError
-                    inputfield_defvalue = int(elem.get("defvalue", ""))
-                    inputfield_player = (
-                        int(elem.get("player", ""))
-                        if elem.get("player") is not None
-                        else None
-                    )
-                except (KeyError, ValueError):
-                    logger.exception(
-                        "Field %s %s %s - missing or abnormal attribute values, skipping",
-                        machine_name,
-                        inputport_tag,
-                        inputfield_mask,
-                    )
-                else:
-                    machines[machine_name][inputport_tag]["fields"][inputfield_mask] = {
-                        "analog": elem.tag == "analog",
-                        "type": inputfield_type,
-                        "defvalue": inputfield_defvalue,
-                        # the following attributes may be absent on the part of MAME:
-                        "specific_name": elem.get("specific_name"),
-                        "player": inputfield_player,
-                    }
+        elif tag == "machine":
+            self.end_machine()
+            self._machine_name = machine_name = attrs.get("name")
+            if not machine_name:
+                logger.warning("No machine name, skipping")
+            elif attrs.get("runnable") == "no":
+                # Non-runnable machines are expected to be (constituent) devices,
+                # as opposed to (full) game drivers. This is distinct from
+                # emulation status/quality, which can be gleaned from the
+                # 'driver' element instead.
+                logger.warning("Machine %s not runnable, skipping", machine_name)
             else:
+                self._ports = {}
+        elif tag == "mame":
+            self.mame_info["mame_build"] = attrs.get("build", "")
+            self.mame_info["mame_config"] = attrs.get("mameconfig", "")
+
+    def _field(
+        self, tag: str, attrs: dict[str, str], fields: dict[int, InputFieldDto]
+    ) -> None:
+        machine_name = self._machine_name
+        inputport_tag = self._inputport_tag
+        # Currently, analog fields are unsupported by inp2json, but if we
+        # encounter one here, we pass it on nevertheless. This way, INP
+        # files of games that have analog fields can still be traversed
+        # correctly (and any digital fields can still be processed).
+        if inputfield_mask := int(attrs.get("mask", 0)):
+            if fields.get(inputfield_mask):
                 logger.warning(
-                    "Port %s %s - no/all-zero input field mask, skipping",
+                    "Field %s %s %s already seen, overiding existing entry",
                     machine_name,
                     inputport_tag,
+                    inputfield_mask,
                 )
+            try:
+                inputfield_type = attrs.get("type")
+                if inputfield_type is None:
+                    raise KeyError
+                inputfield_defvalue = int(attrs.get("defvalue", ""))
+                player = attrs.get("player")
+                inputfield_player = int(player) if player is not None else None
+            except (KeyError, ValueError):
+                logger.exception(
+                    "Field %s %s %s - missing or abnormal attribute values, skipping",
+                    machine_name,
+                    inputport_tag,
+                    inputfield_mask,
+                )
+            else:
+                fields[inputfield_mask] = {
+                    "analog": tag == "analog",
+                    "type": inputfield_type,
+                    "defvalue": inputfield_defvalue,
+                    # the following attributes may be absent on the part of MAME:
+                    "specific_name": attrs.get("specific_name"),
+                    "player": inputfield_player,
+                }
+        else:
+            logger.warning(
+                "Port %s %s - no/all-zero input field mask, skipping",
+                machine_name,
+                inputport_tag,
+            )
+
+
+def iter_mame_metadata(
+    event_iter: collections.abc.Iterable[tuple[str, xml.etree.ElementTree.Element]],
+    mame_info: MameInfoDto,
+) -> collections.abc.Generator[tuple[str, dict[str, InputPortDto]], None, None]:
+    """
+    Single out pertinent information from a parsed MAME info XML document.
 
-        elem.clear()
-        del elem
+    Yield the machine name and a dict containing every input field for each
+    input port of each machine found, as soon as the machine's element has
+    been parsed completely. The MAME build version and mameconfig version are
+    stored in `mame_info` once they have been encountered, which is before
+    the first machine is yielded.
 
-    return mame_build, mame_config, machines
+    Only the elements of the machine currently being parsed are kept in
+    memory; the same machine may be yielded more than once.
+    """
+    collector = MameMetadataCollector(mame_info)
+    root = None
+
+    for event, elem in event_iter:
+        if event == "end":
+            if elem.tag == "machine":
+                collector.end_machine()
+                yield from collector.machines
+                collector.machines.clear()
+                # Drop the elements parsed so far.
+                if root is not None:
+                    root.clear()
+            continue
+
+        if root is None:
+            root = elem
+        collector.start(elem.tag, elem.attrib)
+
+
+def iter_mame_metadata_expat(
+    data_iter: collections.abc.Iterable[bytes],
+    mame_info: MameInfoDto,
+) -> collections.abc.Generator[tuple[str, dict[str, InputPortDto]], None, None]:
+    """
+    Like iter_mame_metadata, but parse a MAME info XML document, given as
+    consecutive pieces of bytes, with expat directly.
+
+    Most elements of a machine, such as its ROMs, are of no interest, so the
+    bytes are scanned for the starting tags of the elements that are, and
+    only those are handed to expat, as empty elements within a root element
+    of their own. Thus, the collector is called right from expat's callbacks
+    for these elements alone, and machines are yielded after each piece. This
+    relies on the document not having such tags in comments or CDATA
+    sections, which MAME does not write. Raise xml.parsers.expat.ExpatError
+    if one of the starting tags is malformed or the document does not end
+    with the ending tag of the mame element; the rest of the document is not
+    checked.
+    """
+    collector = MameMetadataCollector(mame_info)
+    expat_parser = xml.parsers.expat.ParserCreate()
+    expat_parser.StartElementHandler = collector.start
+    expat_parser.Parse(b"<input_tags>", False)
+
+    rest = b""
+    for data in data_iter:
+        data = rest + data
+        # A tag may be cut off at the end of a piece.
+        tags_end = max(0, data.rfind(b"<"))
+        rest = data[tags_end:]
+        tags = INPUT_START_TAG_RE.findall(data, 0, tags_end)
+        if tags:
+            expat_parser.Parse(b"/>".join(tags) + b"/>", False)
+        yield from collector.machines
+        collector.machines.clear()
+    if rest.rstrip() != MAME_END_TAG:
+        raise xml.parsers.expat.ExpatError("document ends prematurely")
+    expat_parser.Parse(b"</input_tags>", True)
+    collector.end_machine()
+    yield from collector.machines
+
+
+def read_chunks(f: BinaryIO) -> collections.abc.Generator[bytes, None, None]:
+    """Read a binary file in pieces of XML_READ_SIZE bytes, and close it."""
+    with f:
+        yield from iter(functools.partial(f.read, XML_READ_SIZE), b"")
+
+
+def split_xmldoc(path: str, chunk_count: int) -> tuple[int, list[tuple[int, int]]]:
+    """
+    Find the boundaries of chunks of a MAME info XML document file.
+
+    Return the size of the prolog, which spans up to the end of the starting
+    tag of the mame element, and a list of (start, end) file offsets of up to
+    `chunk_count` chunks of roughly equal size that the contents of the mame
+    element are divided into. Each chunk but the first starts with the
+    starting tag of a machine element. Raise ValueError if the document does
+    not look like a MAME info XML document.
+    """
+    with open(path, "rb") as f, mmap.mmap(
+        f.fileno(), 0, access=mmap.ACCESS_READ
+    ) as doc:
+        mame_match = MAME_START_TAG_RE.search(doc)
+        if not mame_match:
+            raise ValueError("no starting tag of a mame element found")
+        prolog_end = doc.find(b">", mame_match.start()) + 1
+        body_end = doc.rfind(MAME_END_TAG)
+        if not prolog_end or body_end < prolog_end:
+            raise ValueError("no complete mame element found")
+
+        chunk_size = max(1, -(-(body_end - prolog_end) // chunk_count))
+        boundaries = [prolog_end]
+        while boundaries[-1] < body_end:
+            machine_match = MACHINE_START_TAG_RE.search(
+                doc, boundaries[-1] + chunk_size, body_end
+            )
+            boundaries.append(machine_match.start() if machine_match else body_end)
+
+    return prolog_end, list(zip(boundaries, boundaries[1:]))
+
+
+def parse_xmldoc_chunk(
+    path: str, prolog_end: int, start: int, end: int
+) -> tuple[MameInfoDto, list[tuple[str, dict[str, InputPortDto]]]]:
+    """
+    Parse one chunk of a MAME info XML document file, as found by split_xmldoc.
+
+    The chunk is made into a document of its own by enclosing it in the
+    prolog of the document and an ending tag of the mame element. Return the
+    MAME info and the machines found, in document order.
+    """
+    with open(path, "rb") as f:
+        prolog = f.read(prolog_end)
+        f.seek(start)
+        body = f.read(end - start)
+
+    mame_info: MameInfoDto = {"mame_build": "", "mame_config": ""}
+    machines = list(iter_mame_metadata_expat((prolog, body, MAME_END_TAG), mame_info))
+    return mame_info, machines
+
+
+def iter_mame_metadata_parallel(
+    path: str,
+    jobs: int,
+    mame_info: MameInfoDto,
+    log_level: str = LOGLEVEL_DEF,
+) -> collections.abc.Generator[tuple[str, dict[str, InputPortDto]], None, None]:
+    """
+    Like iter_mame_metadata_expat, but split a MAME info XML document file
+    into chunks that are parsed by a pool of `jobs` worker processes.
+
+    Machines are still yielded in document order. At most two chunks per
+    worker are parsed ahead of the machines being consumed, which bounds
+    memory usage. Raise ValueError if the document cannot be split.
+    """
+    prolog_end, chunks = split_xmldoc(
+        path, max(jobs, -(-os.path.getsize(path) // XML_CHUNK_SIZE))
+    )
+    logger.debug("Parsing %d chunks using %d processes", len(chunks), jobs)
+
+    with concurrent.futures.ProcessPoolExecutor(
+        jobs, initializer=setup_logging, initargs=(log_level,)
+    ) as executor:
+        chunks_iter = iter(chunks)
+        pending: collections.deque[concurrent.futures.Future] = collections.deque()
+        try:
+            while True:
+                for start, end in itertools.islice(
+                    chunks_iter, 2 * jobs - len(pending)
+                ):
+                    pending.append(
+                        executor.submit(
+                            parse_xmldoc_chunk, path, prolog_end, start, end
+                        )
+                    )
+                if not pending:
+                    break
+                chunk_mame_info, machines = pending.popleft().result()
+                mame_info.update(chunk_mame_info)
+                yield from machines
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def collect_machines(
+    machines: collections.abc.Iterable[tuple[str, dict[str, InputPortDto]]],
+) -> dict[str, dict[str, InputPortDto]]:
+    """
+    Collect (machine name, ports) pairs into a dict.
+
+    Should a machine occur more than once, the last occurrence wins.
+    """
+    machines_dict: dict[str, dict[str, InputPortDto]] = {}
+    for machine_name, ports in machines:
+        if machine_name in machines_dict:
+            logger.warning(
+                "Machine %s already seen, overiding existing entry", machine_name
+            )
+        machines_dict[machine_name] = ports
+
+    return machines_dict
+
+
+def pick_mame_metadata(
+    event_iter: collections.abc.Iterable[tuple[str, xml.etree.ElementTree.Element]],
+) -> tuple[str, str, dict[str, dict[str, InputPortDto]]]:
+    """
+    Single out pertinent information from a parsed MAME info XML document.
+
+    Returns MAME build version, mameconfig version, and a dict containing
+    every input field for each input port for each machine found. Should a
+    machine occur more than once, the last occurrence wins.
+    """
+    mame_info: MameInfoDto = {"mame_build": "", "mame_config": ""}
+    machines = collect_machines(iter_mame_metadata(event_iter, mame_info))
+
+    return mame_info["mame_build"], mame_info["mame_config"], machines
+
+
+def iter_unique_machines(
+    machines: collections.abc.Iterable[tuple[str, dict[str, InputPortDto]]],
+) -> collections.abc.Generator[tuple[str, dict[str, InputPortDto]], None, None]:
+    """
+    Pass on (machine name, ports) pairs, skipping any machine seen before.
+
+    Only the machine names are kept in memory.
+    """
+    seen: set[str] = set()
+    for machine_name, ports in machines:
+        if machine_name in seen:
+            logger.warning(
+                "Machine %s already seen, keeping the first entry", machine_name
+            )
+            continue
+        seen.add(machine_name)
+        yield machine_name, ports
+
+
+def prime_machines(
+    machines: collections.abc.Iterable[tuple[str, dict[str, InputPortDto]]],
+) -> collections.abc.Iterator[tuple[str, dict[str, InputPortDto]]]:
+    """
+    Parse up to the first machine of iter_mame_metadata's output, so that the
+    MAME build and mameconfig versions are known before anything is written.
+
+    Return an iterator over all machines.
+    """
+    machines = iter(machines)
+    first = next(machines, None)
+    return machines if first is None else itertools.chain([first], machines)
+
+
+def open_lines_output(
+    path: str | None,
+) -> contextlib.AbstractContextManager[TextIO]:
+    """Open the output of the 'lines' format: stdout, a gzipped file or a plain file."""
+    if not path:
+        return contextlib.nullcontext(sys.stdout)
+    if path.endswith(".gz"):
+        return gzip.open(path, "wt", encoding="utf8")
+    return open(path, "w", encoding="utf8")
+
+
+def write_lines(
+    f: TextIO,
+    mame_info: MameInfoDto,
+    machines: collections.abc.Iterable[tuple[str, dict[str, InputPortDto]]],
+) -> None:
+    """
+    Write input port reference data in the 'lines' format to a text file.
+
+    The header line is written before the first machine is requested from
+    `machines`, so `mame_info` has to be complete by then (see
+    prime_machines). Each definition is keyed by its hash, and a machine
+    whose input ports equal those of an earlier one refers to that hash
+    instead of repeating them.
+    """
+    print(
+        json.dumps(
+            {
+                "mame_build": mame_info["mame_build"],
+                "mame_config": mame_info["mame_config"],
+                "format": inp2json.PORTS_REF_LINES_FORMAT,
+            }
+        ),
+        file=f,
+    )
+    def_key = inp2json.PORTS_REF_DEF_KEY.decode()
+    def_ref = inp2json.PORTS_REF_DEF_REF.decode()
+    for machine_name, ports_json, def_hash, new in inp2json.iter_ports_ref_defs(
+        machines
+    ):
+        if new:
+            print(
+                f"{machine_name}\x00{def_key}{def_hash}\x00{ports_json.decode()}",
+                file=f,
+            )
+        else:
+            print(f"{machine_name}\x00{def_ref}{def_hash}", file=f)
 
 
 def main(_args: argparse.Namespace) -> int:
     logger.info("Startig with args: %s", vars(_args))
 
-    logger.info("Parsing XML document ...")
-    tree_iter = load_and_parse_xmldoc(_args.source_path)
-    if not tree_iter:
-        logger.critical("Fatal: no XML document")
-        sys.exit(1)
+    if _args.output_format == "indexed" and not _args.output_path:
+        logger.critical("Fatal: the indexed output format requires -o/--output-path")
+        return 1
 
-    logger.info("Filtering ...")
-    mame_build, mame_config, machines = pick_mame_metadata(tree_iter)
+    if _args.jobs < 1:
+        logger.critical("Fatal: -j/--jobs must be at least 1")
+        return 1
+    if _args.jobs > 1 and _args.source_path == "-":
+        logger.critical("Fatal: parallel parsing requires a path to a file")
+        return 1
 
-    logger.info("Converting to JSON lines and writing to stdout ...")
-    # Write JSON lines in order to avoid using hundreds of megabytes of memory
-    # on the reading end while aiming to stay fast and pragmatic enough.
-    print(json.dumps({"mame_build": mame_build, "mame_config": mame_config}))
-    for machine_name, ports in machines.items():
-        print(f"{machine_name}\x00{json.dumps(ports)}")
+    logger.info("Parsing XML document ...")
+    mame_info: MameInfoDto = {"mame_build": "", "mame_config": ""}
+    parsed_machines: collections.abc.Iterable[tuple[str, dict[str, InputPortDto]]]
+    if _args.jobs > 1:
+        parsed_machines = iter_mame_metadata_parallel(
+            _args.source_path, _args.jobs, mame_info, _args.log_level
+        )
+    elif _args.parser == "expat":
+        try:
+            xml_file = (
+                sys.stdin.buffer
+                if _args.source_path == "-"
+                else open(_args.source_path, "rb")
+            )
+        except OSError:
+            logger.exception("Could not open XML document %s", _args.source_path)
+            logger.critical("Fatal: no XML document")
+            return 1
+        parsed_machines = iter_mame_metadata_expat(read_chunks(xml_file), mame_info)
+    else:
+        tree_iter = load_and_parse_xmldoc(_args.source_path)
+        if not tree_iter:
+            logger.critical("Fatal: no XML document")
+            sys.exit(1)
+        parsed_machines = iter_mame_metadata(tree_iter, mame_info)
+
+    machines: collections.abc.Iterable[tuple[str, dict[str, InputPortDto]]]
+    try:
+        if _args.stream:
+            logger.info("Filtering and writing as machines are parsed ...")
+            machines = prime_machines(iter_unique_machines(parsed_machines))
+        else:
+            logger.info("Filtering ...")
+            machines = collect_machines(parsed_machines).items()
+
+        if _args.output_format == "indexed":
+            logger.info(
+                "Converting to indexed format and writing to %s ...",
+                _args.output_path,
+            )
+            try:
+                with open(_args.output_path, "wb") as f:
+                    inp2json.write_ports_ref_index(
+                        f, mame_info["mame_build"], mame_info["mame_config"], machines
+                    )
+            except OSError:
+                logger.exception("Could not write %s", _args.output_path)
+                return 1
+        else:
+            logger.info("Converting to JSON lines and writing ...")
+            # Write JSON lines in order to avoid using hundreds of megabytes of
+            # memory on the reading end while aiming to stay fast and pragmatic
+            # enough.
+            try:
+                with open_lines_output(_args.output_path) as f:
+                    write_lines(f, mame_info, machines)
+            except OSError:
+                logger.exception("Could not write %s", _args.output_path)
+                return 1
+    except (ET.ParseError, xml.parsers.expat.ExpatError):
+        logger.exception("Could not parse XML document %s", _args.source_path)
+        return 1
+    except (OSError, ValueError):
+        logger.exception("Could not read XML document %s", _args.source_path)
+        return 1
 
     logger.info("Done.")
 
     return 0
 
 
-if __name__ == "__main__":
-    args = parse_args()
-
-    handler = logging.StreamHandler(sys.stderr)
-    formatter = logging.Formatter(
-        "[%(filename)s:%(lineno)s - %(funcName)-20s][%(levelname)-8s] %(message)s"
-    )
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-
-    numeric_loglevel = getattr(logging, args.log_level.upper(), None)
+def setup_logging(log_level: str) -> None:
+    """Make the logger of this module log to stderr at the given level."""
+    numeric_loglevel = getattr(logging, log_level.upper(), None)
     if not isinstance(numeric_loglevel, int):
-        raise ValueError(f"Invalid log level: {args.log_level}")
+        raise ValueError(f"Invalid log level: {log_level}")
+
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stderr)
+        formatter = logging.Formatter(
+            "[%(filename)s:%(lineno)s - %(funcName)-20s][%(levelname)-8s] %(message)s"
+        )
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
     logger.setLevel(numeric_loglevel)
 
+
+if __name__ == "__main__":
+    args = parse_args()
+    setup_logging(args.log_level)
     sys.exit(main(args))
@@ -3,19 +3,44 @@
 """Convert a MAME input file (INP) to JSON text."""
 
 import argparse
+import bisect
+import concurrent.futures
+import collections
+import contextlib
+import decimal
 import gzip
+import hashlib
 import io
+import itertools
 import json
+import mmap
+import operator
+import os
 import re
 import struct
 import sys
+import time
+import traceback
 import zlib
 from datetime import datetime
 
+import inpcolumns
+import inpindex
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 INPUTPORT_REF_PATH_DEF = "mame_inputport_ref.gz"
+PAYLOAD_CHUNK_SIZE = 1 << 16
+CACHE_MAX_SIZE_DEF = 1024  # MiB
+FOLLOW_POLL_INTERVAL = 0.05  # seconds
+AUTO_DETECT_FRAMES = 4096
 
 HEADER_BYTES = 64
 SKIP_BYTES = 16 * 0
+DECOMPRESSED_SUFFIX = ".decompressed"
 OFFS_BASETIME = 0x08
 OFFS_MAJVERSION = 0x10
 OFFS_MINVERSION = 0x11
@@ -26,6 +51,41 @@ BASETIME_BYTES = 0x08
 SYSNAME_BYTES = 0x0C
 APPDESC_BYTES = 0x20
 
+# Indexed input port reference file, as an alternative to the gzipped JSON lines
+# format: a fixed header, a JSON metadata blob, zlib-compressed records and an
+# open-addressing hash table (key -> record) at the end, so that any machine can
+# be looked up with a constant number of seeks. As of version 2, each distinct
+# definition (the input port reference data of a machine) is stored once, under
+# the key PORTS_REF_DEF_PREFIX + definition hash, and the record of each sysname
+# refers to it; version 1 files store the definition in the sysname's record.
+PORTS_REF_INDEX_MAGIC = b"INP2JREF"
+PORTS_REF_INDEX_VERSION = 2
+PORTS_REF_INDEX_VERSIONS_SUPPORTED = (1, 2)
+PORTS_REF_DEF_PREFIX = "def:"
+# Prefix of a reference to a definition by its hash, in place of the definition.
+# In the gzipped JSON lines format, a machine whose definition equals that of an
+# earlier line refers to it this way.
+PORTS_REF_DEF_REF = b"="
+# As of version 2 of the gzipped JSON lines format, marked by a "format" key in
+# its header line, each definition is preceded by PORTS_REF_DEF_KEY + its hash
+# and a NUL byte, so that it can be found by its hash without hashing any line.
+# Version 1 files, with no such key, hold neither keys nor references.
+PORTS_REF_DEF_KEY = b"#"
+PORTS_REF_LINES_FORMAT = 2
+PORTS_REF_LINES_FORMATS_SUPPORTED = (1, 2)
+PORTS_REF_INDEX_HEADER_FMT = "<8sHIQI"  # magic, version, meta len, table offset, slots
+PORTS_REF_INDEX_SLOT_FMT = "<QQI"  # key hash, record offset, record length
+PORTS_REF_INDEX_HEADER_SIZE = struct.calcsize(PORTS_REF_INDEX_HEADER_FMT)
+PORTS_REF_INDEX_SLOT_SIZE = struct.calcsize(PORTS_REF_INDEX_SLOT_FMT)
+
+# Input port reference store, holding the reference data of many MAME builds in
+# the same file layout. Its metadata maps each build to its mameconfig version.
+# Definitions are stored as in indexed files; the record of each sysname maps
+# builds to definition hashes.
+PORTS_REF_STORE_MAGIC = b"INP2JRST"
+
+MAME_VERSION_RE = re.compile(r"(\d+)\.(\d+)(?:([bu])(\d+))?")
+
 # Unlike mainline MAME and ShmupMAME, WolfMAME's appdesc string skips `APPNAME`
 # and starts with the build version.
 APPDESC_RE = re.compile(r"(MAME )?(\d\S*)")
@@ -36,6 +96,25 @@ ANALOG_STRUCT_FMT = "<LLL?"  # accum, previous, sensitivity, reverse
 FRAME_STRUCT_SIZE = struct.calcsize(FRAME_STRUCT_FMT)
 DIGITAL_STRUCT_SIZE = struct.calcsize(DIGITAL_STRUCT_FMT)
 ANALOG_STRUCT_SIZE = struct.calcsize(ANALOG_STRUCT_FMT)
+FRAME_STRUCT = struct.Struct(FRAME_STRUCT_FMT)
+
+# Orders of ports within INP files, see port_order_for_version.
+PORT_ORDERS = ("tag", "legacy")
+# Bounds of a plausible frame period in attoseconds (1 kHz to 1 Hz).
+FRAME_PERIOD_MIN = 10**15
+FRAME_PERIOD_MAX = 10**18
+
+
+InpHeader = collections.namedtuple(
+    "InpHeader",
+    "header_bytes basetime inp_ver_maj inp_ver_min sysname appdesc bare_build_version",
+)
+
+# A payload layout tried by detect_payload_layout, along with its scores.
+LayoutCandidate = collections.namedtuple(
+    "LayoutCandidate",
+    "shmupmame_compat port_order timing_score remainder_ok ports_score",
+)
 
 
 class InpHeaderError(Exception):
@@ -50,6 +129,14 @@ class UnexpectedInpPayloadEndError(Exception):
     """This exception is raised when an INP payload ends unexpectedly."""
 
 
+class InpPayloadCorruptError(Exception):
+    """This exception is raised when a compressed INP payload could not be decompressed."""
+
+
+class InputPortRefError(Exception):
+    """This exception is raised when input port reference data could not be read or is invalid."""
+
+
 class UnsupportedGameError(Exception):
     """This exception is raised when it has been determined that a given game is unsupported."""
 
@@ -58,14 +145,239 @@ class UnsupportedMameVersionError(Exception):
     """This exception is raised when an INP file header indicates an unsupported MAME version."""
 
 
+class StageProfiler:
+    """
+    Collect wall-clock time per processing stage as well as throughput counters.
+
+    Stage times are exclusive: while a stage is entered from within another
+    one (e.g. decompression pulled in by frame decoding), only the inner stage
+    is charged. If `hook` is given, it is called with the report (see report)
+    when finish is called.
+    """
+
+    def __init__(self, hook=None):
+        self.hook = hook
+        self.stages = {}
+        self.counters = {}
+        self._stack = []
+        self._started = time.perf_counter()
+
+    def _enter(self, name):
+        now = time.perf_counter()
+        if self._stack:
+            parent = self._stack[-1]
+            self.stages[parent[0]] = self.stages.get(parent[0], 0.0) + now - parent[1]
+        self._stack.append([name, now])
+
+    def _exit(self):
+        now = time.perf_counter()
+        name, started = self._stack.pop()
+        self.stages[name] = self.stages.get(name, 0.0) + now - started
+        if self._stack:
+            self._stack[-1][1] = now
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager charging the time spent within it to stage `name`."""
+        self._enter(name)
+        try:
+            yield
+        finally:
+            self._exit()
+
+    def timed_call(self, name, func):
+        """Wrap func so that the time spent in each call is charged to stage `name`."""
+
+        def wrapper(*args, **kwargs):
+            self._enter(name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._exit()
+
+        return wrapper
+
+    def timed_iter(self, name, iterable, counter=None, size=None):
+        """
+        Wrap an iterable so that the time spent producing items is charged to stage `name`.
+
+        If `counter` is given, it is incremented by size(item) for each item,
+        or by one if `size` is None.
+        """
+        iterator = iter(iterable)
+        while True:
+            self._enter(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self._exit()
+            if counter is not None:
+                self.count(counter, size(item) if size is not None else 1)
+            yield item
+
+    def count(self, name, value=1):
+        """Increment counter `name` by `value`."""
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self):
+        """
+        Return a JSON-serializable dict summarizing the collected data.
+
+        It contains the time per stage, the counters, the total elapsed time
+        and the derived frame and byte throughput.
+        """
+        total_seconds = time.perf_counter() - self._started
+        frames = self.counters.get("frames", 0)
+        decode_seconds = self.stages.get("decode", 0.0)
+        decompress_seconds = self.stages.get("decompress", 0.0)
+        return {
+            "stages": {name: {"seconds": secs} for name, secs in self.stages.items()},
+            "counters": dict(self.counters),
+            "total_seconds": total_seconds,
+            "frames_per_second": frames / total_seconds if total_seconds else None,
+            "decode_frames_per_second": frames / decode_seconds
+            if decode_seconds
+            else None,
+            "decompress_bytes_per_second": (
+                self.counters.get("decompressed_bytes", 0) / decompress_seconds
+                if decompress_seconds
+                else None
+            ),
+        }
+
+    def finish(self):
+        """Return the report, after passing it to the hook (if any)."""
+        report = self.report()
+        if self.hook is not None:
+            self.hook(report)
+        return report
+
+
+class FileCache:
+    """
+    Size-bounded, least-recently-used cache of files within one directory.
+
+    Entries are addressed by a kind (a subdirectory) and a tuple of
+    JSON-serializable key parts, which are hashed into the file name. The
+    modification time of an entry is bumped on every hit and serves as its
+    recency. Whenever an entry has been stored, the least recently used
+    entries (of all kinds) are removed until the total size of the cache is
+    within `max_bytes`.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def entry_path(self, kind, key, suffix=""):
+        """Return the path of the entry of the given kind and key."""
+        digest = hashlib.sha256(json.dumps(key).encode()).hexdigest()
+        return os.path.join(self.path, kind, digest + suffix)
+
+    def get(self, kind, key, suffix=""):
+        """Return the path of the entry if it exists (marking it as recently used), else None."""
+        path = self.entry_path(kind, key, suffix)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    @contextlib.contextmanager
+    def store(self, kind, key, suffix=""):
+        """
+        Context manager yielding a binary file to write a new entry to.
+
+        The entry only becomes visible once the block has been left without
+        an exception; afterwards the cache is trimmed to its size limit.
+        """
+        tmp_path = self.tmp_path(kind, key, suffix)
+        try:
+            with open(tmp_path, "wb") as f:
+                yield f
+            self.commit(tmp_path, kind, key, suffix)
+        finally:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def tmp_path(self, kind, key, suffix=""):
+        """
+        Return the temporary path to write a new entry of the given kind and
+        key to, for entries that cannot be written within a block (see
+        store); the entry becomes visible by calling commit.
+        """
+        path = self.entry_path(kind, key, suffix)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return f"{path}.{os.getpid()}.tmp"
+
+    def commit(self, tmp_path, kind, key, suffix=""):
+        """
+        Move a new entry written to `tmp_path` into place and trim the cache.
+
+        An entry larger than the size limit would only displace all others
+        before being removed itself, so it is discarded right away.
+        """
+        if os.path.getsize(tmp_path) > self.max_bytes:
+            os.remove(tmp_path)
+            return
+        os.replace(tmp_path, self.entry_path(kind, key, suffix))
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits into its size limit."""
+        entries = []
+        total = 0
+        for dir_path, _, file_names in os.walk(self.path):
+            for file_name in file_names:
+                if file_name.endswith(".tmp"):
+                    continue
+                path = os.path.join(dir_path, file_name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, path))
+                total += st.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+
 def parse_args():
     parser = argparse.ArgumentParser(description=sys.modules[__name__].__doc__)
     parser.add_argument(
         "-i",
         "--input-file-path",
+        action="extend",
+        nargs="+",
+        type=str,
+        help="Path to the MAME INP file that should be converted. Multiple paths can be "
+        "given; directories are searched for *.inp files recursively. If more than one "
+        "file is to be converted, the files are converted in parallel (see -j/--jobs).",
+    )
+    parser.add_argument(
+        "--file-list",
         type=str,
-        required=True,
-        help="Path to the MAME INP file that should be converted.",
+        help="Path to a text file listing paths of INP files to convert, one per line, "
+        "in addition to -i/--input-file-path. Use '-' to read the list from stdin.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="Number of worker processes used when converting more than one file. "
+        "(default: number of CPUs)",
     )
     parser.add_argument(
         "-p",
@@ -82,14 +394,46 @@ def parse_args():
         type=str,
         default=INPUTPORT_REF_PATH_DEF,
         help="Path to a file containing input port reference data, as generated by the "
-        f"filter_convert_mamexml.py helper. (default: {INPUTPORT_REF_PATH_DEF}).",
+        "filter_convert_mamexml.py helper, either in the gzipped JSON lines or in the "
+        "indexed format, or to a reference store covering several MAME builds, as "
+        "generated by the ports_ref_store.py helper; the build closest to the one "
+        "the INP file has been recorded with is picked from a store. "
+        f"(default: {INPUTPORT_REF_PATH_DEF}).",
     )
     parser.add_argument(
         "-d",
         "--write-decompressed",
         action="store_true",
         default=False,
-        help="If specified, the decompressed INP file is written to the filesystem.",
+        help="If specified, the decompressed INP file is written to the filesystem, as "
+        "INPUT_FILE_PATH.decompressed. Later runs decode frames straight from it "
+        "instead of decompressing the INP file again, as long as the INP file does "
+        "not change.",
+    )
+    parser.add_argument(
+        "--index",
+        action="store_true",
+        default=False,
+        help="If specified, build a seekable sidecar index INPUT_FILE_PATH.inpidx "
+        "while converting, or, if an up-to-date one exists, use it to start decoding "
+        "at the nearest checkpoint when seeking (see --start-frame/--start-time).",
+    )
+    parser.add_argument(
+        "--start-frame",
+        type=int,
+        help="Number of the first frame to convert (frame numbers start at 1). "
+        "(default: convert from the beginning)",
+    )
+    parser.add_argument(
+        "--start-time",
+        type=parse_emulated_time,
+        help="Emulated time in seconds (fractions allowed); conversion starts at the "
+        "first frame at or after it. (default: convert from the beginning)",
+    )
+    parser.add_argument(
+        "--frame-count",
+        type=int,
+        help="Maximum number of frames to convert. (default: convert up to the end)",
     )
     parser.add_argument(
         "-l",
@@ -108,7 +452,150 @@ def parse_args():
         "ShmupMAME or MAME Plus (maintenance of which came to a halt years ago). Breaks "
         "processing of INP files not created using one of these forks.",
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--auto-detect",
+        action="store_true",
+        default=False,
+        help="Detect the payload layout by trial decoding the first "
+        f"{AUTO_DETECT_FRAMES} frames of each INP file with and without "
+        "-s/--shmupmame-compat and with each possible order of ports, instead of "
+        "relying on the MAME version and -s/--shmupmame-compat. Useful for "
+        "unattended conversion of INP files of mixed origin; also makes INP files "
+        "recorded using MAME 0.175 convertible.",
+    )
+    parser.add_argument(
+        "--analog",
+        action="store_true",
+        default=False,
+        help="If specified, the values of analog inputs (such as paddles, dials, "
+        "trackballs and analog sticks) are decoded and written along with the "
+        "pressed buttons: their accumulated value and the value of the previous "
+        "frame.",
+    )
+    parser.add_argument(
+        "-f",
+        "--output-format",
+        type=str,
+        choices=OUTPUT_FORMATS,
+        default=OUTPUT_FORMAT_DEF,
+        help="Output format. 'json' writes one JSON array containing all frames to "
+        "INPUT_FILE_PATH.json, 'ndjson' writes one JSON document per frame and line "
+        "to INPUT_FILE_PATH.ndjson, 'events' writes only button presses and releases "
+        "along with a port/button dictionary to INPUT_FILE_PATH.events.json, "
+        "'columnar' writes a compact binary file with fixed-width columns to "
+        "INPUT_FILE_PATH.inpcols, which can be read using the inpcolumns module, "
+        "'stats' writes only statistics of the inputs (press counts, hold durations, "
+        "presses per second, idle stretches, per-player activity, current speed) to "
+        "INPUT_FILE_PATH.stats.json. "
+        f"(default: {OUTPUT_FORMAT_DEF})",
+    )
+    parser.add_argument(
+        "-o",
+        "--output-path",
+        type=str,
+        help="Path to write the output of a single INP file to. Use '-' to write to "
+        "stdout; progress information is printed to stderr then. (default: "
+        "INPUT_FILE_PATH plus a suffix depending on the output format, see "
+        "-f/--output-format)",
+    )
+    parser.add_argument(
+        "--chunk-frames",
+        type=int,
+        help="Split the output into chunks of this many frames, written to the "
+        "directory INPUT_FILE_PATH.chunks (or -o/--output-path) as they fill up, one "
+        "complete document in the output format per chunk, along with a manifest "
+        "listing each chunk's frame range, time range and size, manifest.json.",
+    )
+    parser.add_argument(
+        "--chunk-seconds",
+        type=parse_emulated_time,
+        help="Like --chunk-frames, but split the output into chunks spanning this many "
+        "seconds of emulated time (fractions allowed) each.",
+    )
+    parser.add_argument(
+        "--follow",
+        action="store_true",
+        default=False,
+        help="Follow an INP file that is still being recorded: keep reading newly "
+        "appended data and write each frame as soon as it is complete, until the "
+        "recording ends, --follow-timeout expires or the program is interrupted. "
+        "Best combined with '-f ndjson -o -'.",
+    )
+    parser.add_argument(
+        "--follow-timeout",
+        type=float,
+        help="With --follow, stop after this many seconds without new data. "
+        "(default: wait until the recording ends)",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="count",
+        default=0,
+        help="Print information about each frame while converting: -v prints frame "
+        "numbers and timing data, -vv additionally prints pressed buttons. Slows down "
+        "the conversion considerably. (default: only print progress information)",
+    )
+    parser.add_argument(
+        "--profile-report",
+        type=str,
+        help="If specified, time each processing stage and write a JSON report "
+        "containing stage timings, byte and frame counts and throughput to the given path.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=os.environ.get("INP2JSON_CACHE_DIR"),
+        help="Directory to cache resolved input port reference data and decompressed "
+        "INP payloads in, so that later runs for the same game do not have to consult "
+        "the input port reference file, and later runs for the same INP file decode "
+        "frames straight from the decompressed payload. Entries are invalidated "
+        "automatically when the reference file or INP file changes. "
+        "(default: INP2JSON_CACHE_DIR environment variable; no caching if unset)",
+    )
+    parser.add_argument(
+        "--cache-max-size",
+        type=int,
+        default=CACHE_MAX_SIZE_DEF,
+        help="Size limit of the cache directory in MiB; least recently used entries "
+        f"are removed when it is exceeded. (default: {CACHE_MAX_SIZE_DEF})",
+    )
+    _args = parser.parse_args()
+    if not _args.input_file_path and not _args.file_list:
+        parser.error("one of -i/--input-file-path or --file-list is required")
+    if _args.jobs is not None and _args.jobs < 1:
+        parser.error("-j/--jobs must be at least 1")
+    if _args.auto_detect and _args.shmupmame_compat:
+        parser.error("--auto-detect and -s/--shmupmame-compat are mutually exclusive")
+    if _args.chunk_frames is not None and _args.chunk_seconds is not None:
+        parser.error("--chunk-frames and --chunk-seconds are mutually exclusive")
+    if _args.chunk_frames is not None and _args.chunk_frames < 1:
+        parser.error("--chunk-frames must be at least 1")
+    if _args.chunk_seconds is not None and not any(_args.chunk_seconds):
+        parser.error("--chunk-seconds must be greater than 0")
+    if (
+        _args.chunk_frames is not None or _args.chunk_seconds is not None
+    ) and _args.output_path == "-":
+        parser.error("chunked output cannot be written to stdout")
+    if _args.start_frame is not None and _args.start_time is not None:
+        parser.error("--start-frame and --start-time are mutually exclusive")
+    if _args.start_frame is not None and _args.start_frame < 1:
+        parser.error("--start-frame must be at least 1")
+    if _args.frame_count is not None and _args.frame_count < 0:
+        parser.error("--frame-count must not be negative")
+    return _args
+
+
+def parse_emulated_time(value):
+    """Parse a non-negative number of seconds into a (seconds, attoseconds) tuple."""
+    try:
+        seconds = decimal.Decimal(value)
+    except decimal.InvalidOperation as e:
+        raise argparse.ArgumentTypeError(f"invalid time: '{value}'") from e
+    if not seconds.is_finite() or seconds < 0:
+        raise argparse.ArgumentTypeError(f"invalid time: '{value}'")
+    whole_seconds = int(seconds)
+    return whole_seconds, int((seconds - whole_seconds) * 10**18)
 
 
 def parse_appdesc(appdesc):
@@ -125,380 +612,2658 @@ def parse_appdesc(appdesc):
     return None
 
 
+def mame_version_key(mame_version):
+    """
+    Return a key that MAME build versions (e.g. "0.250", "0.37b5", "0.106u2") sort
+    chronologically by.
+
+    Betas precede and updates follow the release they are numbered after.
+    """
+    match = MAME_VERSION_RE.match(mame_version)
+    if not match:
+        return tuple(int(number) for number in re.findall(r"\d+", mame_version))
+    major, minor, kind, number = match.groups()
+    sub = (0, 0) if kind is None else (-1 if kind == "b" else 1, int(number))
+    return (int(major), int(minor)) + sub
+
+
+def pick_closest_build(mame_builds, mame_version):
+    """
+    Pick the MAME build whose input port reference data suits an INP file best.
+
+    Return `mame_version` itself if it is one of `mame_builds`, else the most
+    recent build preceding it, else the earliest one. Without `mame_version`,
+    return the most recent build.
+    """
+    ordered = sorted(mame_builds, key=mame_version_key)
+    if mame_version is None:
+        return ordered[-1]
+    if mame_version in mame_builds:
+        return mame_version
+    pos = bisect.bisect_right(
+        [mame_version_key(mame_build) for mame_build in ordered],
+        mame_version_key(mame_version),
+    )
+    return ordered[pos - 1] if pos else ordered[0]
+
+
+def read_header(f):
+    """
+    Read and parse the header of an INP file from an opened binary file.
+
+    Return an InpHeader. Raise InpHeaderError if the header is invalid, and
+    UnicodeDecodeError if its strings cannot be decoded.
+    """
+    header_bytes = f.read(HEADER_BYTES)
+    if (
+        not header_bytes
+        or len(header_bytes) < HEADER_BYTES
+        or not header_bytes[:8] == b"MAMEINP\0"
+    ):
+        raise InpHeaderError("Not a MAME INP file")
+
+    basetime = int.from_bytes(
+        header_bytes[OFFS_BASETIME : OFFS_BASETIME + BASETIME_BYTES], "little"
+    )
+
+    inp_ver_maj = int(header_bytes[OFFS_MAJVERSION])
+    inp_ver_min = int(header_bytes[OFFS_MINVERSION])
+    if inp_ver_maj != 3 or inp_ver_min not in (0, 5):
+        raise InpHeaderError(f"Invalid INP version: {inp_ver_maj}.{inp_ver_min}")
+
+    sysname = (
+        header_bytes[OFFS_SYSNAME : OFFS_SYSNAME + SYSNAME_BYTES]
+        .decode("ascii")
+        .strip("\0")
+    )
+
+    appdesc = (
+        header_bytes[OFFS_APPDESC : OFFS_APPDESC + APPDESC_BYTES]
+        .decode("ascii")
+        .strip("\0")
+    )
+    bare_build_version = parse_appdesc(appdesc)
+    if not bare_build_version:
+        raise InpHeaderError("Unable to extract BARE_BUILD_VERSION")
+
+    return InpHeader(
+        header_bytes,
+        basetime,
+        inp_ver_maj,
+        inp_ver_min,
+        sysname,
+        appdesc,
+        bare_build_version,
+    )
+
+
 def parse_header(input_file_path):
     """
     Try to load an INP file from a file system path and partially parse it.
 
-    Return None on failure, else return sysname, header bytes, compressed
-    payload bytes, major MAME version and minor MAME version.
+    Return None on failure, else return the MAME build version, sysname,
+    header bytes, major INP version and minor INP version. The (compressed)
+    payload is not read; see iter_decompressed_payload.
     """
     try:
         with open(input_file_path, "rb") as f:
-            header_bytes = f.read(HEADER_BYTES)
-            if (
-                not header_bytes
-                or len(header_bytes) < HEADER_BYTES
-                or not header_bytes[:8] == b"MAMEINP\0"
-            ):
-                raise InpHeaderError("Not a MAME INP file")
+            header = read_header(f)
+    except (OSError, UnicodeDecodeError, InpHeaderError) as e:
+        print(f"Could not open and parse INP file at '{input_file_path}': {e}")
+        return None
 
-            basetime = int.from_bytes(
-                header_bytes[OFFS_BASETIME : OFFS_BASETIME + BASETIME_BYTES], "little"
-            )
-            print(
-                "INP file basetime: {} UTC".format(
-                    datetime.utcfromtimestamp(basetime).strftime("%Y-%m-%d %H:%M:%S")
-                )
-            )
+    print(
+        "INP file basetime: {} UTC".format(
+            datetime.utcfromtimestamp(header.basetime).strftime("%Y-%m-%d %H:%M:%S")
+        )
+    )
+    print(f"INP file sysname: {header.sysname}")
+    print(f"INP file appdesc: {header.appdesc}")
+
+    return (
+        header.bare_build_version,
+        header.sysname,
+        header.header_bytes,
+        header.inp_ver_maj,
+        header.inp_ver_min,
+    )
 
-            inp_ver_maj = int(header_bytes[OFFS_MAJVERSION])
-            inp_ver_min = int(header_bytes[OFFS_MINVERSION])
-            if inp_ver_maj != 3 or inp_ver_min not in (0, 5):
-                raise InpHeaderError(
-                    f"Invalid INP version: {inp_ver_maj}.{inp_ver_min}"
-                )
 
-            sysname = (
-                header_bytes[OFFS_SYSNAME : OFFS_SYSNAME + SYSNAME_BYTES]
-                .decode("ascii")
-                .strip("\0")
-            )
-            print(f"INP file sysname: {sysname}")
+def iter_decompressed_payload(
+    input_file_path,
+    chunk_size=PAYLOAD_CHUNK_SIZE,
+    tee=None,
+    follow=False,
+    idle_timeout=None,
+    on_wait=None,
+):
+    """
+    Incrementally decompress the payload of an INP file.
+
+    Yield the uncompressed payload in chunks of at most `chunk_size` bytes,
+    reading the compressed payload in chunks of the same size, so memory usage
+    does not depend on the length of the recording. If `tee` is given, it is a
+    writable binary file that every uncompressed chunk is written to as well.
+
+    If `follow` is true, the INP file is assumed to be still being recorded:
+    at the end of the file, wait for more data to be appended, polling every
+    FOLLOW_POLL_INTERVAL seconds, until the compressed stream ends or no data
+    has been appended for `idle_timeout` seconds (if given). `on_wait`, if
+    given, is called whenever all data available so far has been yielded and
+    waiting begins.
+
+    Raise UnexpectedInpPayloadEndError if the compressed payload is truncated,
+    after having yielded everything that could be decompressed, and
+    InpPayloadCorruptError if it is corrupt.
+    """
+    decompressor = zlib.decompressobj()
+    skip = SKIP_BYTES
+    waiting_since = None
+    with open(input_file_path, "rb") as f:
+        f.seek(HEADER_BYTES)
+        try:
+            while not decompressor.eof:
+                data = decompressor.unconsumed_tail or f.read(chunk_size)
+                if data:
+                    waiting_since = None
+                    chunk = decompressor.decompress(data, chunk_size)
+                elif follow and (
+                    waiting_since is None
+                    or idle_timeout is None
+                    or time.monotonic() - waiting_since < idle_timeout
+                ):
+                    if waiting_since is None:
+                        waiting_since = time.monotonic()
+                        if on_wait is not None:
+                            on_wait()
+                    time.sleep(FOLLOW_POLL_INTERVAL)
+                    continue
+                else:
+                    chunk = decompressor.flush()
+                    if not decompressor.eof and not chunk:
+                        raise UnexpectedInpPayloadEndError(
+                            "Compressed INP payload is truncated"
+                        )
+
+                if tee is not None:
+                    tee.write(chunk)
+                if skip:
+                    skipped = min(skip, len(chunk))
+                    chunk = chunk[skipped:]
+                    skip -= skipped
+                if chunk:
+                    yield chunk
+        except zlib.error as e:
+            raise InpPayloadCorruptError(
+                f"Could not decompress INP payload: {e}"
+            ) from e
 
-            appdesc = (
-                header_bytes[OFFS_APPDESC : OFFS_APPDESC + APPDESC_BYTES]
-                .decode("ascii")
-                .strip("\0")
-            )
-            bare_build_version = parse_appdesc(appdesc)
-            if not bare_build_version:
-                raise InpHeaderError("Unable to extract BARE_BUILD_VERSION")
-            print(f"INP file appdesc: {appdesc}")
 
-            compressed_payload_bytes = f.read()
-            return (
-                bare_build_version,
-                sysname,
-                header_bytes,
-                compressed_payload_bytes,
-                inp_ver_maj,
-                inp_ver_min,
-            )
-    except (OSError, UnicodeDecodeError, InpHeaderError) as e:
-        print(f"Could not open and parse INP file at '{input_file_path}': {e}")
+def wait_for_file_size(path, size, idle_timeout=None):
+    """
+    Wait for the file at `path` to exist and be at least `size` bytes long.
 
-    return None
+    Poll every FOLLOW_POLL_INTERVAL seconds. Return True once it is, or False
+    after `idle_timeout` seconds (if given) have passed.
+    """
+    started = time.monotonic()
+    while True:
+        try:
+            if os.path.getsize(path) >= size:
+                return True
+        except OSError:
+            pass
+        if idle_timeout is not None and time.monotonic() - started >= idle_timeout:
+            return False
+        time.sleep(FOLLOW_POLL_INTERVAL)
 
 
-def load_ports_ref(ports_ref_path, sysname):
+def map_decompressed_payload(path, header_bytes):
     """
-    Try to load an input port reference file from a file system path.
+    Memory-map a decompressed INP file, as written using -d/--write-decompressed.
 
-    The helper `filter_convert_mamexml.py` can be used to generate an input
-    port reference file in the expected format.
+    Return the read-only mapping, or None if the file does not start with
+    `header_bytes`, i.e. has not been written for the INP file at hand.
+    """
+    with open(path, "rb") as f:
+        if f.read(HEADER_BYTES) != header_bytes:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
-    Return input reference data for sysname, as well as the MAME build version
-    and mameconfig version, if input reference data matching sysname is found.
-    Raise UnsupportedGameError if no input reference data matching sysname is
-    found. Return None on failure to deal with the given path or file.
+
+def iter_mapped_payload(payload_map, offset=0, chunk_size=PAYLOAD_CHUNK_SIZE):
     """
-    sysname_bytes = sysname.encode("ascii")
-    mame_build = None
-    mame_config = None
-    try:
-        with gzip.open(ports_ref_path, "rb") as f:
-            maybe_mame_info = json.loads(next(f))
-            if (
-                "mame_build" in maybe_mame_info
-                and "mame_config" in maybe_mame_info
-                and len(maybe_mame_info) == 2
-            ):
-                mame_build = maybe_mame_info["mame_build"]
-                mame_config = maybe_mame_info["mame_config"]
-            else:
-                f.seek(0)
+    Yield the uncompressed payload of a memory-mapped decompressed INP file
+    (see map_decompressed_payload) in chunks, starting `offset` bytes into
+    the payload.
 
-            for line in f:
-                sysdata = line.split(b"\x00", 1)
-                if len(sysdata) != 2:
-                    return None
-                if sysdata[0] == sysname_bytes:
-                    return json.loads(sysdata[1]), mame_build, mame_config
-    except OSError as e:
-        print(f"Could not open input port reference file: {e}")
-    except UnicodeDecodeError:
-        print("Failed to unicode decode line")
-    except (json.JSONDecodeError, StopIteration):
-        print(f"Failed to parse input port reference data at '{ports_ref_path}'")
-    else:
-        raise UnsupportedGameError(
-            f"Could not find sysname/machine {sysname} in input port reference data at '{ports_ref_path}'"
-        )
+    The chunks are slices of a memoryview of the mapping, so nothing is
+    copied.
+    """
+    view = memoryview(payload_map)
+    for pos in range(HEADER_BYTES + SKIP_BYTES + offset, len(view), chunk_size):
+        yield view[pos : pos + chunk_size]
 
-    return None
 
+def decompressed_file_is_current(path, input_file_path):
+    """
+    Tell whether the decompressed INP file at `path` has been written in
+    full from the current contents of the INP file at `input_file_path`.
 
-def sort_ports_ref(ports_ref, mame_version):
+    Once complete, a decompressed file is stamped with the modification time
+    of its INP file (see stamp_decompressed_file), which changes as soon as
+    the INP file is written to.
     """
-    Try to sort the input port ref dict according to the given MAME version.
+    return os.stat(path).st_mtime_ns == os.stat(input_file_path).st_mtime_ns
 
-    On success, return the a new input port ref dict with its key-value-pairs
-    (input ports) sorted according to the given MAME version.
 
-    On failure, raise either UnsupportedMameVersionError or KeyError.
-    The first case occurs only with MAME version 0.175, as ports' order was
-    unspecified with that version. The second case indicates that `ports_ref`
-    contained insufficient data required for the detected sorting order.
+def stamp_decompressed_file(path, mtime_ns):
     """
-    # In MAME < 0.175, ports were ordered within INP files according to order
-    # of insertion into a list in memory.
-    # In MAME == 0.175, ports' order was unspecified and varied across platforms/compilers.
-    # See https://github.com/mamedev/mame/commit/d705e4a28d49b9eeeadc9c019a12cf580ae5ee8f
-    #
-    # In MAME >= 0.176 (up to and including the current version at the time of
-    # writing, which is 0.249), ports are ordered lexicographically by tag.
-    # See https://github.com/mamedev/mame/commit/ef22943d0161be210b7c0ef057fa6954fdfe1993
-    if mame_version == "0.175":
-        raise UnsupportedMameVersionError(mame_version)
-    if mame_version < "0.175":
+    Mark the decompressed INP file at `path` as complete (see
+    decompressed_file_is_current); `mtime_ns` is the modification time of
+    the INP file from before decompressing it.
+    """
+    os.utime(path, ns=(os.stat(path).st_atime_ns, mtime_ns))
 
-        def ports_ref_sort_key(item):
-            return item[1]["legacy_order"]
 
-    else:
+def ports_ref_index_key_hash(key):
+    """Return the 64 bit hash used to place `key` (bytes) in a reference index table."""
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
 
-        def ports_ref_sort_key(item):
-            return item
 
-    return dict(sorted(ports_ref.items(), key=ports_ref_sort_key))
+def ports_ref_def_hash(ports):
+    """Return the hash of a JSON-encoded definition (bytes) as a hex string."""
+    return hashlib.blake2b(ports, digest_size=16).hexdigest()
 
 
-def read_next_frame_metadata(data):
+def parse_ports_ref_def(ports, def_hash=None, def_cache=None):
     """
-    Try to read the next frame metadata.
+    Parse a JSON-encoded definition (bytes).
 
-    This function is designed to be called as part of a
-    read_next_frame_metadata->read_next_frame_digital_inputs
-    ->read_next_frame_analog_inputs loop in order to iterate over a
-    (non-compressed) INP file payload.
-
-    In case not enough data can be read, return None, else return seconds,
-    attoseconds and current speed.
+    `def_cache`, if given, is a dict mapping definition hashes to parsed
+    definitions, which is consulted first and updated. `def_hash` is the
+    hash of `ports`, if known. Parsed definitions may thus be shared and must
+    not be modified.
     """
-    next_data = data.read(FRAME_STRUCT_SIZE)
-    if not next_data:
-        return None
+    if def_cache is None:
+        return json.loads(ports)
+    if def_hash is None:
+        def_hash = ports_ref_def_hash(ports)
+    parsed = def_cache.get(def_hash)
+    if parsed is None:
+        parsed = def_cache[def_hash] = json.loads(ports)
+    return parsed
 
-    try:
-        return struct.unpack(FRAME_STRUCT_FMT, next_data)
-    except struct.error as e:
-        raise UnexpectedInpPayloadEndError(
-            f"Error when reading next frame metadata: {e}"
-        ) from e
 
+def iter_ports_ref_defs(machines):
+    """
+    Intern the definitions of (sysname, ports) pairs, as taken by
+    write_ports_ref_index.
 
-def read_next_frame_digital_inputs(data, ports_count):
+    Yield (sysname, JSON-encoded ports, definition hash, new) tuples, where
+    new tells whether the definition occurs for the first time.
     """
-    Try to read the next default and active digital input states.
+    def_hashes = set()
+    for sysname, ports in machines:
+        if not isinstance(ports, bytes):
+            ports = json.dumps(ports).encode()
+        def_hash = ports_ref_def_hash(ports)
+        new = def_hash not in def_hashes
+        def_hashes.add(def_hash)
+        yield sysname, ports, def_hash, new
 
-    This function is designed to be called as part of a
-    read_next_frame_metadata->read_next_frame_digital_inputs
-    ->read_next_frame_analog_inputs loop in order to iterate over a
-    (non-compressed) INP file payload.
 
-    In case not enough data can be read, return None. Else, return two mappings
-    between port index and bit fields (as ints); one representing default input
-    state, the other representing active input state.
+def write_ports_ref_index(f, mame_build, mame_config, machines):
     """
-    ports_def = {}
-    ports_digital = {}
+    Write an indexed input port reference file to the seekable binary file `f`.
 
-    for i in range(ports_count):
-        next_data = data.read(DIGITAL_STRUCT_SIZE)
-        try:
-            defvalue, digital = struct.unpack(DIGITAL_STRUCT_FMT, next_data)
-        except struct.error as e:
-            raise UnexpectedInpPayloadEndError(
-                f"Error when reading next digital input data: {e}"
-            ) from e
+    `machines` is an iterable of (sysname, ports) pairs, where ports is the
+    input port reference data of one machine, either as a dict or as already
+    JSON-encoded bytes. Records are written in iteration order; should a
+    sysname occur more than once, the last record wins. Each distinct
+    definition is written once.
+    """
 
-        ports_def[i] = defvalue
-        ports_digital[i] = digital
+    def iter_records():
+        for sysname, ports, def_hash, new in iter_ports_ref_defs(machines):
+            if new:
+                yield (PORTS_REF_DEF_PREFIX + def_hash).encode(), ports
+            yield sysname.encode("ascii"), PORTS_REF_DEF_REF + def_hash.encode()
 
-    return ports_def, ports_digital
+    meta = {"mame_build": mame_build, "mame_config": mame_config}
+    write_ports_ref_table(f, PORTS_REF_INDEX_MAGIC, meta, iter_records())
 
 
-def read_next_frame_analog_inputs(data, ports_count):
+def write_ports_ref_table(f, magic, meta, records):
     """
-    Try to read the next analog input state.
+    Write a file in the layout of indexed input port reference files to the
+    seekable binary file `f`.
 
-    This function is designed to be called as part of a
-    read_next_frame_metadata->read_next_frame_digital_inputs
-    ->read_next_frame_analog_inputs loop in order to iterate over a
-    (non-compressed) INP file payload.
+    `magic` tells the kind of file, `meta` is the metadata dict, and `records`
+    an iterable of (key, payload) pairs of bytes; keys must not contain NUL
+    bytes. Records are written in iteration order; should a key occur more
+    than once, the last record wins.
+    """
+    meta = json.dumps(meta).encode()
+    f.write(b"\0" * PORTS_REF_INDEX_HEADER_SIZE)
+    f.write(meta)
+
+    offset = PORTS_REF_INDEX_HEADER_SIZE + len(meta)
+    records_pos = {}
+    for key, payload in records:
+        record = zlib.compress(key + b"\x00" + payload, 9)
+        f.write(record)
+        records_pos[key] = (offset, len(record))
+        offset += len(record)
+
+    # Keep the load factor at or below 0.5 so that probe sequences stay short.
+    slots_count = 1
+    while slots_count < 2 * len(records_pos):
+        slots_count <<= 1
+    slots = [None] * slots_count
+    for key, (record_offset, record_len) in records_pos.items():
+        key_hash = ports_ref_index_key_hash(key)
+        slot = key_hash & (slots_count - 1)
+        while slots[slot] is not None:
+            slot = (slot + 1) & (slots_count - 1)
+        slots[slot] = (key_hash, record_offset, record_len)
+
+    table_offset = offset
+    empty_slot = struct.pack(PORTS_REF_INDEX_SLOT_FMT, 0, 0, 0)
+    for slot in slots:
+        f.write(struct.pack(PORTS_REF_INDEX_SLOT_FMT, *slot) if slot else empty_slot)
+
+    f.seek(0)
+    f.write(
+        struct.pack(
+            PORTS_REF_INDEX_HEADER_FMT,
+            magic,
+            PORTS_REF_INDEX_VERSION,
+            len(meta),
+            table_offset,
+            slots_count,
+        )
+    )
 
-    In case not enough data can be read, return None. Else, return True.
 
-    Processing of analog fields is currently not implemented, hence analog
-    input state is not returned. This function still has to be called in order
-    to be able to correctly traverse INP files that contain analog input
-    fields.
+def write_ports_ref_store(f, sources):
     """
-    for _ in range(ports_count):
-        next_data = data.read(ANALOG_STRUCT_SIZE)
-        try:
-            struct.unpack(ANALOG_STRUCT_FMT, next_data)
-        except struct.error as e:
-            raise UnexpectedInpPayloadEndError(
-                f"Error when reading next analog input data: {e}"
-            ) from e
+    Write an input port reference store to the seekable binary file `f`.
+
+    `sources` is a list of (mame_build, mame_config, machines) tuples, where
+    machines is an iterable of (sysname, ports) pairs as taken by
+    write_ports_ref_index, where ports may also be a reference to a
+    definition given earlier (see PORTS_REF_DEF_REF). Definitions identical
+    across builds (or machines) are stored only once. Should a build occur
+    more than once, its last occurrence wins as far as its mameconfig version
+    and the machines of both occurrences are concerned.
+
+    Return the number of machine definitions taken and the number of distinct
+    definitions stored.
+    """
+    meta = {
+        "builds": {mame_build: mame_config for mame_build, mame_config, _ in sources}
+    }
+    machine_builds = {}
+    def_hashes = set()
+    counts = [0]
+
+    def iter_records():
+        for mame_build, _, machines in sources:
+            for sysname, ports in machines:
+                if not isinstance(ports, bytes):
+                    ports = json.dumps(ports).encode()
+                if ports.startswith(PORTS_REF_DEF_REF):
+                    def_hash = ports[len(PORTS_REF_DEF_REF) :].decode("ascii")
+                    if def_hash not in def_hashes:
+                        raise ValueError(f"Unknown definition {def_hash}")
+                else:
+                    def_hash = ports_ref_def_hash(ports)
+                machine_builds.setdefault(sysname, {})[mame_build] = def_hash
+                counts[0] += 1
+                if def_hash not in def_hashes:
+                    def_hashes.add(def_hash)
+                    yield (PORTS_REF_DEF_PREFIX + def_hash).encode(), ports
+        for sysname, builds in machine_builds.items():
+            yield sysname.encode("ascii"), json.dumps(builds).encode()
+
+    write_ports_ref_table(f, PORTS_REF_STORE_MAGIC, meta, iter_records())
+    return counts[0], len(def_hashes)
+
+
+def read_ports_ref_index_header(f, magic=PORTS_REF_INDEX_MAGIC):
+    """
+    Read the fixed header and metadata of an opened indexed reference file.
 
-    return True  # placeholder
+    Return the metadata dict, the hash table offset and the hash table slot
+    count. Raise ValueError if the file is not an indexed reference file of a
+    supported version; `magic` tells which kind of such file is expected.
+    """
+    f.seek(0)
+    file_magic, version, meta_len, table_offset, slots_count = struct.unpack(
+        PORTS_REF_INDEX_HEADER_FMT, f.read(PORTS_REF_INDEX_HEADER_SIZE)
+    )
+    if file_magic != magic or version not in PORTS_REF_INDEX_VERSIONS_SUPPORTED:
+        raise ValueError("Not an input port reference index of a supported version")
+    if not slots_count or slots_count & (slots_count - 1):
+        raise ValueError("Invalid slot count")
 
+    return json.loads(f.read(meta_len)), table_offset, slots_count
 
-def calc_player_count(ports_ref):
-    """For the input port reference of one game, return the player count."""
-    player_indexes = set()
-    for ports in ports_ref.values():
-        for aux in ports["fields"].values():
-            if aux.get("player") is not None:
-                player_indexes.add(aux.get("player"))
-    return len(player_indexes)
 
+def read_ports_ref_index_record(f, table_offset, slots_count, key):
+    """
+    Look up one record in an opened indexed reference file.
 
-def read_next_frame_mameplus_custom_inputs(data, player_count):
+    Return the decompressed record payload stored under `key` (bytes), or None
+    if `key` is not contained in the index. Raise ValueError if the file is
+    malformed.
     """
-    Read extra, custom ports of INP files of MAME Plus based forks.
+    key_hash = ports_ref_index_key_hash(key)
+    slot = key_hash & (slots_count - 1)
+    for _ in range(slots_count):
+        f.seek(table_offset + slot * PORTS_REF_INDEX_SLOT_SIZE)
+        slot_hash, record_offset, record_len = struct.unpack(
+            PORTS_REF_INDEX_SLOT_FMT, f.read(PORTS_REF_INDEX_SLOT_SIZE)
+        )
+        if not record_offset:
+            return None
+        if slot_hash == key_hash:
+            f.seek(record_offset)
+            record = zlib.decompress(f.read(record_len)).split(b"\x00", 1)
+            if len(record) != 2:
+                raise ValueError("Malformed record")
+            if record[0] == key:
+                return record[1]
+        slot = (slot + 1) & (slots_count - 1)
+
+    return None
+
 
-    MAME forks ShmupMAME and MAME Plus (the former was based on the latter)
-    added generic extra ports (one per player) for "custom buttons" after the
-    driver-specific ports. Take those into account by skipping them, so that we
-    can correctly traverse INP files created by these forks.
+def iter_ports_ref_index_records(f, table_offset, slots_count):
     """
-    # We could detect these button inputs too, but there might not be that many
-    # occasions where this would actually be useful, so for now, it is left as
-    # an exercise for the reader.
-    for _ in range(player_count):
-        data.read(DIGITAL_STRUCT_SIZE)
+    Yield all (key, payload) records of an opened indexed reference file, in
+    file order. Raise ValueError if the file is malformed.
+    """
+    f.seek(table_offset)
+    table = f.read(slots_count * PORTS_REF_INDEX_SLOT_SIZE)
+    locations = sorted(
+        (record_offset, record_len)
+        for _, record_offset, record_len in struct.iter_unpack(
+            PORTS_REF_INDEX_SLOT_FMT, table
+        )
+        if record_offset
+    )
+    for record_offset, record_len in locations:
+        f.seek(record_offset)
+        record = zlib.decompress(f.read(record_len)).split(b"\x00", 1)
+        if len(record) != 2:
+            raise ValueError("Malformed record")
+        yield record[0], record[1]
 
-    return True  # placeholder
 
+def read_ports_ref_index_def(f, table_offset, slots_count, def_hash, def_cache=None):
+    """
+    Look up and parse one definition in an opened indexed reference file or
+    store, unless it is found in `def_cache` (see parse_ports_ref_def).
 
-# pylint: disable=unused-argument
-def check_digital_inputs(ports_ref, button_inputs_def, button_inputs_digital, port_idx):
+    Raise ValueError if it is missing or the file is malformed.
     """
-    Produce a list of pressed buttons that is both human- and machine-readable.
+    if def_cache is not None and def_hash in def_cache:
+        return def_cache[def_hash]
+    ports = read_ports_ref_index_record(
+        f, table_offset, slots_count, (PORTS_REF_DEF_PREFIX + def_hash).encode()
+    )
+    if ports is None:
+        raise ValueError("Missing definition")
+    return parse_ports_ref_def(ports, def_hash, def_cache)
+
 
-    Combine reference bit masks of one input port with a bit field
-    representing digital input state in order to produce a list of pressed
-    buttons.
+def read_ports_ref_from_index(f, ports_ref_path, sysname, def_cache=None):
     """
-    pressed_buttons = []
-    # We made sure in main() that ports to check are within ports_ref:
-    key = list(ports_ref)[port_idx]
-    fields = ports_ref[key]["fields"]
-    for mask, aux in fields.items():
-        mask = int(mask, base=10)  # sic
-        # Concerning ACTIVE_HIGH vs. ACTIVE_LOW fields, we do not need to
-        # xor button_inputs_def as MAME already writes normalized values.
-        if button_inputs_digital[port_idx] & mask == mask:
-            pressed_buttons.append(aux.get("type"))
+    Read the input port reference data of one machine from an indexed file.
 
-    if pressed_buttons:
-        print(f"{key} {','.join(pressed_buttons)}")
-    return pressed_buttons
+    Counterpart of read_ports_ref for files written by write_ports_ref_index.
+    """
+    try:
+        meta, table_offset, slots_count = read_ports_ref_index_header(f)
+        ports = read_ports_ref_index_record(
+            f, table_offset, slots_count, sysname.encode("ascii")
+        )
+        if ports is not None:
+            if ports.startswith(PORTS_REF_DEF_REF):
+                ports = read_ports_ref_index_def(
+                    f,
+                    table_offset,
+                    slots_count,
+                    ports[len(PORTS_REF_DEF_REF) :].decode("ascii"),
+                    def_cache,
+                )
+            else:
+                ports = parse_ports_ref_def(ports, def_cache=def_cache)
+            return ports, meta.get("mame_build"), meta.get("mame_config")
+    except (struct.error, zlib.error, ValueError) as e:
+        # json.JSONDecodeError is a subclass of ValueError
+        raise InputPortRefError(
+            f"failed to parse input port reference data at '{ports_ref_path}'"
+        ) from e
 
+    raise UnsupportedGameError(
+        f"Could not find sysname/machine {sysname} in input port reference data at '{ports_ref_path}'"
+    )
 
-def frame_timestamp_regress(
-    seconds_cur, attoseconds_cur, seconds_prev, attoseconds_prev
+
+def read_ports_ref_from_store(
+    f, ports_ref_path, sysname, mame_version=None, def_cache=None
 ):
     """
-    Check if the compound value of the current frame timestamp regressed.
+    Read the input port reference data of one machine from a reference store.
 
-    Return True if the current frame timestamp has a lower compound value than
-    the previous one, else return False.
+    Counterpart of read_ports_ref for files written by write_ports_ref_store.
+    Of the builds the store holds data of the machine for, the one picked by
+    pick_closest_build for `mame_version` is used.
     """
-    return seconds_cur < seconds_prev or (
-        attoseconds_cur < attoseconds_prev and seconds_cur == seconds_prev
+    try:
+        meta, table_offset, slots_count = read_ports_ref_index_header(
+            f, PORTS_REF_STORE_MAGIC
+        )
+        builds = read_ports_ref_index_record(
+            f, table_offset, slots_count, sysname.encode("ascii")
+        )
+        if builds is not None:
+            builds = json.loads(builds)
+            mame_build = pick_closest_build(builds, mame_version)
+            ports = read_ports_ref_index_def(
+                f, table_offset, slots_count, builds[mame_build], def_cache
+            )
+            return ports, mame_build, meta["builds"].get(mame_build)
+    except (struct.error, zlib.error, ValueError, KeyError, TypeError) as e:
+        # json.JSONDecodeError is a subclass of ValueError
+        raise InputPortRefError(
+            f"failed to parse input port reference data at '{ports_ref_path}'"
+        ) from e
+
+    raise UnsupportedGameError(
+        f"Could not find sysname/machine {sysname} in input port reference data at '{ports_ref_path}'"
     )
 
 
-def iter_inp_payload(ports_ref, inp_data, ports_to_check=None, shmupmame_compat=False):
-    """
-    Convert an INP file payload into one list of pressed buttons per frame.
+def is_ports_ref_store(ports_ref_path):
+    """Tell whether a file system path is that of an input port reference store."""
+    try:
+        with open(ports_ref_path, "rb") as f:
+            return f.read(len(PORTS_REF_STORE_MAGIC)) == PORTS_REF_STORE_MAGIC
+    except OSError:
+        return False
 
-    Return a chronologically sorted list containing one dict per input frame,
-    each containing timing data as well as a list of inputs that are active
-    during the particular frame.
 
-    The `ports_to_check` argument can be used to ignore specific input ports.
-    It takes a list of 0-based port indexes (MAME orders the ports
-    alphabetically by name). If it is None, all available ports are taken into
-    account.
+def read_ports_ref_lines_header(f, ports_ref_path):
     """
-    output = []
-    frame_no = 0
-    seconds_cur = attoseconds_cur = 0
-    ports_count = len(ports_ref)
-    player_count = calc_player_count(ports_ref)
+    Read the header line of an opened gzipped JSON lines reference file.
 
-    analog_fields_count = 0
-    for p in ports_ref.values():
-        analog_fields_count += sum(1 for x in p["fields"].values() if x["analog"])
+    Return the MAME build version and mameconfig version given in the header,
+    or None for both if there is no header line, in which case the file is
+    rewound, as well as the format version. Raise InputPortRefError if the
+    format version is not supported.
+    """
+    maybe_mame_info = json.loads(next(f))
+    if not (
+        isinstance(maybe_mame_info, dict)
+        and "mame_build" in maybe_mame_info
+        and "mame_config" in maybe_mame_info
+    ):
+        f.seek(0)
+        return None, None, 1
+
+    lines_format = maybe_mame_info.get("format", 1)
+    if lines_format not in PORTS_REF_LINES_FORMATS_SUPPORTED:
+        raise InputPortRefError(
+            f"unsupported input port reference format {lines_format!r} at "
+            f"'{ports_ref_path}', supported are {PORTS_REF_LINES_FORMATS_SUPPORTED}"
+        )
+    return maybe_mame_info["mame_build"], maybe_mame_info["mame_config"], lines_format
 
-    if ports_to_check is None:
-        ports_to_check = range(ports_count)
 
-    while True:
-        frame_no += 1
-
-        metadata = read_next_frame_metadata(inp_data)
-        if metadata is None:
-            # Expected end of an INP file payload.
-            print("END OF REPLAY")
-            break
-
-        seconds_prev = seconds_cur
-        attoseconds_prev = attoseconds_cur
-        seconds_cur, attoseconds_cur, curspeed = metadata
-        if frame_timestamp_regress(
-            seconds_cur, attoseconds_cur, seconds_prev, attoseconds_prev
-        ):
-            # We should be able to assume that the sequence of frame timestamps
-            # encountered when traversing any well-formed INP file from
-            # beginning to end increases monotonically. In practice, if it
-            # doesn't, then this is a clue that the expected payload format
-            # does not coincide with the actual format: we are likely
-            # misinterpreting the data, generating garbled output, so stop if
-            # we see this.
-            raise InpPayloadSanityCheckError("Bumped into frame timestamp decrease")
-
-        print(f"Frame #{frame_no} {seconds_cur} {attoseconds_cur} {curspeed}")
-
-        digital_inputs = read_next_frame_digital_inputs(inp_data, ports_count)
-        button_inputs_def, button_inputs_digital = digital_inputs
-
-        read_next_frame_analog_inputs(inp_data, analog_fields_count)
-
-        if shmupmame_compat:
-            read_next_frame_mameplus_custom_inputs(inp_data, player_count)
-
-        next_frame_output = {
-            "f": frame_no,
-            "s": seconds_cur,
-            "as": attoseconds_cur,
-            "cs": curspeed,
-            "p": {},
-        }
+def split_ports_ref_line(line):
+    """
+    Split a line of a gzipped JSON lines reference file.
 
-        for port_idx in ports_to_check:
-            next_frame_output["p"][port_idx] = check_digital_inputs(
-                ports_ref, button_inputs_def, button_inputs_digital, port_idx
-            )
+    Return the sysname, the JSON-encoded definition or a reference to one (see
+    PORTS_REF_DEF_REF) and the definition hash if the line is keyed by it (see
+    PORTS_REF_DEF_KEY), else None, all as bytes. Raise ValueError if the line
+    is malformed.
+    """
+    sysdata = line.rstrip(b"\n").split(b"\x00", 2)
+    if len(sysdata) == 3 and sysdata[1].startswith(PORTS_REF_DEF_KEY):
+        return sysdata[0], sysdata[2], sysdata[1][len(PORTS_REF_DEF_KEY) :]
+    if len(sysdata) != 2:
+        raise ValueError("Malformed line")
+    return sysdata[0], sysdata[1], None
 
-        output.append(next_frame_output)
 
-    return output
+def find_ports_ref_lines_def(f, def_hash):
+    """
+    Find a definition in an opened gzipped JSON lines reference file by its
+    hash, scanning from the start. Return the JSON-encoded definition, or None.
+    """
+    def_key = PORTS_REF_DEF_KEY + def_hash.encode("ascii")
+    f.seek(0)
+    for line in f:
+        sysdata = line.split(b"\x00", 2)
+        if len(sysdata) == 3 and sysdata[1] == def_key:
+            return sysdata[2].rstrip(b"\n")
+
+    return None
+
+
+def read_ports_ref(ports_ref_path, sysname, mame_version=None, def_cache=None):
+    """
+    Read the input port reference data of one machine from a file system path.
+
+    The helper `filter_convert_mamexml.py` can be used to generate an input
+    port reference file in the expected format. Both the gzipped JSON lines
+    format and the indexed format (see write_ports_ref_index) are accepted, as
+    well as reference stores (see write_ports_ref_store); the latter two are
+    told apart by their magic bytes. `mame_version` is the MAME build version
+    the INP file has been recorded with; it only matters for stores.
+    `def_cache`, if given, is a dict that parsed definitions are cached in by
+    their hash, so that machines sharing a definition (such as clones) share
+    a single parsed copy (see parse_ports_ref_def).
+
+    Return input reference data for sysname, as well as the MAME build version
+    and mameconfig version it stems from. Raise UnsupportedGameError if no
+    input reference data matching sysname is found, and InputPortRefError on
+    failure to deal with the given path or file.
+    """
+    sysname_bytes = sysname.encode("ascii")
+    try:
+        with open(ports_ref_path, "rb") as f:
+            magic = f.read(len(PORTS_REF_INDEX_MAGIC))
+            if magic == PORTS_REF_INDEX_MAGIC:
+                return read_ports_ref_from_index(f, ports_ref_path, sysname, def_cache)
+            if magic == PORTS_REF_STORE_MAGIC:
+                return read_ports_ref_from_store(
+                    f, ports_ref_path, sysname, mame_version, def_cache
+                )
+
+        with gzip.open(ports_ref_path, "rb") as f:
+            mame_build, mame_config, _ = read_ports_ref_lines_header(
+                f, ports_ref_path
+            )
+            for line in f:
+                sysdata = line.split(b"\x00", 1)
+                if len(sysdata) != 2:
+                    raise InputPortRefError(
+                        f"failed to parse input port reference data at '{ports_ref_path}'"
+                    )
+                if sysdata[0] != sysname_bytes:
+                    continue
+                _, ports, def_hash = split_ports_ref_line(line)
+                if def_hash is not None:
+                    def_hash = def_hash.decode("ascii")
+                if not ports.startswith(PORTS_REF_DEF_REF):
+                    ports = parse_ports_ref_def(ports, def_hash, def_cache)
+                    return ports, mame_build, mame_config
+                # The definition is found on an earlier line.
+                def_hash = ports[len(PORTS_REF_DEF_REF) :].decode("ascii")
+                if def_cache is not None and def_hash in def_cache:
+                    return def_cache[def_hash], mame_build, mame_config
+                ports = find_ports_ref_lines_def(f, def_hash)
+                if ports is None:
+                    raise InputPortRefError(
+                        f"failed to parse input port reference data at '{ports_ref_path}'"
+                    )
+                ports = parse_ports_ref_def(ports, def_hash, def_cache)
+                return ports, mame_build, mame_config
+    except OSError as e:
+        raise InputPortRefError(f"could not open input port reference file: {e}") from e
+    except UnicodeDecodeError as e:
+        raise InputPortRefError("failed to unicode decode line") from e
+    except (ValueError, StopIteration) as e:
+        # json.JSONDecodeError is a subclass of ValueError
+        raise InputPortRefError(
+            f"failed to parse input port reference data at '{ports_ref_path}'"
+        ) from e
+
+    raise UnsupportedGameError(
+        f"Could not find sysname/machine {sysname} in input port reference data at '{ports_ref_path}'"
+    )
+
+
+def load_ports_ref(ports_ref_path, sysname, mame_version=None):
+    """
+    Try to load an input port reference file from a file system path.
+
+    Like read_ports_ref, but print a message and return None on failure to
+    deal with the given path or file. Raise UnsupportedGameError if no input
+    reference data matching sysname is found.
+    """
+    try:
+        return read_ports_ref(ports_ref_path, sysname, mame_version)
+    except InputPortRefError as e:
+        print(e)
+
+    return None
+
+
+def port_order_for_version(mame_version):
+    """
+    Return the order of ports within INP files of the given MAME version.
+
+    Return "legacy" if ports are ordered by the legacy_order of the input port
+    reference data, "tag" if they are ordered by tag, or None if the order is
+    unknown, which is only the case with MAME version 0.175.
+    """
+    # In MAME < 0.175, ports were ordered within INP files according to order
+    # of insertion into a list in memory.
+    # In MAME == 0.175, ports' order was unspecified and varied across platforms/compilers.
+    # See https://github.com/mamedev/mame/commit/d705e4a28d49b9eeeadc9c019a12cf580ae5ee8f
+    #
+    # In MAME >= 0.176 (up to and including the current version at the time of
+    # writing, which is 0.249), ports are ordered lexicographically by tag.
+    # See https://github.com/mamedev/mame/commit/ef22943d0161be210b7c0ef057fa6954fdfe1993
+    if mame_version == "0.175":
+        return None
+    if mame_version < "0.175":
+        return "legacy"
+    return "tag"
+
+
+def sort_ports_ref(ports_ref, mame_version, port_order=None):
+    """
+    Try to sort the input port ref dict according to the given MAME version.
+
+    On success, return the a new input port ref dict with its key-value-pairs
+    (input ports) sorted according to the given MAME version, or, if
+    `port_order` is given, in that order (one of PORT_ORDERS).
+
+    On failure, raise either UnsupportedMameVersionError or KeyError.
+    The first case occurs only with MAME version 0.175, as ports' order was
+    unspecified with that version. The second case indicates that `ports_ref`
+    contained insufficient data required for the detected sorting order.
+    """
+    if port_order is None:
+        port_order = port_order_for_version(mame_version)
+        if port_order is None:
+            raise UnsupportedMameVersionError(mame_version)
+    if port_order == "legacy":
+
+        def ports_ref_sort_key(item):
+            return item[1]["legacy_order"]
+
+    else:
+
+        def ports_ref_sort_key(item):
+            return item
+
+    return dict(sorted(ports_ref.items(), key=ports_ref_sort_key))
+
+
+def score_frame_timing(head, record_size, max_frames=AUTO_DETECT_FRAMES):
+    """
+    Rate how plausible the frame timestamps at the start of a payload are.
+
+    `head` holds the start of the uncompressed payload, which is assumed to
+    consist of records of `record_size` bytes; up to `max_frames` of them are
+    looked at. Return a score between 0 and 1: the mean of the fraction of
+    timestamps with less than a second worth of attoseconds, the fraction of
+    frames not going back in time, and the fraction of frame periods within
+    10% of the median period, the latter counting only if the median period
+    is plausible.
+    """
+    count = min(max_frames, len(head) // record_size)
+    if not count:
+        return 0.0
+    timestamps = [
+        FRAME_STRUCT.unpack_from(head, frame_idx * record_size)[:2]
+        for frame_idx in range(count)
+    ]
+    valid = sum(1 for _, attoseconds in timestamps if attoseconds < 10**18)
+    times = [seconds * 10**18 + attoseconds for seconds, attoseconds in timestamps]
+    periods = sorted(cur - prev for prev, cur in zip(times, times[1:]))
+    monotonic = sum(1 for period in periods if period >= 0)
+    regular = 0
+    if periods:
+        median = periods[len(periods) // 2]
+        if FRAME_PERIOD_MIN <= median <= FRAME_PERIOD_MAX:
+            regular = sum(
+                1 for period in periods if abs(period - median) * 10 <= median
+            )
+    return (valid / count + (monotonic + regular) / max(1, len(periods))) / 3
+
+
+def score_port_values(head, layout, ports_ref, max_frames=AUTO_DETECT_FRAMES):
+    """
+    Rate how well the digital input structs of a payload match the ports' order.
+
+    `layout` is the FrameLayout of the payload and `ports_ref` the input port
+    reference data sorted in the order to rate. For each port of the first
+    `max_frames` records in `head`, check whether the recorded default value
+    equals the one the reference data gives for the port's digital fields,
+    and whether the digital bit field only has bits of those fields set.
+    Return the fraction of checks passed, a score between 0 and 1.
+    """
+    count = min(max_frames, len(head) // layout.record_size)
+    if not count or not layout.ports_count:
+        return 0.0
+    masks = []
+    defvalues = []
+    for port in ports_ref.values():
+        mask = 0
+        defvalue = 0
+        for field_mask, field in port["fields"].items():
+            if not field["analog"]:
+                field_mask = int(field_mask, base=10)
+                mask |= field_mask
+                defvalue |= (field.get("defvalue") or 0) & field_mask
+        masks.append(mask)
+        defvalues.append(defvalue)
+
+    digital_struct = struct.Struct(DIGITAL_STRUCT_FMT)
+    passed = 0
+    for frame_idx in range(count):
+        record_offset = frame_idx * layout.record_size
+        for mask, defvalue, offset in zip(masks, defvalues, layout.digital_offsets):
+            recorded_defvalue, digital = digital_struct.unpack_from(
+                head, record_offset + offset
+            )
+            passed += (recorded_defvalue & mask == defvalue) + (not digital & ~mask)
+    return passed / (2 * count * layout.ports_count)
+
+
+def detect_payload_layout(
+    ports_ref,
+    mame_version,
+    head,
+    payload_size,
+    default=(False, None),
+    max_frames=AUTO_DETECT_FRAMES,
+):
+    """
+    Determine the payload layout of an INP file by trial decoding.
+
+    Candidate layouts differ in whether the extra ports of MAME Plus based
+    forks are present (see FrameLayout.for_decoder), which changes the record
+    size, and in the order of ports (see port_order_for_version). `ports_ref`
+    is the input port reference data of the recorded game, in any order, and
+    `head` the start of the uncompressed payload. Up to `max_frames` records
+    are decoded per candidate.
+
+    Candidates are ranked by the plausibility of their frame timestamps (see
+    score_frame_timing) first. `payload_size` is either the size of the whole
+    uncompressed payload or a callable returning it, which is only called if
+    the timestamps cannot tell record sizes apart. Candidates that leave no
+    unexpected remainder at the end of the payload rank higher next.
+    Port orders are ranked by score_port_values. `default` is the
+    (shmupmame_compat, port_order) tuple that wins ties; a port order of None
+    stands for the one of `mame_version`, or "tag" if that is unknown.
+
+    Return the list of LayoutCandidate tuples, best first.
+    """
+    default_order = default[1] or port_order_for_version(mame_version) or "tag"
+    default = (default[0], default_order)
+    orders = {}
+    for port_order in sorted(PORT_ORDERS, key=lambda order: order != default_order):
+        try:
+            sorted_ports_ref = sort_ports_ref(ports_ref, mame_version, port_order)
+        except KeyError:
+            continue
+        # Orders resulting in the same port order cannot be told apart.
+        if list(sorted_ports_ref) not in (list(other) for other in orders.values()):
+            orders[port_order] = sorted_ports_ref
+
+    decoder = PortDecoder(ports_ref)
+    layouts = {
+        shmupmame_compat: FrameLayout.for_decoder(decoder, shmupmame_compat)
+        for shmupmame_compat in ((False, True) if decoder.player_count else (False,))
+    }
+    timing_scores = {
+        shmupmame_compat: round(
+            score_frame_timing(head, layout.record_size, max_frames), 2
+        )
+        for shmupmame_compat, layout in layouts.items()
+    }
+    best_timing_score = max(timing_scores.values())
+    remainders_ok = dict.fromkeys(layouts)
+    if (
+        not callable(payload_size)
+        or list(timing_scores.values()).count(best_timing_score) > 1
+    ):
+        if callable(payload_size):
+            payload_size = payload_size()
+        for shmupmame_compat, layout in layouts.items():
+            remainder = payload_size % layout.record_size
+            remainders_ok[shmupmame_compat] = (
+                not remainder or remainder >= layout.custom_offset
+            )
+
+    candidates = [
+        LayoutCandidate(
+            shmupmame_compat,
+            port_order,
+            timing_scores[shmupmame_compat],
+            remainders_ok[shmupmame_compat],
+            round(
+                score_port_values(
+                    head, layouts[shmupmame_compat], sorted_ports_ref, max_frames
+                ),
+                2,
+            ),
+        )
+        for shmupmame_compat in layouts
+        for port_order, sorted_ports_ref in orders.items()
+    ]
+    candidates.sort(
+        key=lambda candidate: (
+            candidate.timing_score,
+            bool(candidate.remainder_ok),
+            candidate.ports_score,
+            candidate[:2] == default,
+        ),
+        reverse=True,
+    )
+    return candidates
+
+
+def ports_ref_cache_key(ports_ref_path, sysname, mame_version, port_order=None):
+    """
+    Return the key of the resolved input port reference data in a FileCache.
+
+    The reference file is identified by its path, size and modification time,
+    so that it does not have to be read to build the key, while entries are
+    invalidated as soon as the file changes. The MAME version only matters as
+    far as the port order is concerned, unless the file is a reference store;
+    `port_order`, if given, overrides the port order of the MAME version.
+    """
+    st = os.stat(ports_ref_path)
+    key = [
+        os.path.realpath(ports_ref_path),
+        st.st_size,
+        st.st_mtime_ns,
+        sysname,
+        port_order or port_order_for_version(mame_version),
+    ]
+    if is_ports_ref_store(ports_ref_path):
+        key.append(mame_version)
+    return key
+
+
+def load_cached_ports_ref(
+    cache, ports_ref_path, sysname, mame_version, port_order=None
+):
+    """
+    Try to get sorted input port reference data from a FileCache.
+
+    Return the same as load_ports_ref, but with the ports already sorted, or
+    None if there is no usable cache entry.
+    """
+    try:
+        key = ports_ref_cache_key(ports_ref_path, sysname, mame_version, port_order)
+        path = cache.get("ports", key, ".json")
+        if path is None:
+            return None
+        with open(path, "rb") as f:
+            entry = json.load(f)
+        return entry["ports_ref"], entry["mame_build"], entry["mame_config"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def store_cached_ports_ref(
+    cache, ports_ref_path, sysname, mame_version, ports_ref_data, port_order=None
+):
+    """Store sorted input port reference data in a FileCache, ignoring failures."""
+    ports_ref, mame_build, mame_config = ports_ref_data
+    try:
+        key = ports_ref_cache_key(ports_ref_path, sysname, mame_version, port_order)
+        with cache.store("ports", key, ".json") as f:
+            f.write(
+                json.dumps(
+                    {
+                        "ports_ref": ports_ref,
+                        "mame_build": mame_build,
+                        "mame_config": mame_config,
+                    }
+                ).encode()
+            )
+    except OSError:
+        # The cache is merely an optimization.
+        pass
+
+
+def calc_player_count(ports_ref):
+    """For the input port reference of one game, return the player count."""
+    player_indexes = set()
+    for ports in ports_ref.values():
+        for aux in ports["fields"].values():
+            if aux.get("player") is not None:
+                player_indexes.add(aux.get("player"))
+    return len(player_indexes)
+
+
+class PortDecoder:
+    """
+    Decoding plan for the digital inputs of one game.
+
+    Built once per game from its (sorted) input port reference, so that
+    decoding a frame does not have to re-derive anything from the reference
+    data: masks are converted to ints up front, and for each byte of a port's
+    bit field a lookup table maps the byte value to the set of fields that are
+    fully active within that byte. Fields whose mask spans more than one byte
+    are checked individually.
+
+    Lists of pressed buttons are cached per port and bit field value and
+    shared between frames, so they must not be modified by the caller.
+    """
+
+    # Upper bound for the number of distinct bit field values cached per port.
+    PRESSED_CACHE_SIZE = 1 << 16
+
+    def __init__(self, ports_ref):
+        self.port_names = list(ports_ref)
+        self.ports_count = len(self.port_names)
+        self.player_count = calc_player_count(ports_ref)
+
+        # Per analog field, in payload order: the index of its port and its
+        # name; and per port: the number of its analog fields.
+        self.analog_fields = []
+        self.analog_fields_counts = []
+        for port_idx, port in enumerate(ports_ref.values()):
+            names = [
+                aux.get("type") for aux in port["fields"].values() if aux["analog"]
+            ]
+            self.analog_fields.extend((port_idx, name) for name in names)
+            self.analog_fields_counts.append(len(names))
+        self.analog_fields_count = len(self.analog_fields)
+
+        # Per port: field masks, names and 0-based player indexes (None for
+        # fields not belonging to a player), in reference data order.
+        self.field_masks = []
+        self.field_names = []
+        self.field_players = []
+        self._byte_tables = []
+        self._wide_fields = []
+        self._pressed_cache = []
+        for port in ports_ref.values():
+            masks = [int(mask, base=10) for mask in port["fields"]]  # sic
+            self.field_masks.append(masks)
+            self.field_names.append(
+                [aux.get("type") for aux in port["fields"].values()]
+            )
+            self.field_players.append(
+                [
+                    None if aux.get("player") is None else int(aux["player"])
+                    for aux in port["fields"].values()
+                ]
+            )
+
+            byte_tables = [[0] * 256 for _ in range(4)]
+            wide_fields = []
+            for field_idx, mask in enumerate(masks):
+                # A zero mask ends up in the table of the first byte, where,
+                # like with the reference decoding, it is always active.
+                byte_idx = max(0, (mask.bit_length() - 1) // 8)
+                byte_mask = mask >> (8 * byte_idx)
+                if byte_idx > 3 or byte_mask << (8 * byte_idx) != mask:
+                    wide_fields.append((mask, 1 << field_idx))
+                    continue
+                table = byte_tables[byte_idx]
+                for value in range(256):
+                    if value & byte_mask == byte_mask:
+                        table[value] |= 1 << field_idx
+
+            self._byte_tables.append(
+                [table if any(table) else None for table in byte_tables]
+            )
+            self._wide_fields.append(wide_fields)
+            self._pressed_cache.append({})
+
+    def analog_fields_of(self, ports_to_check):
+        """
+        Return the analog fields of the ports in `ports_to_check`.
+
+        Return a list of (port index, name, analog field index) tuples, in
+        payload order.
+        """
+        return [
+            (port_idx, name, analog_idx)
+            for analog_idx, (port_idx, name) in enumerate(self.analog_fields)
+            if port_idx in ports_to_check
+        ]
+
+    def active_fields(self, port_idx, digital):
+        """
+        Return the set of active fields of one port as a bit set of field indexes.
+
+        Concerning ACTIVE_HIGH vs. ACTIVE_LOW fields, we do not need to xor
+        the default value as MAME already writes normalized values.
+        """
+        active = 0
+        for byte_idx, table in enumerate(self._byte_tables[port_idx]):
+            if table is not None:
+                active |= table[(digital >> (8 * byte_idx)) & 0xFF]
+        for mask, field_bit in self._wide_fields[port_idx]:
+            if digital & mask == mask:
+                active |= field_bit
+        return active
+
+    def pressed_buttons(self, port_idx, digital):
+        """
+        Produce a list of pressed buttons that is both human- and machine-readable.
+
+        Combine the reference bit masks of one input port with a bit field
+        representing its digital input state.
+        """
+        cache = self._pressed_cache[port_idx]
+        pressed_buttons = cache.get(digital)
+        if pressed_buttons is None:
+            names = self.field_names[port_idx]
+            active = self.active_fields(port_idx, digital)
+            pressed_buttons = [
+                name for field_idx, name in enumerate(names) if active >> field_idx & 1
+            ]
+            if len(cache) >= self.PRESSED_CACHE_SIZE:
+                cache.clear()
+            cache[digital] = pressed_buttons
+        return pressed_buttons
+
+
+def frame_timestamp_regress(
+    seconds_cur, attoseconds_cur, seconds_prev, attoseconds_prev
+):
+    """
+    Check if the compound value of the current frame timestamp regressed.
+
+    Return True if the current frame timestamp has a lower compound value than
+    the previous one, else return False.
+    """
+    return seconds_cur < seconds_prev or (
+        attoseconds_cur < attoseconds_prev and seconds_cur == seconds_prev
+    )
+
+
+def tuple_getter(indexes):
+    """Return a function that picks the items at `indexes` of a tuple as a tuple."""
+    if not indexes:
+        return lambda _: ()
+    if indexes == list(range(indexes[0], indexes[-1] + 1)):
+        # Also covers a single index, for which itemgetter would return the
+        # bare item.
+        return operator.itemgetter(slice(indexes[0], indexes[-1] + 1))
+    return operator.itemgetter(*indexes)
+
+
+class FrameLayout:
+    """
+    Fixed-size layout of one frame record within an (uncompressed) INP payload.
+
+    A record consists of the frame metadata, one digital input struct per
+    port, each followed by one analog input struct per analog field of the
+    port, and, for INP files of MAME Plus based forks, one extra digital
+    input struct per player. Since the size of a record is fixed per game,
+    whole runs of records can be unpacked in one go using a precompiled
+    struct, or a NumPy structured dtype if NumPy is available.
+
+    `analog_fields_counts` holds the number of analog fields of each port.
+    If `analog` is true, the accum and previous values of analog fields are
+    decoded as well, else analog input structs are skipped.
+    """
+
+    def __init__(self, analog_fields_counts, custom_ports_count=0, analog=False):
+        self.ports_count = len(analog_fields_counts)
+        self.analog_fields_count = sum(analog_fields_counts)
+        self.custom_ports_count = custom_ports_count
+        self.analog = analog
+
+        # Offsets of the record's sections, also used to tell which part of a
+        # truncated record is missing.
+        self.digital_offsets = []
+        self.analog_offsets = []
+        offset = FRAME_STRUCT_SIZE
+        for analog_fields_count in analog_fields_counts:
+            self.digital_offsets.append(offset)
+            offset += DIGITAL_STRUCT_SIZE
+            for _ in range(analog_fields_count):
+                self.analog_offsets.append(offset)
+                offset += ANALOG_STRUCT_SIZE
+        self.custom_offset = offset
+        self.record_size = self.custom_offset + custom_ports_count * DIGITAL_STRUCT_SIZE
+        self._sections = sorted(
+            [(0, "frame metadata", FRAME_STRUCT_SIZE)]
+            + [
+                (offset, "digital input data", DIGITAL_STRUCT_SIZE)
+                for offset in self.digital_offsets
+            ]
+            + [
+                (offset, "analog input data", ANALOG_STRUCT_SIZE)
+                for offset in self.analog_offsets
+            ]
+        )
+        self._section_offsets = [offset for offset, _, _ in self._sections]
+
+        # Default values of digital ports as well as the configuration of
+        # analog fields are not processed, so skip them as padding.
+        analog_fmt = (
+            f"ll{ANALOG_STRUCT_SIZE - 8}x" if analog else f"{ANALOG_STRUCT_SIZE}x"
+        )
+        self.record_struct = struct.Struct(
+            FRAME_STRUCT_FMT
+            + "".join(
+                f"{DIGITAL_STRUCT_SIZE - 4}xL" + analog_fmt * analog_fields_count
+                for analog_fields_count in analog_fields_counts
+            )
+            + f"{self.record_size - self.custom_offset}x"
+        )
+        assert self.record_struct.size == self.record_size
+        # Indexes of the digital bit fields and the analog values within an
+        # unpacked record, which interleaves them port by port.
+        digital_indexes = []
+        analog_indexes = []
+        idx = 3
+        for analog_fields_count in analog_fields_counts:
+            digital_indexes.append(idx)
+            idx += 1
+            if analog:
+                analog_indexes.extend(range(idx, idx + 2 * analog_fields_count))
+                idx += 2 * analog_fields_count
+        self._get_digital = tuple_getter(digital_indexes)
+        self._get_analog = tuple_getter(analog_indexes)
+
+        self.record_dtype = None
+        if numpy is not None:
+            names = ["s", "as", "cs"] + [f"d{i}" for i in range(self.ports_count)]
+            formats = ["<u4", "<u8", "<u4"] + ["<u4"] * self.ports_count
+            offsets = [0, 4, 12] + [offset + 4 for offset in self.digital_offsets]
+            if analog:
+                for analog_idx, offset in enumerate(self.analog_offsets):
+                    names += [f"a{analog_idx}", f"ap{analog_idx}"]
+                    formats += ["<i4", "<i4"]
+                    offsets += [offset, offset + 4]
+            self.record_dtype = numpy.dtype(
+                {
+                    "names": names,
+                    "formats": formats,
+                    "offsets": offsets,
+                    "itemsize": self.record_size,
+                }
+            )
+
+    @classmethod
+    def for_decoder(cls, decoder, shmupmame_compat=False, analog=False):
+        """
+        Return the frame layout of the game described by a PortDecoder.
+
+        MAME forks ShmupMAME and MAME Plus (the former was based on the
+        latter) added generic extra ports (one per player) for "custom
+        buttons" after the driver-specific ports. If `shmupmame_compat` is
+        true, take those into account by skipping them, so that we can
+        correctly traverse INP files created by these forks. For `analog`,
+        see FrameLayout.
+        """
+        # We could detect these button inputs too, but there might not be that
+        # many occasions where this would actually be useful, so for now, it is
+        # left as an exercise for the reader.
+        return cls(
+            decoder.analog_fields_counts,
+            decoder.player_count if shmupmame_compat else 0,
+            analog,
+        )
+
+    def truncation_error(self, remainder):
+        """Return an UnexpectedInpPayloadEndError for a record cut off after `remainder` bytes."""
+        section_idx = bisect.bisect_right(self._section_offsets, remainder) - 1
+        _, section, size = self._sections[section_idx]
+        return UnexpectedInpPayloadEndError(
+            f"Error when reading next {section}: unpack requires a buffer of {size} bytes"
+        )
+
+    def iter_records(self, chunks):
+        """
+        Decode frame records from an iterable of bytes-like payload chunks.
+
+        Chunks need not be aligned to record boundaries. Yield one tuple of
+        seconds, attoseconds, current speed, a sequence of digital input bit
+        fields (one per port) and a sequence of analog values per frame. The
+        latter holds the accum and previous value of each analog field, in
+        turn, if analog fields are decoded, else it is empty.
+
+        Raise InpPayloadSanityCheckError when the frame timestamps decrease,
+        and UnexpectedInpPayloadEndError when the payload ends within a
+        record, in both cases after having yielded all frames before.
+        """
+        record_size = self.record_size
+        pending = b""
+        timestamp = (0, 0)
+
+        for chunk in chunks:
+            view = memoryview(chunk).cast("B")
+            if pending:
+                missing = record_size - len(pending)
+                pending += bytes(view[:missing])
+                view = view[missing:]
+                if len(pending) < record_size:
+                    continue
+                timestamp = yield from self._decode(pending, timestamp)
+                pending = b""
+
+            full_size = len(view) - len(view) % record_size
+            if full_size:
+                timestamp = yield from self._decode(view[:full_size], timestamp)
+            pending = bytes(view[full_size:])
+
+        if pending:
+            if len(pending) < self.custom_offset:
+                raise self.truncation_error(len(pending))
+            # Short reads of the extra ports of MAME Plus based forks have
+            # always been tolerated.
+            pending += b"\0" * (record_size - len(pending))
+            yield from self._decode(pending, timestamp)
+
+    def _decode(self, buf, timestamp):
+        """
+        Decode a run of whole records; return the timestamp of the last one.
+
+        `timestamp` is the (seconds, attoseconds) tuple of the record preceding
+        the run.
+        """
+        if self.record_dtype is not None:
+            return (yield from self._decode_numpy(buf, timestamp))
+
+        seconds_prev, attoseconds_prev = timestamp
+        get_digital = self._get_digital
+        get_analog = self._get_analog
+        for record in self.record_struct.iter_unpack(buf):
+            seconds_cur, attoseconds_cur, curspeed = record[:3]
+            if frame_timestamp_regress(
+                seconds_cur, attoseconds_cur, seconds_prev, attoseconds_prev
+            ):
+                raise_timestamp_regress()
+            yield (
+                seconds_cur,
+                attoseconds_cur,
+                curspeed,
+                get_digital(record),
+                get_analog(record),
+            )
+            seconds_prev, attoseconds_prev = seconds_cur, attoseconds_cur
+
+        return seconds_prev, attoseconds_prev
+
+    def _decode_numpy(self, buf, timestamp):
+        records = numpy.frombuffer(buf, dtype=self.record_dtype)
+        seconds = records["s"]
+        attoseconds = records["as"]
+
+        seconds_prev = numpy.empty_like(seconds)
+        attoseconds_prev = numpy.empty_like(attoseconds)
+        seconds_prev[0], attoseconds_prev[0] = timestamp
+        seconds_prev[1:] = seconds[:-1]
+        attoseconds_prev[1:] = attoseconds[:-1]
+        regress = (seconds < seconds_prev) | (
+            (attoseconds < attoseconds_prev) & (seconds == seconds_prev)
+        )
+        regress_at = int(regress.argmax()) if regress.any() else len(records)
+
+        digital = (
+            zip(
+                *(
+                    records[f"d{i}"][:regress_at].tolist()
+                    for i in range(self.ports_count)
+                )
+            )
+            if self.ports_count
+            else itertools.repeat(())
+        )
+        analog = (
+            zip(
+                *(
+                    records[f"{name}{i}"][:regress_at].tolist()
+                    for i in range(self.analog_fields_count)
+                    for name in ("a", "ap")
+                )
+            )
+            if self.analog and self.analog_fields_count
+            else itertools.repeat(())
+        )
+        yield from zip(
+            seconds[:regress_at].tolist(),
+            attoseconds[:regress_at].tolist(),
+            records["cs"][:regress_at].tolist(),
+            digital,
+            analog,
+        )
+        if regress_at < len(records):
+            raise_timestamp_regress()
+
+        return int(seconds[-1]), int(attoseconds[-1])
+
+
+def raise_timestamp_regress():
+    """
+    Raise InpPayloadSanityCheckError because of a frame timestamp decrease.
+
+    We should be able to assume that the sequence of frame timestamps
+    encountered when traversing any well-formed INP file from beginning to end
+    increases monotonically. In practice, if it doesn't, then this is a clue
+    that the expected payload format does not coincide with the actual format:
+    we are likely misinterpreting the data, generating garbled output, so stop
+    if we see this.
+    """
+    raise InpPayloadSanityCheckError("Bumped into frame timestamp decrease")
+
+
+def make_frame_output(decoder, ports_to_check, frame_no, record, analog_fields=None):
+    """
+    Build the dict representing one frame in the JSON output.
+
+    `record` is a frame record as yielded by FrameLayout.iter_records. If
+    `analog_fields` is given, it is what PortDecoder.analog_fields_of
+    returned, and the frame additionally maps the index of each port that
+    has analog fields to a dict mapping the field names to [accum, previous]
+    lists under the key "a"; the record must hold analog values then.
+    """
+    seconds, attoseconds, curspeed, digital, analog = record
+    pressed_buttons = decoder.pressed_buttons
+    frame = {
+        "f": frame_no,
+        "s": seconds,
+        "as": attoseconds,
+        "cs": curspeed,
+        "p": {
+            port_idx: pressed_buttons(port_idx, digital[port_idx])
+            for port_idx in ports_to_check
+        },
+    }
+    if analog_fields is not None:
+        analog_output = {}
+        for port_idx, name, analog_idx in analog_fields:
+            analog_output.setdefault(port_idx, {})[name] = list(
+                analog[2 * analog_idx : 2 * analog_idx + 2]
+            )
+        frame["a"] = analog_output
+    return frame
+
+
+def iter_inp_payload(
+    decoder, chunks, ports_to_check=None, shmupmame_compat=False, analog=False
+):
+    """
+    Convert an INP file payload into one list of pressed buttons per frame.
+
+    Yield one dict per input frame in chronological order, each containing
+    timing data as well as a list of inputs that are active during the
+    particular frame.
+
+    `decoder` is the PortDecoder of the game the payload belongs to, `chunks`
+    an iterable of bytes-like objects holding the uncompressed payload.
+
+    The `ports_to_check` argument can be used to ignore specific input ports.
+    It takes a list of 0-based port indexes (MAME orders the ports
+    alphabetically by name). If it is None, all available ports are taken into
+    account. If `analog` is true, the values of analog fields are included.
+    """
+    if ports_to_check is None:
+        ports_to_check = range(decoder.ports_count)
+    analog_fields = decoder.analog_fields_of(ports_to_check) if analog else None
+
+    records = FrameLayout.for_decoder(decoder, shmupmame_compat, analog).iter_records(
+        chunks
+    )
+    for frame_no, record in enumerate(records, 1):
+        yield make_frame_output(
+            decoder, ports_to_check, frame_no, record, analog_fields
+        )
+
+
+class InpReader:
+    """
+    Lazily read an INP file.
+
+    Creating an InpReader reads and parses the INP header only; the parsed
+    header is available as `header`, and its most relevant parts as
+    `basetime`, `sysname`, `appdesc` and `version` (the MAME build version).
+    Input port reference data is resolved on first use, or explicitly by
+    calling resolve_ports, and the payload is only decompressed and decoded
+    while frames are being consumed, so consumers may stop early at no extra
+    cost. Nothing is printed; failures are reported by exceptions.
+
+    `ports_ref_data`, if given, is what read_ports_ref returned for the INP
+    file's sysname and MAME version; the input port reference file is not
+    consulted then. `port_order`, if given, is the order of ports within the
+    payload (one of PORT_ORDERS), overriding the one of the MAME version; see
+    detect_layout for determining it along with `shmupmame_compat`. If
+    `analog` is true, the values of analog fields are decoded as well.
+    `cache`, if given, is a FileCache that resolved reference data and
+    decompressed payloads are looked up in (see also open_decompressed) and
+    resolved reference data is stored to. `profiler`, if given, is a StageProfiler that
+    processing stages are timed with.
+
+    Raise OSError if the INP file cannot be read, InpHeaderError or
+    UnicodeDecodeError if its header is invalid.
+    """
+
+    def __init__(
+        self,
+        input_file_path,
+        inputport_ref_path=INPUTPORT_REF_PATH_DEF,
+        ports_to_check=None,
+        shmupmame_compat=False,
+        ports_ref_data=None,
+        cache=None,
+        profiler=None,
+        port_order=None,
+        analog=False,
+    ):
+        self.path = input_file_path
+        self.inputport_ref_path = inputport_ref_path
+        self.shmupmame_compat = shmupmame_compat
+        self.port_order = port_order
+        self.analog = analog
+        self._ports_to_check = ports_to_check
+        self._ports_ref_data = ports_ref_data
+        self._cache = cache
+        self._profiler = profiler
+
+        with self._stage("parse_header"):
+            with open(input_file_path, "rb") as f:
+                self.header = read_header(f)
+
+        self.index = None
+        self.payload_map = None
+        self.payload_complete = False
+        self.ports_source = None
+        self._ports_ref = None
+        self._mame_build = None
+        self._mame_config = None
+        self._decoder = None
+
+    def _stage(self, name):
+        if self._profiler is None:
+            return contextlib.nullcontext()
+        return self._profiler.stage(name)
+
+    @property
+    def basetime(self):
+        """The recording start time as a Unix timestamp."""
+        return self.header.basetime
+
+    @property
+    def sysname(self):
+        """The name of the recorded game (MAME machine)."""
+        return self.header.sysname
+
+    @property
+    def appdesc(self):
+        """The description of the recording application."""
+        return self.header.appdesc
+
+    @property
+    def version(self):
+        """The MAME build version the INP file has been recorded with."""
+        return self.header.bare_build_version
+
+    @property
+    def inp_version(self):
+        """The INP format version as a (major, minor) tuple."""
+        return self.header.inp_ver_maj, self.header.inp_ver_min
+
+    def use_cached_ports(self):
+        """
+        Try to resolve the input port reference data from the cache only.
+
+        Return True if the reference data is resolved afterwards, else False.
+        Reference data given to the constructor takes precedence and is not
+        looked up.
+        """
+        if self.ports_source is not None:
+            return True
+        if (
+            self._ports_ref_data is not None
+            or self._cache is None
+            or (self.port_order or port_order_for_version(self.version)) is None
+        ):
+            return False
+
+        with self._stage("load_ports_ref"):
+            resolved = load_cached_ports_ref(
+                self._cache,
+                self.inputport_ref_path,
+                self.sysname,
+                self.version,
+                self.port_order,
+            )
+        if resolved is None:
+            return False
+
+        self._set_ports(resolved, "cache")
+        return True
+
+    def resolve_ports(self):
+        """
+        Resolve the input port reference data of the recorded game.
+
+        Reference data given to the constructor is used if present, else it is
+        taken from the cache or read from the input port reference file. Set
+        `ports_source` to "given", "cache" or "file", respectively.
+
+        Raise InputPortRefError if the reference data cannot be read or is
+        insufficient, UnsupportedGameError if it does not cover the game, and
+        UnsupportedMameVersionError if the INP file has been recorded using a
+        MAME version whose port order is unknown.
+        """
+        if self.use_cached_ports():
+            return
+
+        self._sort_ports(*self._read_ports_ref_data())
+
+    def _read_ports_ref_data(self):
+        """Return the unsorted reference data and its source (see resolve_ports)."""
+        if self._ports_ref_data is not None:
+            return self._ports_ref_data, "given"
+        with self._stage("load_ports_ref"):
+            return (
+                read_ports_ref(self.inputport_ref_path, self.sysname, self.version),
+                "file",
+            )
+
+    def _sort_ports(self, ports_ref_data, source):
+        ports_ref, mame_build, mame_config = ports_ref_data
+        try:
+            with self._stage("sort_ports_ref"):
+                ports_ref = sort_ports_ref(ports_ref, self.version, self.port_order)
+        except KeyError as e:
+            raise InputPortRefError(
+                f"missing legacy sort order for game '{self.sysname}'"
+            ) from e
+
+        resolved = ports_ref, mame_build, mame_config
+        if source == "file" and self._cache is not None:
+            store_cached_ports_ref(
+                self._cache,
+                self.inputport_ref_path,
+                self.sysname,
+                self.version,
+                resolved,
+                self.port_order,
+            )
+        self._set_ports(resolved, source)
+
+    def _set_ports(self, resolved, source):
+        self._ports_ref, self._mame_build, self._mame_config = resolved
+        self.ports_source = source
+
+    def detect_layout(self, max_frames=AUTO_DETECT_FRAMES):
+        """
+        Determine the payload layout by trial decoding (see detect_payload_layout).
+
+        Decode up to `max_frames` records at the start of the payload for each
+        candidate layout, then set `shmupmame_compat` and `port_order` to the
+        best one and resolve the input port reference data accordingly. The
+        values given to the constructor win ties. Return the list of
+        candidates, best first.
+
+        Raise the same exceptions as resolve_ports, except for
+        UnsupportedMameVersionError, as the port order is detected.
+        """
+        ports_ref_data = None
+        if self._ports_ref_data is None and self._cache is not None:
+            # The reference data is sorted again anyway, so an entry cached
+            # for any port order will do.
+            with self._stage("load_ports_ref"):
+                for port_order in PORT_ORDERS:
+                    ports_ref_data = load_cached_ports_ref(
+                        self._cache,
+                        self.inputport_ref_path,
+                        self.sysname,
+                        self.version,
+                        port_order,
+                    )
+                    if ports_ref_data is not None:
+                        source = "cache"
+                        break
+        if ports_ref_data is None:
+            ports_ref_data, source = self._read_ports_ref_data()
+
+        with self._stage("detect_layout"):
+            max_record_size = FrameLayout.for_decoder(
+                PortDecoder(ports_ref_data[0]), True
+            ).record_size
+            head, complete = self._payload_head(max_frames * max_record_size)
+            candidates = detect_payload_layout(
+                ports_ref_data[0],
+                self.version,
+                head,
+                len(head) if complete else self._payload_size,
+                (self.shmupmame_compat, self.port_order),
+                max_frames,
+            )
+
+        self.shmupmame_compat, self.port_order = candidates[0][:2]
+        self.ports_source = None
+        self._decoder = None
+        self._sort_ports(ports_ref_data, source)
+        return candidates
+
+    def _payload_head(self, size):
+        """
+        Return at least `size` bytes of the start of the uncompressed payload.
+
+        Return a tuple of the bytes and whether they are the whole payload.
+        """
+        if self.payload_map is not None:
+            start = HEADER_BYTES + SKIP_BYTES
+            head = self.payload_map[start : start + size]
+            return head, len(head) < size
+        head = bytearray()
+        chunks = iter_decompressed_payload(self.path)
+        try:
+            for chunk in chunks:
+                head += chunk
+                if len(head) >= size:
+                    return bytes(head), False
+        except UnexpectedInpPayloadEndError:
+            pass
+        finally:
+            chunks.close()
+        return bytes(head), True
+
+    def _payload_size(self):
+        """Return the size of the uncompressed payload (as far as it can be decompressed)."""
+        if self.payload_map is not None:
+            return len(self.payload_map) - HEADER_BYTES - SKIP_BYTES
+        size = 0
+        try:
+            for chunk in iter_decompressed_payload(self.path):
+                size += len(chunk)
+        except UnexpectedInpPayloadEndError:
+            pass
+        return size
+
+    @property
+    def ports_ref(self):
+        """The input port reference data, sorted by port order."""
+        if self.ports_source is None:
+            self.resolve_ports()
+        return self._ports_ref
+
+    @property
+    def mame_build(self):
+        """The MAME build version the input port reference data stems from."""
+        if self.ports_source is None:
+            self.resolve_ports()
+        return self._mame_build
+
+    @property
+    def mame_config(self):
+        """The mameconfig version the input port reference data stems from."""
+        if self.ports_source is None:
+            self.resolve_ports()
+        return self._mame_config
+
+    @property
+    def decoder(self):
+        """The PortDecoder of the recorded game."""
+        if self._decoder is None:
+            ports_ref = self.ports_ref
+            with self._stage("compile_decoder"):
+                self._decoder = PortDecoder(ports_ref)
+        return self._decoder
+
+    @property
+    def ports(self):
+        """The names of the input ports, in port order."""
+        return self.decoder.port_names
+
+    @property
+    def ports_to_check(self):
+        """The indexes of the input ports that frames are decoded for."""
+        if self._ports_to_check is None:
+            return range(self.decoder.ports_count)
+        return self._ports_to_check
+
+    @property
+    def layout(self):
+        """The FrameLayout of the payload."""
+        return FrameLayout.for_decoder(self.decoder, self.shmupmame_compat, self.analog)
+
+    @property
+    def index_path(self):
+        """The default path of the sidecar index of the INP file."""
+        return f"{self.path}{inpindex.SUFFIX}"
+
+    def open_index(self, path=None):
+        """
+        Try to open the sidecar index at `path` (default: index_path).
+
+        The index is only used if it has been built from the very same INP
+        file using the same frame layout. Return True if it is, else False.
+        """
+        try:
+            index = inpindex.IndexReader(path or self.index_path)
+            source = inpindex.source_info(self.path, self.header.header_bytes)
+            if not index.is_valid_for(source, self.layout.record_size):
+                return False
+        except (OSError, ValueError, KeyError, inpindex.IndexFormatError):
+            return False
+
+        self.index = index
+        return True
+
+    @property
+    def decompressed_path(self):
+        """The default path of the decompressed copy of the INP file (see -d/--write-decompressed)."""
+        return f"{self.path}{DECOMPRESSED_SUFFIX}"
+
+    def payload_cache_key(self):
+        """Return the key of the decompressed payload of the INP file within a FileCache."""
+        return [
+            os.path.realpath(self.path),
+            inpindex.source_info(self.path, self.header.header_bytes),
+        ]
+
+    def open_decompressed(self):
+        """
+        Try to memory-map an up-to-date decompressed copy of the INP file.
+
+        Once mapped, as `payload_map`, frames are decoded straight from the
+        mapping instead of decompressing the payload again, and seeking to a
+        frame or an emulated time takes no decoding at all. The copy at
+        decompressed_path is used if it has been written in full from the
+        current INP file (see decompressed_file_is_current), else the one in
+        the cache, if any. Return where the copy has been found ("sidecar" or
+        "cache"), or None.
+        """
+        header_bytes = self.header.header_bytes
+        try:
+            if decompressed_file_is_current(self.decompressed_path, self.path):
+                self.payload_map = map_decompressed_payload(
+                    self.decompressed_path, header_bytes
+                )
+                if self.payload_map is not None:
+                    return "sidecar"
+        except (OSError, ValueError):
+            pass
+
+        if self._cache is None:
+            return None
+        try:
+            path = self._cache.get(
+                "payload", self.payload_cache_key(), DECOMPRESSED_SUFFIX
+            )
+            if path is not None:
+                self.payload_map = map_decompressed_payload(path, header_bytes)
+        except (OSError, ValueError):
+            return None
+        return None if self.payload_map is None else "cache"
+
+    def index_writer(self, f):
+        """Return an inpindex.IndexWriter writing the sidecar index of the INP file to `f`."""
+        return inpindex.IndexWriter(
+            f,
+            self.layout.record_size,
+            inpindex.source_info(self.path, self.header.header_bytes),
+        )
+
+    def _timed_chunks(self, chunks):
+        if self._profiler is None:
+            return chunks
+        return self._profiler.timed_iter(
+            "decompress", chunks, counter="decompressed_bytes", size=len
+        )
+
+    def _track_completion(self, chunks):
+        self.payload_complete = False
+        yield from chunks
+        self.payload_complete = True
+
+    def payload_chunks(self, tee=None, follow=False, idle_timeout=None, on_wait=None):
+        """
+        Yield the uncompressed payload in chunks (see iter_decompressed_payload).
+
+        If `tee` is given, it is a writable binary file that every
+        uncompressed chunk is written to as well. The remaining arguments
+        control following an INP file that is still being recorded. Unless
+        any of these are given, the chunks are taken from `payload_map` if
+        a decompressed copy has been opened (see open_decompressed).
+        `payload_complete` tells whether the payload has been read in full
+        once all chunks have been consumed.
+        """
+        if self.payload_map is not None and tee is None and not follow:
+            self.payload_complete = True
+            return self._timed_chunks(iter_mapped_payload(self.payload_map))
+        if self._profiler is not None:
+            try:
+                self._profiler.count(
+                    "compressed_bytes", os.path.getsize(self.path) - HEADER_BYTES
+                )
+            except OSError:
+                pass
+        return self._timed_chunks(
+            self._track_completion(
+                iter_decompressed_payload(
+                    self.path,
+                    tee=tee,
+                    follow=follow,
+                    idle_timeout=idle_timeout,
+                    on_wait=on_wait,
+                )
+            )
+        )
+
+    def records(self, chunks=None):
+        """
+        Yield the frame records of the payload (see FrameLayout.iter_records).
+
+        `chunks` defaults to payload_chunks().
+
+        Raise InpPayloadSanityCheckError if the payload does not look like it
+        matches the input port reference data, UnexpectedInpPayloadEndError if
+        it is truncated and InpPayloadCorruptError if it is corrupt.
+        """
+        if chunks is None:
+            chunks = self.payload_chunks()
+        records = self.layout.iter_records(chunks)
+        if self._profiler is not None:
+            records = self._profiler.timed_iter("decode", records, counter="frames")
+        return records
+
+    def numbered_records(self, chunks=None, start_frame=1, start_time=None):
+        """
+        Yield (frame number, frame record) tuples, frame numbers starting at 1.
+
+        Start at frame number `start_frame`, or, if `start_time` is given, at
+        the first frame at or after that emulated time, given as a tuple of
+        seconds and attoseconds. If `chunks` is None and a decompressed copy
+        has been opened (see open_decompressed), decoding starts right at that
+        frame, else, if an index has been opened (see open_index), at the
+        nearest checkpoint before; otherwise, all frames before are decoded
+        and skipped.
+        """
+        first_frame = 1
+        if chunks is None and self.payload_map is not None:
+            if start_time is not None:
+                frame_idx = self._mapped_frame_for_time(start_time)
+            else:
+                frame_idx = min(start_frame - 1, self._mapped_frames_count())
+            first_frame += frame_idx
+            chunks = self._timed_chunks(
+                iter_mapped_payload(
+                    self.payload_map, frame_idx * self.layout.record_size
+                )
+            )
+        elif chunks is None and self.index is not None:
+            if start_time is not None:
+                block_idx = self.index.block_for_time(*start_time)
+            else:
+                block_idx = self.index.block_for_frame(start_frame - 1)
+            first_frame += self.index.checkpoints[block_idx][0]
+            chunks = self._timed_chunks(self.index.iter_blocks(block_idx))
+
+        records = enumerate(self.records(chunks), first_frame)
+        if start_time is not None:
+            return itertools.dropwhile(lambda item: item[1][:2] < start_time, records)
+        return itertools.islice(records, max(0, start_frame - first_frame), None)
+
+    def _mapped_frames_count(self):
+        """Return the number of whole frame records within `payload_map`."""
+        return self._payload_size() // self.layout.record_size
+
+    def _mapped_frame_for_time(self, start_time):
+        """
+        Return the index of the first frame at or after the emulated time
+        `start_time` within `payload_map`, by bisecting the frame timestamps.
+        """
+        record_size = self.layout.record_size
+        start = HEADER_BYTES + SKIP_BYTES
+        low, high = 0, self._mapped_frames_count()
+        while low < high:
+            mid = (low + high) // 2
+            timestamp = FRAME_STRUCT.unpack_from(
+                self.payload_map, start + mid * record_size
+            )[:2]
+            if timestamp < start_time:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def frames(self, chunks=None, start_frame=1, start_time=None):
+        """
+        Yield one dict per frame, as found in the JSON output.
+
+        See iter_inp_payload; the arguments are the same as those of
+        numbered_records.
+        """
+        decoder = self.decoder
+        ports_to_check = self.ports_to_check
+        analog_fields = (
+            decoder.analog_fields_of(ports_to_check) if self.analog else None
+        )
+        for frame_no, record in self.numbered_records(chunks, start_frame, start_time):
+            yield make_frame_output(
+                decoder, ports_to_check, frame_no, record, analog_fields
+            )
+
+    def __iter__(self):
+        return self.frames()
+
+
+def print_frame(frame_no, record, decoder, ports_to_check, verbosity):
+    """
+    Print a frame record to stdout.
+
+    With verbosity 1, only print frame number and timing data; with verbosity
+    2 or higher, also print the pressed buttons of each port, and the values
+    of analog fields if the record holds them.
+    """
+    seconds, attoseconds, curspeed, digital, analog = record
+    print(f"Frame #{frame_no} {seconds} {attoseconds} {curspeed}")
+    if verbosity >= 2:
+        for port_idx in ports_to_check:
+            buttons = decoder.pressed_buttons(port_idx, digital[port_idx])
+            if buttons:
+                print(f"{decoder.port_names[port_idx]} {','.join(buttons)}")
+        if analog:
+            for port_idx, name, analog_idx in decoder.analog_fields_of(ports_to_check):
+                accum, previous = analog[2 * analog_idx : 2 * analog_idx + 2]
+                print(f"{decoder.port_names[port_idx]} {name} {accum} {previous}")
+
+
+class JsonFrameWriter:
+    """
+    Incrementally write frames as one JSON array.
+
+    Frame records (as yielded by FrameLayout.iter_records) are converted into
+    frame dicts (see make_frame_output) for the ports in `ports_to_check`
+    (default: all). The output is byte-identical to serializing the list of
+    all frame dicts at once using json.dumps, without ever holding that list
+    in memory. Frames are encoded in small batches to keep the per-call
+    overhead of the JSON encoder low. If `analog` is true, the records must
+    hold analog values, which are written as well.
+    """
+
+    BATCH_SIZE = 1024
+    binary = False
+
+    def __init__(self, f, decoder, ports_to_check=None, analog=False):
+        self._f = f
+        self._decoder = decoder
+        self._ports_to_check = (
+            range(decoder.ports_count) if ports_to_check is None else ports_to_check
+        )
+        self._analog_fields = (
+            decoder.analog_fields_of(self._ports_to_check) if analog else None
+        )
+        self._encode = json.JSONEncoder().encode
+        self._batch = []
+        self._separator = "["
+
+    def write(self, frame_no, record):
+        """Append one frame to the output."""
+        self._batch.append(
+            make_frame_output(
+                self._decoder,
+                self._ports_to_check,
+                frame_no,
+                record,
+                self._analog_fields,
+            )
+        )
+        if len(self._batch) >= self.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Encode and write all frames that are still pending."""
+        if self._batch:
+            self._f.write(self._separator)
+            self._f.write(self._encode(self._batch)[1:-1])
+            self._batch.clear()
+            self._separator = ", "
+        self._f.flush()
+
+    def close(self):
+        """Write all pending frames and terminate the document."""
+        self.flush()
+        if self._separator == "[":
+            self._f.write("[")
+        self._f.write("]")
+        self._f.flush()
+
+
+class NdjsonFrameWriter(JsonFrameWriter):
+    """
+    Incrementally write frames as newline-delimited JSON, one frame per line.
+
+    Every complete line is a valid JSON document, so the output can be
+    consumed (e.g. tailed) while it is still being written.
+    """
+
+    def flush(self):
+        if self._batch:
+            self._f.write("".join(self._encode(frame) + "\n" for frame in self._batch))
+            self._batch.clear()
+        self._f.flush()
+
+    def close(self):
+        self.flush()
+
+
+class EventsWriter(JsonFrameWriter):
+    """
+    Incrementally write input changes (button presses and releases) as JSON.
+
+    Instead of the full input state of every frame, only transitions are
+    written. The output is one JSON object: "ports" maps each checked port
+    index to the port's name and the names of its buttons (fields), "events"
+    is a chronologically sorted list of [frame, seconds, attoseconds, port,
+    button, pressed] arrays, where button is an index into the port's
+    button list and pressed is 1 for a press and 0 for a release. Buttons
+    that are pressed in the first frame are reported as pressed in that
+    frame.
+
+    If `analog` is true, each port additionally lists the names of its analog
+    fields under "analog", and changes of an analog field's accumulated value
+    are written as [frame, seconds, attoseconds, port, field, accum,
+    previous] arrays, where field is an index into that list. The first
+    frame reports every analog field. Such output is marked as version 2.
+    """
+
+    VERSION = 1
+    ANALOG_VERSION = 2
+
+    def __init__(self, f, decoder, ports_to_check=None, analog=False):
+        super().__init__(f, decoder, ports_to_check, analog)
+        self._prev_digital = {port_idx: None for port_idx in self._ports_to_check}
+        self._prev_active = {port_idx: 0 for port_idx in self._ports_to_check}
+        # Per analog field: its port, its index within the port's analog
+        # fields and its index within the record's analog values.
+        self._analog_events = []
+        ports = {
+            port_idx: {
+                "name": decoder.port_names[port_idx],
+                "buttons": decoder.field_names[port_idx],
+            }
+            for port_idx in self._ports_to_check
+        }
+        if analog:
+            for port_idx, name, analog_idx in self._analog_fields:
+                port_analog = ports[port_idx].setdefault("analog", [])
+                self._analog_events.append((port_idx, len(port_analog), analog_idx))
+                port_analog.append(name)
+            for port in ports.values():
+                port.setdefault("analog", [])
+        self._prev_accum = [None] * len(self._analog_events)
+        header = {
+            "version": self.ANALOG_VERSION if analog else self.VERSION,
+            "ports": ports,
+        }
+        self._f.write(self._encode(header)[:-1] + ', "events": ')
+
+    def write(self, frame_no, record):
+        seconds, attoseconds, _, digital, analog = record
+        prev_digital = self._prev_digital
+        for port_idx in self._ports_to_check:
+            value = digital[port_idx]
+            if value == prev_digital[port_idx]:
+                continue
+            prev_digital[port_idx] = value
+            active = self._decoder.active_fields(port_idx, value)
+            changed = active ^ self._prev_active[port_idx]
+            self._prev_active[port_idx] = active
+            while changed:
+                field_bit = changed & -changed
+                self._batch.append(
+                    (
+                        frame_no,
+                        seconds,
+                        attoseconds,
+                        port_idx,
+                        field_bit.bit_length() - 1,
+                        1 if active & field_bit else 0,
+                    )
+                )
+                changed ^= field_bit
+        prev_accum = self._prev_accum
+        for event_idx, (port_idx, field_idx, analog_idx) in enumerate(
+            self._analog_events
+        ):
+            accum = analog[2 * analog_idx]
+            if accum == prev_accum[event_idx]:
+                continue
+            prev_accum[event_idx] = accum
+            self._batch.append(
+                (
+                    frame_no,
+                    seconds,
+                    attoseconds,
+                    port_idx,
+                    field_idx,
+                    accum,
+                    analog[2 * analog_idx + 1],
+                )
+            )
+        if len(self._batch) >= self.BATCH_SIZE:
+            self.flush()
+
+    def close(self):
+        super().close()
+        self._f.write("}")
+        self._f.flush()
+
+
+class StatsWriter:
+    """
+    Incrementally compute statistics of the inputs, and write them as JSON.
+
+    No per-frame output is built: button presses and releases are detected
+    as in EventsWriter, and only aggregates are kept, so memory usage only
+    depends on the number of buttons. On close, one JSON object is written,
+    holding the number of frames, the emulated duration (from the first to
+    the last frame, in seconds), the mean, minimum and maximum current
+    speed, the number of presses and presses per second, stretches of at
+    least IDLE_MIN_SECONDS without any pressed button ("idle"), per-player
+    activity (presses and frames and seconds with any of the player's
+    buttons pressed, keyed by player number, "none" for buttons belonging to
+    no player), and, per checked port, per button in field order: presses,
+    frames and seconds held, and the longest and mean hold in seconds.
+    Holds lasting until the last frame count up to that frame.
+    """
+
+    binary = False
+    VERSION = 1
+    IDLE_MIN_SECONDS = 1
+
+    # pylint: disable-next=unused-argument
+    def __init__(self, f, decoder, ports_to_check=None, analog=False):
+        self._f = f
+        self._decoder = decoder
+        self._ports_to_check = (
+            range(decoder.ports_count) if ports_to_check is None else ports_to_check
+        )
+        self._frames = 0
+        # (frame number, attoseconds) of the first and last frame
+        self._first = None
+        self._last = None
+        self._last_record = None
+        self._curspeed_sum = 0
+        self._curspeed_min = None
+        self._curspeed_max = None
+        self._prev_curspeed = None
+        self._prev_record_digital = None
+
+        # Per checked port: the last bit field and set of active fields
+        self._prev_digital = [None] * len(self._ports_to_check)
+        self._prev_active = [0] * len(self._ports_to_check)
+        # Per checked port, per field: press count, frames and attoseconds
+        # held, longest hold in attoseconds, and the (frame number,
+        # attoseconds) of the press of an ongoing hold
+        self._buttons = [
+            [[0, 0, 0, 0, None] for _ in decoder.field_masks[port_idx]]
+            for port_idx in self._ports_to_check
+        ]
+
+        # Player index (None for no player) -> per checked port, the set of
+        # the player's fields
+        self._player_fields = {}
+        for port_pos, port_idx in enumerate(self._ports_to_check):
+            for field_idx, player in enumerate(decoder.field_players[port_idx]):
+                port_fields = self._player_fields.setdefault(
+                    player, [0] * len(self._ports_to_check)
+                )
+                port_fields[port_pos] |= 1 << field_idx
+        # Player index -> press count, active frames, active attoseconds and
+        # (frame number, attoseconds) since which the player is active
+        self._players = {player: [0, 0, 0, None] for player in self._player_fields}
+
+        # Idle stretches: count, frames, attoseconds, longest stretch as
+        # (attoseconds, frames, first frame number), and (frame number,
+        # attoseconds) since which no button is pressed
+        self._idle = [0, 0, 0, None]
+        self._idle_longest = (0, 0, None)
+        self._idle_since = None
+
+    def write(self, frame_no, record):
+        """Account for one frame."""
+        # Most frames do not change anything, so they take as little work as
+        # possible.
+        seconds, attoseconds, curspeed, digital, _ = record
+        self._frames += 1
+        self._curspeed_sum += curspeed
+        self._last_record = (frame_no, record)
+        if curspeed != self._prev_curspeed:
+            self._prev_curspeed = curspeed
+            if self._curspeed_min is None or curspeed < self._curspeed_min:
+                self._curspeed_min = curspeed
+            if self._curspeed_max is None or curspeed > self._curspeed_max:
+                self._curspeed_max = curspeed
+        if digital == self._prev_record_digital:
+            return
+        self._prev_record_digital = digital
+
+        now = (frame_no, seconds * 10**18 + attoseconds)
+        if self._first is None:
+            self._first = now
+            self._idle_since = now
+        prev_digital = self._prev_digital
+        changed_any = False
+        for port_pos, port_idx in enumerate(self._ports_to_check):
+            value = digital[port_idx]
+            if value == prev_digital[port_pos]:
+                continue
+            prev_digital[port_pos] = value
+            active = self._decoder.active_fields(port_idx, value)
+            changed = active ^ self._prev_active[port_pos]
+            if not changed:
+                continue
+            self._prev_active[port_pos] = active
+            changed_any = True
+            buttons = self._buttons[port_pos]
+            while changed:
+                field_bit = changed & -changed
+                button = buttons[field_bit.bit_length() - 1]
+                if active & field_bit:
+                    button[0] += 1
+                    button[4] = now
+                else:
+                    self._end_hold(button, now)
+                changed ^= field_bit
+        if changed_any:
+            self._update_activity(now)
+
+    def _end_hold(self, button, now, inclusive=False):
+        """Account for a hold of a button ending at `now`; `inclusive` if that frame counts."""
+        since_frame, since_time = button[4]
+        button[1] += now[0] - since_frame + inclusive
+        held = now[1] - since_time
+        button[2] += held
+        button[3] = max(button[3], held)
+        button[4] = None
+
+    def _update_activity(self, now, inclusive=False):
+        """
+        Update idle stretches and per-player activity after the set of
+        active fields has changed at `now`; with `inclusive`, end all
+        ongoing stretches including that frame.
+        """
+        for player, port_fields in self._player_fields.items():
+            state = self._players[player]
+            active = not inclusive and any(
+                active & fields
+                for active, fields in zip(self._prev_active, port_fields)
+            )
+            if active and state[3] is None:
+                state[3] = now
+            elif not active and state[3] is not None:
+                since_frame, since_time = state[3]
+                state[1] += now[0] - since_frame + inclusive
+                state[2] += now[1] - since_time
+                state[3] = None
+
+        idle = not inclusive and not any(self._prev_active)
+        if idle and self._idle_since is None:
+            self._idle_since = now
+        elif not idle and self._idle_since is not None:
+            since_frame, since_time = self._idle_since
+            frames = now[0] - since_frame + inclusive
+            duration = now[1] - since_time
+            if duration >= self.IDLE_MIN_SECONDS * 10**18:
+                self._idle[0] += 1
+                self._idle[1] += frames
+                self._idle[2] += duration
+                self._idle_longest = max(
+                    self._idle_longest, (duration, frames, since_frame)
+                )
+            self._idle_since = None
+
+    def flush(self):
+        """Statistics are only written on close."""
+
+    def close(self):
+        """End all ongoing holds and stretches, and write the statistics."""
+        if self._last_record is not None:
+            frame_no, record = self._last_record
+            self._last = (frame_no, record[0] * 10**18 + record[1])
+            for buttons in self._buttons:
+                for button in buttons:
+                    if button[4] is not None:
+                        self._end_hold(button, self._last, inclusive=True)
+            self._update_activity(self._last, inclusive=True)
+        for buttons, port_idx in zip(self._buttons, self._ports_to_check):
+            for button, player in zip(buttons, self._decoder.field_players[port_idx]):
+                self._players[player][0] += button[0]
+
+        duration = 0 if self._last is None else self._last[1] - self._first[1]
+        presses = sum(button[0] for buttons in self._buttons for button in buttons)
+        idle_longest_time, idle_longest_frames, idle_longest_first = self._idle_longest
+        stats = {
+            "version": self.VERSION,
+            "frames": self._frames,
+            "first_frame": None if self._first is None else self._first[0],
+            "last_frame": None if self._last is None else self._last[0],
+            "duration": _attoseconds_to_seconds(duration),
+            "curspeed": {
+                "mean": (
+                    round(self._curspeed_sum / self._frames, 2)
+                    if self._frames
+                    else None
+                ),
+                "min": self._curspeed_min,
+                "max": self._curspeed_max,
+            },
+            "presses": presses,
+            "presses_per_second": _per_second(presses, duration),
+            "idle": {
+                "min_seconds": self.IDLE_MIN_SECONDS,
+                "stretches": self._idle[0],
+                "frames": self._idle[1],
+                "seconds": _attoseconds_to_seconds(self._idle[2]),
+                "longest": {
+                    "first_frame": idle_longest_first,
+                    "frames": idle_longest_frames,
+                    "seconds": _attoseconds_to_seconds(idle_longest_time),
+                },
+            },
+            "players": {
+                "none"
+                if player is None
+                else str(player + 1): {
+                    "presses": state[0],
+                    "presses_per_second": _per_second(state[0], duration),
+                    "active_frames": state[1],
+                    "active_seconds": _attoseconds_to_seconds(state[2]),
+                }
+                for player, state in sorted(
+                    self._players.items(),
+                    key=lambda item: (item[0] is None, item[0] or 0),
+                )
+            },
+            "ports": {
+                port_idx: {
+                    "name": self._decoder.port_names[port_idx],
+                    "buttons": [
+                        {
+                            "name": name,
+                            "presses": button[0],
+                            "held_frames": button[1],
+                            "held_seconds": _attoseconds_to_seconds(button[2]),
+                            "longest_hold_seconds": _attoseconds_to_seconds(button[3]),
+                            "mean_hold_seconds": _attoseconds_to_seconds(
+                                button[2] // button[0] if button[0] else 0
+                            ),
+                        }
+                        for name, button in zip(
+                            self._decoder.field_names[port_idx], buttons
+                        )
+                    ],
+                }
+                for port_idx, buttons in zip(self._ports_to_check, self._buttons)
+            },
+        }
+        self._f.write(json.dumps(stats))
+        self._f.flush()
+
+
+def _attoseconds_to_seconds(attoseconds):
+    return round(attoseconds / 10**18, 6)
+
+
+def _per_second(count, attoseconds):
+    return round(count * 10**18 / attoseconds, 3) if attoseconds else None
+
+
+# Output format name -> frame writer class, output file name suffix
+OUTPUT_FORMATS = {
+    "json": (JsonFrameWriter, ".json"),
+    "ndjson": (NdjsonFrameWriter, ".ndjson"),
+    "events": (EventsWriter, ".events.json"),
+    "columnar": (inpcolumns.ColumnarWriter, ".inpcols"),
+    "stats": (StatsWriter, ".stats.json"),
+}
+OUTPUT_FORMAT_DEF = "json"
+CHUNKS_SUFFIX = ".chunks"
+
+
+class ChunkedWriter:
+    """
+    Incrementally write frames split into chunks, one file per chunk.
+
+    Chunks either hold `chunk_frames` frames each, counted from frame number
+    1 on, or span `chunk_time` (a (seconds, attoseconds) tuple) of emulated
+    time each, counted from time 0 on, so that the chunk holding a given
+    frame or point in time does not depend on where conversion started.
+    Windows of time without any frames do not get a chunk. Each chunk is a
+    complete document in the output format of `writer_cls` (one of the
+    writer classes of OUTPUT_FORMATS), written to the directory `path` as
+    the chunk index plus `suffix`, and holds the frame numbers of its
+    frames, the columnar format by its first frame number.
+
+    The directory also holds a manifest, manifest.json, which is rewritten
+    atomically whenever a chunk is complete, so that consumers can start
+    with the first chunks while conversion is still running. Besides the
+    chunking parameters and `meta`, it lists each complete chunk's index,
+    file name, first and last frame number, timestamp ([seconds,
+    attoseconds]) of the first and last frame, and size in bytes; "complete"
+    tells whether conversion has finished.
+    """
+
+    MANIFEST_NAME = "manifest.json"
+    VERSION = 1
+
+    def __init__(
+        self,
+        path,
+        writer_cls,
+        suffix,
+        decoder,
+        ports_to_check=None,
+        analog=False,
+        chunk_frames=None,
+        chunk_time=None,
+        meta=None,
+    ):
+        self.path = path
+        self.binary = writer_cls.binary
+        self._writer_cls = writer_cls
+        self._suffix = suffix
+        self._writer_args = (decoder, ports_to_check, analog)
+        self._chunk_frames = chunk_frames
+        self._chunk_period = (
+            None if chunk_time is None else chunk_time[0] * 10**18 + chunk_time[1]
+        )
+        self._file = None
+        self._writer = None
+        self._chunk = None
+        self._chunk_idx = None
+        self._manifest = {"version": self.VERSION}
+        self._manifest.update(meta or {})
+        self._manifest.update(
+            {
+                "chunk_frames": chunk_frames,
+                "chunk_time": None if chunk_time is None else list(chunk_time),
+                "complete": False,
+                "chunks": [],
+            }
+        )
+
+        os.makedirs(path, exist_ok=True)
+        self._write_manifest()
+
+    def _write_manifest(self):
+        manifest_path = os.path.join(self.path, self.MANIFEST_NAME)
+        tmp_path = f"{manifest_path}.tmp"
+        with open(tmp_path, "w", encoding="utf8") as f:
+            json.dump(self._manifest, f)
+        os.replace(tmp_path, manifest_path)
+
+    def _finish_chunk(self):
+        self._writer.close()
+        self._file.close()
+        self._chunk["size"] = os.path.getsize(
+            os.path.join(self.path, self._chunk["path"])
+        )
+        self._manifest["chunks"].append(self._chunk)
+        self._write_manifest()
+        self._file = None
+        self._writer = None
+
+    def write(self, frame_no, record):
+        """Append one frame to the output, completing the current chunk first if it is full."""
+        seconds, attoseconds = record[:2]
+        if self._chunk_frames is not None:
+            chunk_idx = (frame_no - 1) // self._chunk_frames
+        else:
+            chunk_idx = (seconds * 10**18 + attoseconds) // self._chunk_period
+        if chunk_idx != self._chunk_idx:
+            if self._writer is not None:
+                self._finish_chunk()
+            self._chunk_idx = chunk_idx
+            file_name = f"{chunk_idx:06d}{self._suffix}"
+            file_path = os.path.join(self.path, file_name)
+            # pylint: disable-next=consider-using-with
+            self._file = (
+                open(file_path, "wb")
+                if self.binary
+                else open(file_path, "w", encoding="utf8")
+            )
+            self._writer = self._writer_cls(self._file, *self._writer_args)
+            self._chunk = {
+                "index": chunk_idx,
+                "path": file_name,
+                "first_frame": frame_no,
+                "start": [seconds, attoseconds],
+            }
+        self._writer.write(frame_no, record)
+        self._chunk["last_frame"] = frame_no
+        self._chunk["end"] = [seconds, attoseconds]
+
+    def flush(self):
+        """Write all pending frames of the current chunk."""
+        if self._writer is not None:
+            self._writer.flush()
+
+    def close(self):
+        """Complete the last chunk and mark the manifest as complete."""
+        if self._writer is not None:
+            self._finish_chunk()
+        self._manifest["complete"] = True
+        self._write_manifest()
+
+    def discard(self):
+        """Remove the chunks and the manifest written so far."""
+        if self._file is not None:
+            self._file.close()
+            self._manifest["chunks"].append(self._chunk)
+        file_names = [chunk["path"] for chunk in self._manifest["chunks"]]
+        for file_name in file_names + [self.MANIFEST_NAME]:
+            try:
+                os.remove(os.path.join(self.path, file_name))
+            except OSError:
+                pass
+        try:
+            # Only if it is empty now
+            os.rmdir(self.path)
+        except OSError:
+            pass
 
 
 def print_ports(ports_ref):
@@ -524,32 +3289,175 @@ def print_ports(ports_ref):
         idx += 1
 
 
-def main(_args):
-    print("Parsing INP file ...")
-    parsed_inp_file = parse_header(_args.input_file_path)
-    if not parsed_inp_file:
-        print("Fatal: no INP file", file=sys.stderr)
-        return 1
+def print_layout_candidates(candidates):
+    """Print the payload layout candidates returned by detect_payload_layout."""
+    for candidate_idx, candidate in enumerate(candidates):
+        if candidate.remainder_ok is None:
+            remainder = "unchecked"
+        else:
+            remainder = "ok" if candidate.remainder_ok else "unexpected"
+        print(
+            f"{'Rejected' if candidate_idx else 'Detected'} payload layout: "
+            f"ShmupMAME compatibility {'on' if candidate.shmupmame_compat else 'off'}, "
+            f"{candidate.port_order} port order (timing score "
+            f"{candidate.timing_score:.2f}, remainder {remainder}, "
+            f"port score {candidate.ports_score:.2f})"
+        )
 
-    mame_version, sysname, header_bytes, compressed_payload_bytes = parsed_inp_file[:4]
 
-    print(f"Looking up input port reference data for game '{sysname}' ...")
+def write_profile_report(path, report):
+    """Write a StageProfiler report as JSON; return False on failure."""
     try:
-        ports_ref = load_ports_ref(_args.inputport_ref_path, sysname)
-    except UnsupportedGameError as e:
-        print(f"Fatal: game '{sysname}' is not supported: {e}", file=sys.stderr)
-        return 1
+        with open(path, "w", encoding="utf8") as f:
+            json.dump(report, f, indent=2)
+    except OSError as e:
+        print(f"Could not write profile report '{path}': {e}", file=sys.stderr)
+        return False
+    return True
 
-    if not ports_ref:
-        print(
-            f"Fatal: could not load input port reference file '{_args.inputport_ref_path}'",
-            file=sys.stderr,
+
+def finish_index_file(index_file, index_writer, complete, index_path):
+    """
+    Complete and close a sidecar index file that has been written to a
+    temporary path next to `index_path`, and move it into place.
+
+    If `complete` is false, the payload could not be read in full, and the
+    temporary file is removed instead. Failures are not fatal, as the index
+    is merely an optimization.
+    """
+    tmp_path = index_file.name
+    try:
+        with index_file:
+            if complete:
+                index_writer.close()
+        if complete:
+            os.replace(tmp_path, index_path)
+            return
+    except OSError as e:
+        print(f"Could not write index file: {e}")
+    try:
+        os.remove(tmp_path)
+    except OSError:
+        pass
+
+
+def finish_decompressed_file(decompressed_file, complete, mtime_ns):
+    """
+    Close the decompressed INP file written using -d/--write-decompressed,
+    and, if the payload has been decompressed in full (`complete`), mark it
+    as complete so that later runs use it instead of decompressing the INP
+    file again (see stamp_decompressed_file).
+    """
+    decompressed_file.close()
+    if complete:
+        try:
+            stamp_decompressed_file(decompressed_file.name, mtime_ns)
+        except OSError as e:
+            print(f"Could not mark decompressed file as complete: {e}")
+
+
+def finish_payload_cache_file(cache_file, complete, cache, key):
+    """
+    Complete and close a decompressed copy of the INP file that has been
+    written to the temporary path of the entry of `cache` with the given
+    key, and move it into place.
+
+    If the payload could not be decompressed in full (`complete` is false),
+    the temporary file is removed instead. Failures are not fatal, as the
+    cache is merely an optimization.
+    """
+    tmp_path = cache_file.name
+    try:
+        cache_file.close()
+        if complete:
+            cache.commit(tmp_path, "payload", key, DECOMPRESSED_SUFFIX)
+            return
+    except OSError as e:
+        print(f"Could not cache decompressed INP payload: {e}")
+    try:
+        os.remove(tmp_path)
+    except OSError:
+        pass
+
+
+def convert_inp_file(
+    input_file_path, _args, profiler=None, ports_ref_data=None, output_stream=None
+):
+    """
+    Convert one INP file according to the command line arguments `_args`.
+
+    If `profiler` is given, it is a StageProfiler that processing stages are
+    timed with. If `ports_ref_data` is given, it is what read_ports_ref
+    returned for the INP file's sysname, and the input port reference file is
+    not consulted. `output_stream` is the text stream output is written to if
+    the output path is '-' (default: sys.stdout).
+
+    Return 0 on success, else 1.
+    """
+    if output_stream is None:
+        output_stream = sys.stdout
+    cache = (
+        FileCache(_args.cache_dir, _args.cache_max_size << 20)
+        if _args.cache_dir
+        else None
+    )
+
+    print("Parsing INP file ...")
+    if _args.follow and not wait_for_file_size(
+        input_file_path, HEADER_BYTES, _args.follow_timeout
+    ):
+        print("Fatal: no INP file", file=sys.stderr)
+        return 1
+    try:
+        reader = InpReader(
+            input_file_path,
+            _args.inputport_ref_path,
+            _args.check_ports,
+            _args.shmupmame_compat,
+            ports_ref_data,
+            cache,
+            profiler,
+            analog=_args.analog,
         )
+    except (OSError, UnicodeDecodeError, InpHeaderError) as e:
+        print(f"Could not open and parse INP file at '{input_file_path}': {e}")
+        print("Fatal: no INP file", file=sys.stderr)
         return 1
 
-    ports_ref, mame_build, mame_config = ports_ref
+    print(
+        "INP file basetime: {} UTC".format(
+            datetime.utcfromtimestamp(reader.basetime).strftime("%Y-%m-%d %H:%M:%S")
+        )
+    )
+    print(f"INP file sysname: {reader.sysname}")
+    print(f"INP file appdesc: {reader.appdesc}")
+
+    payload_source = None if _args.follow else reader.open_decompressed()
+    if payload_source == "sidecar":
+        print(f"Using decompressed INP file '{reader.decompressed_path}'")
+    elif payload_source == "cache":
+        print("Using cached decompressed INP payload")
+
+    if _args.auto_detect:
+        print("Detecting payload layout ...")
+    elif ports_ref_data is None:
+        if reader.use_cached_ports():
+            print(f"Using cached input port reference data for game '{reader.sysname}'")
+        else:
+            print(
+                f"Looking up input port reference data for game '{reader.sysname}' ..."
+            )
     try:
-        ports_ref = sort_ports_ref(ports_ref, mame_version)
+        if _args.auto_detect:
+            print_layout_candidates(reader.detect_layout())
+            if reader.ports_source == "cache":
+                print(
+                    f"Used cached input port reference data for game '{reader.sysname}'"
+                )
+        reader.resolve_ports()
+    except UnsupportedGameError as e:
+        print(f"Fatal: game '{reader.sysname}' is not supported: {e}", file=sys.stderr)
+        return 1
     except UnsupportedMameVersionError as e:
         print(
             f"Fatal: given INP file has been recorded using MAME version {e}, "
@@ -557,78 +3465,457 @@ def main(_args):
             file=sys.stderr,
         )
         return 1
-    except KeyError:
+    except InputPortRefError as e:
         print(
-            f"Fatal: input port reference: missing legacy sort order for game '{sysname}'",
+            f"Fatal: could not load input port reference data from "
+            f"'{_args.inputport_ref_path}': {e}",
             file=sys.stderr,
         )
         return 1
+    except InpPayloadCorruptError as e:
+        print(f"Fatal: INP payload is corrupt: {e}", file=sys.stderr)
+        return 1
+    except OSError as e:
+        print(f"Fatal: could not read INP payload: {e}", file=sys.stderr)
+        return 1
 
-    print(f"Input port reference: {mame_build=} {mame_config=}")
+    print(
+        f"Input port reference: mame_build={reader.mame_build!r} "
+        f"mame_config={reader.mame_config!r}"
+    )
+    decoder = reader.decoder
 
     if _args.list_ports:
-        print_ports(ports_ref)
+        print_ports(reader.ports_ref)
         return 0
 
     if (
         _args.check_ports is not None
     ):  # None is default; checks all available ports. Will be a list otherwise.
-        ports_count = len(ports_ref)
         for check_port in _args.check_ports:
-            if not 0 <= check_port <= ports_count - 1:
+            if not 0 <= check_port <= decoder.ports_count - 1:
                 print(
-                    f"Requested port {check_port} is unavailable for game '{sysname}'",
+                    f"Requested port {check_port} is unavailable for game '{reader.sysname}'",
                     file=sys.stderr,
                 )
                 return 1
 
-    inp_data = io.BytesIO(zlib.decompress(compressed_payload_bytes))
-    inp_data.seek(SKIP_BYTES)
+    decompressed_file = None
+    if _args.write_decompressed and payload_source != "sidecar":
+        out_path = reader.decompressed_path
+        try:
+            mtime_ns = os.stat(input_file_path).st_mtime_ns
+            decompressed_file = open(out_path, "wb")
+            decompressed_file.write(reader.header.header_bytes)
+        except OSError as e:
+            print(f"Fatal: could not write file '{out_path}': {e}", file=sys.stderr)
+            return 1
 
-    if _args.write_decompressed:
-        out_path = f"{_args.input_file_path}.decompressed"
+    # Keep a decompressed copy in the cache for later runs, unless there
+    # will be one next to the INP file anyway.
+    cache_file = None
+    payload_cache_key = None
+    if (
+        cache is not None
+        and payload_source is None
+        and decompressed_file is None
+        and not _args.follow
+    ):
         try:
-            with open(out_path, "wb") as f:
-                f.write(header_bytes)
-                f.write(inp_data.read())
-                inp_data.seek(0)
+            payload_cache_key = reader.payload_cache_key()
+            # pylint: disable-next=consider-using-with
+            cache_file = open(
+                cache.tmp_path("payload", payload_cache_key, DECOMPRESSED_SUFFIX),
+                "wb",
+            )
+            cache_file.write(reader.header.header_bytes)
+        except OSError as e:
+            print(f"Could not cache decompressed INP payload: {e}")
+            cache_file = None
+    tee = decompressed_file or cache_file
+
+    index_file = None
+    index_writer = None
+    if _args.index:
+        if not _args.follow and reader.open_index():
+            print(f"Using index file '{reader.index_path}'")
+        else:
+            try:
+                # pylint: disable-next=consider-using-with
+                index_file = open(f"{reader.index_path}.tmp", "wb")
+            except OSError as e:
+                print(f"Could not write index file: {e}")
+
+    writer_cls, out_suffix = OUTPUT_FORMATS[_args.output_format]
+    ports_to_check = reader.ports_to_check
+    chunked = _args.chunk_frames is not None or _args.chunk_seconds is not None
+    out_path = _args.output_path or (
+        f"{input_file_path}{CHUNKS_SUFFIX if chunked else out_suffix}"
+    )
+    if chunked:
+        try:
+            writer = ChunkedWriter(
+                out_path,
+                writer_cls,
+                out_suffix,
+                decoder,
+                ports_to_check,
+                _args.analog,
+                _args.chunk_frames,
+                _args.chunk_seconds,
+                {
+                    "format": _args.output_format,
+                    "sysname": reader.sysname,
+                    "basetime": reader.basetime,
+                },
+            )
+        except OSError as e:
+            print(
+                f"Fatal: could not write to directory '{out_path}': {e}",
+                file=sys.stderr,
+            )
+            return 1
+        out_context = contextlib.nullcontext()
+    elif out_path == "-":
+        out_file = output_stream.buffer if writer_cls.binary else output_stream
+        out_context = contextlib.nullcontext()
+    else:
+        try:
+            out_file = (
+                open(out_path, "wb")
+                if writer_cls.binary
+                else open(out_path, "w", encoding="utf8")
+            )
         except OSError as e:
             print(f"Fatal: could not write file '{out_path}': {e}", file=sys.stderr)
             return 1
+        out_context = out_file
 
-    print("Iterating over INP file payload ...")
-    try:
-        output = iter_inp_payload(
-            ports_ref, inp_data, _args.check_ports, _args.shmupmame_compat
-        )
-    except InpPayloadSanityCheckError as e:
-        print(
-            f"INP payload sanity check failed: '{e}' - stopping processing. "
-            "If the INP file has been created using ShmupMAME, please try the "
-            "'-s' command line option. If this is not the case or '-s' does "
-            "not help, please read the limitations section in README.md "
-            "and/or report a bug.",
-            file=sys.stderr,
-        )
-        return 1
-    except UnexpectedInpPayloadEndError as e:
-        print(f"INP payload ended unexpectedly: {e}", file=sys.stderr)
-        # We still output what we have so far
+    print(
+        f"Iterating over INP file payload and writing {_args.output_format.upper()} ..."
+    )
+    if not chunked:
+        writer = writer_cls(out_file, decoder, ports_to_check, _args.analog)
 
-    print("Writing JSON...")
-    out_path = f"{_args.input_file_path}.json"
+    chunks = None
+    if (
+        tee is not None
+        or index_file is not None
+        or (reader.index is None and reader.payload_map is None)
+    ):
+        on_wait = None
+        if _args.follow and not writer_cls.binary:
+            # Make frames available as soon as all data recorded so far has
+            # been processed. The columnar format only allows an incomplete
+            # block at the end, so it is written one block at a time.
+            on_wait = writer.flush
+        chunks = reader.payload_chunks(tee, _args.follow, _args.follow_timeout, on_wait)
+        if index_file is not None:
+            index_writer = reader.index_writer(index_file)
+            chunks = index_writer.wrap(chunks)
+
+    write_frame = writer.write
+    close_writer = writer.close
+    if profiler is not None:
+        write_frame = profiler.timed_call("write_output", write_frame)
+        close_writer = profiler.timed_call("write_output", close_writer)
+    records = reader.numbered_records(chunks, _args.start_frame or 1, _args.start_time)
+    if _args.frame_count is not None:
+        records = itertools.islice(records, _args.frame_count)
+    interrupted = False
+    corrupt = False
     try:
-        with open(out_path, "w", encoding="utf8") as f:
-            f.write(json.dumps(output))
-    except OSError as e:
-        print(f"Fatal: could not write file '{out_path}': {e}", file=sys.stderr)
+        with out_context:
+            try:
+                for frame_no, record in records:
+                    if _args.verbose:
+                        print_frame(
+                            frame_no, record, decoder, ports_to_check, _args.verbose
+                        )
+                    write_frame(frame_no, record)
+                if _args.verbose:
+                    print("END OF REPLAY")
+            except UnexpectedInpPayloadEndError as e:
+                print(f"INP payload ended unexpectedly: {e}", file=sys.stderr)
+                # We still output what we have so far
+            except KeyboardInterrupt:
+                interrupted = True
+                if not _args.follow:
+                    raise
+                print("Interrupted, stopped following the INP file")
+            close_writer()
+    except KeyboardInterrupt:
+        interrupted = True
+        raise
+    except (InpPayloadSanityCheckError, InpPayloadCorruptError) as e:
+        if isinstance(e, InpPayloadCorruptError):
+            corrupt = True
+            print(f"Fatal: INP payload is corrupt: {e}", file=sys.stderr)
+        else:
+            print(
+                f"INP payload sanity check failed: '{e}' - stopping processing. "
+                "If the INP file has been created using ShmupMAME, please try the "
+                "'-s' command line option. If this is not the case or '-s' does "
+                "not help, please read the limitations section in README.md "
+                "and/or report a bug.",
+                file=sys.stderr,
+            )
+        # Do not leave garbled output behind.
+        if chunked:
+            writer.discard()
+        elif out_path != "-":
+            try:
+                os.remove(out_path)
+            except OSError:
+                pass
+        return 1
+    except (OSError, inpindex.IndexFormatError) as e:
+        print(f"Fatal: could not process INP payload: {e}", file=sys.stderr)
         return 1
+    finally:
+        if tee is not None or index_file is not None:
+            # Decoding may have stopped early; the decompressed file and the
+            # index are written in full regardless, unless the user asked to
+            # stop or the payload is corrupt, in which case they are left
+            # incomplete.
+            drained = not interrupted and not corrupt
+            try:
+                if drained:
+                    for _ in chunks:
+                        pass
+            except UnexpectedInpPayloadEndError:
+                pass
+            except (OSError, InpPayloadCorruptError):
+                drained = False
+            if decompressed_file is not None:
+                finish_decompressed_file(
+                    decompressed_file, drained and reader.payload_complete, mtime_ns
+                )
+            if cache_file is not None:
+                finish_payload_cache_file(
+                    cache_file,
+                    drained and reader.payload_complete,
+                    cache,
+                    payload_cache_key,
+                )
+            if index_file is not None:
+                finish_index_file(index_file, index_writer, drained, reader.index_path)
 
     print("DONE")
 
     return 0
 
 
+def collect_input_paths(input_paths, file_list_path=None):
+    """
+    Expand the INP file paths given on the command line.
+
+    Directories are searched recursively for files with an .inp extension. If
+    `file_list_path` is given, paths are additionally read from that file
+    (or stdin, if it is '-'), one per line. Return a list of paths without
+    duplicates, or None if the file list could not be read.
+    """
+    input_paths = list(input_paths or [])
+    if file_list_path:
+        try:
+            with (
+                open(file_list_path, encoding="utf8")
+                if file_list_path != "-"
+                else contextlib.nullcontext(sys.stdin)
+            ) as f:
+                input_paths.extend(line.strip() for line in f if line.strip())
+        except OSError as e:
+            print(
+                f"Fatal: could not read file list '{file_list_path}': {e}",
+                file=sys.stderr,
+            )
+            return None
+
+    paths = []
+    for path in input_paths:
+        if os.path.isdir(path):
+            for dir_path, dir_names, file_names in os.walk(path):
+                dir_names.sort()
+                paths.extend(
+                    os.path.join(dir_path, file_name)
+                    for file_name in sorted(file_names)
+                    if file_name.lower().endswith(".inp")
+                )
+        else:
+            paths.append(path)
+
+    return list(dict.fromkeys(paths))
+
+
+# Input port reference data per (sysname, MAME version) key (see convert_batch),
+# shared with batch worker processes via the pool initializer.
+_batch_ports_refs = {}
+
+
+def _init_batch_worker(ports_refs):
+    _batch_ports_refs.update(ports_refs)
+
+
+def _convert_batch_file(input_file_path, ports_ref_key, _args):
+    """
+    Convert one INP file of a batch within a worker process.
+
+    Return the input file path, the exit code, the last error message (if
+    any) and the profile report (if profiling is enabled).
+    """
+    profiler = StageProfiler() if _args.profile_report else None
+    errors = io.StringIO()
+    try:
+        with open(os.devnull, "w", encoding="utf8") as devnull:
+            with contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(
+                errors
+            ):
+                rc = convert_inp_file(
+                    input_file_path, _args, profiler, _batch_ports_refs[ports_ref_key]
+                )
+    except Exception:  # pylint: disable=broad-except
+        # A bad file must not take down the whole batch.
+        rc = 1
+        errors.write(traceback.format_exc())
+
+    lines = [line for line in errors.getvalue().splitlines() if line.strip()]
+    message = lines[-1] if lines else None
+    report = profiler.finish() if profiler is not None and rc == 0 else None
+    return input_file_path, rc, message, report
+
+
+def convert_batch(input_paths, _args):
+    """
+    Convert many INP files using a pool of worker processes.
+
+    Headers are read and input port reference data is loaded up front, once
+    per sysname (and MAME version, if taken from a reference store), and then
+    shared with the workers. Definitions shared by several games (such as
+    clones) are only parsed and passed on once. Every file succeeds or
+    fails on its own and is reported as soon as it is done; a bad file does
+    not abort the batch.
+
+    Return 0 if all files have been converted successfully, else 1.
+    """
+    print(f"Reading headers of {len(input_paths)} INP files ...")
+    failed = 0
+    tasks = []
+    ports_refs = {}
+    def_cache = {}
+    ports_ref_store = is_ports_ref_store(_args.inputport_ref_path)
+    for input_file_path in input_paths:
+        try:
+            with open(input_file_path, "rb") as f:
+                header = read_header(f)
+        except (OSError, UnicodeDecodeError, InpHeaderError) as e:
+            print(f"FAILED {input_file_path}: no INP file: {e}", file=sys.stderr)
+            failed += 1
+            continue
+
+        sysname = header.sysname
+        mame_version = header.bare_build_version if ports_ref_store else None
+        ports_ref_key = (sysname, mame_version)
+        if ports_ref_key not in ports_refs:
+            print(f"Looking up input port reference data for game '{sysname}' ...")
+            try:
+                ports_refs[ports_ref_key] = read_ports_ref(
+                    _args.inputport_ref_path, sysname, mame_version, def_cache
+                )
+            except UnsupportedGameError:
+                ports_refs[ports_ref_key] = f"game '{sysname}' is not supported"
+            except InputPortRefError as e:
+                ports_refs[ports_ref_key] = (
+                    "could not load input port reference data from "
+                    f"'{_args.inputport_ref_path}': {e}"
+                )
+        ports_ref_data = ports_refs[ports_ref_key]
+        if isinstance(ports_ref_data, str):
+            print(f"FAILED {input_file_path}: {ports_ref_data}", file=sys.stderr)
+            failed += 1
+        else:
+            tasks.append((input_file_path, ports_ref_key))
+
+    ports_refs = {
+        ports_ref_key: data
+        for ports_ref_key, data in ports_refs.items()
+        if not isinstance(data, str)
+    }
+    reports = {}
+    print(f"Converting {len(tasks)} INP files ...")
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=_args.jobs,
+        initializer=_init_batch_worker,
+        initargs=(ports_refs,),
+    ) as executor:
+        futures = [
+            executor.submit(_convert_batch_file, input_file_path, ports_ref_key, _args)
+            for input_file_path, ports_ref_key in tasks
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                input_file_path, rc, message, report = future.result()
+            except concurrent.futures.process.BrokenProcessPool as e:
+                print(f"Fatal: worker process pool broke down: {e}", file=sys.stderr)
+                return 1
+            if rc == 0:
+                print(f"OK {input_file_path}" + (f" ({message})" if message else ""))
+                if report is not None:
+                    reports[input_file_path] = report
+            else:
+                print(f"FAILED {input_file_path}: {message}", file=sys.stderr)
+                failed += 1
+
+    print(f"Converted {len(input_paths) - failed} of {len(input_paths)} INP files")
+    if _args.profile_report and not write_profile_report(
+        _args.profile_report, {"files": reports}
+    ):
+        return 1
+
+    return 1 if failed else 0
+
+
+def main(_args, profiler=None):
+    input_paths = collect_input_paths(_args.input_file_path, _args.file_list)
+    if input_paths is None:
+        return 1
+    if not input_paths:
+        print("Fatal: no INP files given", file=sys.stderr)
+        return 1
+
+    if len(input_paths) > 1:
+        for option, given in (
+            ("-l/--list-ports", _args.list_ports),
+            ("-o/--output-path", _args.output_path),
+            ("--follow", _args.follow),
+        ):
+            if given:
+                print(f"Fatal: {option} requires a single INP file", file=sys.stderr)
+                return 1
+        return convert_batch(input_paths, _args)
+
+    if profiler is None and _args.profile_report:
+        profiler = StageProfiler()
+
+    # With output to stdout, keep progress information out of the way.
+    output_stream = sys.stdout
+    with (
+        contextlib.redirect_stdout(sys.stderr)
+        if _args.output_path == "-"
+        else contextlib.nullcontext()
+    ):
+        rc = convert_inp_file(
+            input_paths[0], _args, profiler, output_stream=output_stream
+        )
+    if rc == 0 and profiler is not None:
+        report = profiler.finish()
+        if _args.profile_report and not write_profile_report(
+            _args.profile_report, report
+        ):
+            return 1
+
+    return rc
+
+
 if __name__ == "__main__":
     args = parse_args()
     sys.exit(main(args))
@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Read (and write) the compact binary columnar output format of inp2json.py.
+
+A columnar file starts with the magic bytes, the format version and a JSON
+header holding the number of the first frame, describing the columns and
+mapping the bits of each port's bit field to button names, and, if analog
+inputs have been decoded, listing the analog fields along with the names of
+their columns. Frames follow in blocks of a fixed number of frames; within a
+block, the values of each column are stored contiguously as fixed-width
+little-endian integers. Since every frame takes the same number of bytes, any
+frame can be located without an index, and the frame count follows from the
+file size.
+
+When run as a script, convert a columnar file back to the JSON format of
+inp2json.py and write it to stdout.
+"""
+
+import argparse
+import array
+import itertools
+import json
+import mmap
+import struct
+import sys
+
+MAGIC = b"INPCOLS\0"
+VERSION = 1
+# Files holding analog columns are marked as such, as they cannot be read by
+# readers supporting VERSION only.
+ANALOG_VERSION = 2
+PREAMBLE_FMT = "<8sHI"  # magic, version, header length
+PREAMBLE_SIZE = struct.calcsize(PREAMBLE_FMT)
+BLOCK_FRAMES = 4096
+
+# Column name -> array typecode, for the columns every file has. One further
+# "I" column per port, named "p<port index>", follows these, and, if analog
+# inputs have been decoded, two "i" columns per analog field, named
+# "a<analog field position>" (accumulated value) and "ap<analog field
+# position>" (previous value).
+TIMING_COLUMNS = (("s", "I"), ("as", "Q"), ("cs", "I"))
+TYPECODE_SIZES = {"I": 4, "Q": 8, "i": 4}
+
+for _typecode, _size in TYPECODE_SIZES.items():
+    assert array.array(_typecode).itemsize == _size
+
+
+class ColumnarFormatError(Exception):
+    """This exception is raised when a file is not a valid columnar file of a supported version."""
+
+
+def _to_little_endian(values):
+    if sys.byteorder != "little":
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return values
+
+
+class ColumnarWriter:
+    """
+    Incrementally write frames in the columnar format.
+
+    Implements the frame writer interface of inp2json.py: frame records (as
+    yielded by inp2json.FrameLayout.iter_records) are passed to write, the
+    raw digital bit field of each port in `ports_to_check` (default: all) is
+    stored. If `analog` is true, the records must hold analog values, and the
+    accumulated and previous value of each analog field of these ports are
+    stored as well. Frames are written to the binary file `f` one block at a
+    time; they must be consecutive, the number of the first one being stored
+    in the header, which is therefore only written along with the first
+    frame (or on close, if there is none).
+    """
+
+    binary = True
+
+    def __init__(self, f, decoder, ports_to_check=None, analog=False):
+        self._f = f
+        self._ports_to_check = (
+            range(decoder.ports_count) if ports_to_check is None else ports_to_check
+        )
+        analog_fields = decoder.analog_fields_of(self._ports_to_check) if analog else []
+        # Indexes of the analog values to store within a record's analog values
+        self._analog_indexes = []
+        for _, _, analog_idx in analog_fields:
+            self._analog_indexes.extend((2 * analog_idx, 2 * analog_idx + 1))
+        self._columns = [array.array(typecode) for _, typecode in TIMING_COLUMNS]
+        self._columns.extend(array.array("I") for _ in self._ports_to_check)
+        self._columns.extend(array.array("i") for _ in self._analog_indexes)
+        self._digital_end = len(TIMING_COLUMNS) + len(self._ports_to_check)
+        self._frames = 0
+        self._analog = analog
+
+        self._header = {
+            "block_frames": BLOCK_FRAMES,
+            "columns": [
+                {"name": name, "type": typecode} for name, typecode in TIMING_COLUMNS
+            ]
+            + [
+                {"name": f"p{port_idx}", "type": "I"}
+                for port_idx in self._ports_to_check
+            ]
+            + [
+                {"name": f"{prefix}{pos}", "type": "i"}
+                for pos in range(len(analog_fields))
+                for prefix in ("a", "ap")
+            ],
+            "ports": [
+                {
+                    "index": port_idx,
+                    "name": decoder.port_names[port_idx],
+                    "buttons": [
+                        [mask, name]
+                        for mask, name in zip(
+                            decoder.field_masks[port_idx], decoder.field_names[port_idx]
+                        )
+                    ],
+                }
+                for port_idx in self._ports_to_check
+            ],
+        }
+        if analog:
+            self._header["analog"] = [
+                {
+                    "port": port_idx,
+                    "name": name,
+                    "accum": f"a{pos}",
+                    "previous": f"ap{pos}",
+                }
+                for pos, (port_idx, name, _) in enumerate(analog_fields)
+            ]
+
+    def _write_header(self, first_frame):
+        self._header["first_frame"] = first_frame
+        header_bytes = json.dumps(self._header).encode()
+        version = ANALOG_VERSION if self._analog else VERSION
+        self._f.write(struct.pack(PREAMBLE_FMT, MAGIC, version, len(header_bytes)))
+        self._f.write(header_bytes)
+        self._header = None
+
+    def write(self, frame_no, record):
+        """Append one frame to the output."""
+        if self._header is not None:
+            self._write_header(frame_no)
+        seconds, attoseconds, curspeed, digital, analog = record
+        columns = self._columns
+        columns[0].append(seconds)
+        columns[1].append(attoseconds)
+        columns[2].append(curspeed)
+        for column, port_idx in zip(
+            columns[3 : self._digital_end], self._ports_to_check
+        ):
+            column.append(digital[port_idx])
+        for column, analog_idx in zip(
+            columns[self._digital_end :], self._analog_indexes
+        ):
+            column.append(analog[analog_idx])
+        self._frames += 1
+        if self._frames == BLOCK_FRAMES:
+            self.flush()
+
+    def flush(self):
+        """Write the pending (possibly incomplete, hence last) block."""
+        if self._frames:
+            for column in self._columns:
+                self._f.write(_to_little_endian(column).tobytes())
+                del column[:]
+            self._frames = 0
+        self._f.flush()
+
+    def close(self):
+        """Write all pending frames."""
+        if self._header is not None:
+            self._write_header(1)
+        self.flush()
+
+
+class ColumnarReader:
+    """
+    Lazily read frames from a columnar file.
+
+    The file is memory-mapped; frames or column ranges are only decoded when
+    requested. `header` holds the parsed JSON header, `ports` its port
+    descriptions, `analog` its analog field descriptions (None if the file
+    holds no analog values), `first_frame` the frame number of its first
+    frame, and len() returns the number of frames.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, "rb")  # pylint: disable=consider-using-with
+        try:
+            preamble = self._file.read(PREAMBLE_SIZE)
+            if len(preamble) < PREAMBLE_SIZE:
+                raise ColumnarFormatError("Not a columnar file")
+            magic, version, header_len = struct.unpack(PREAMBLE_FMT, preamble)
+            if magic != MAGIC:
+                raise ColumnarFormatError("Not a columnar file")
+            if version not in (VERSION, ANALOG_VERSION):
+                raise ColumnarFormatError(
+                    f"Unsupported columnar format version {version}"
+                )
+            self.header = json.loads(self._file.read(header_len))
+            self._data_offset = PREAMBLE_SIZE + header_len
+            self._read_header()
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError, ColumnarFormatError):
+            self._file.close()
+            raise
+
+        self._frames_count = (len(self._map) - self._data_offset) // self.frame_size
+        self._pressed_cache = [{} for _ in self.ports]
+
+    def _read_header(self):
+        """Take the attributes describing the file from `header`, validating it."""
+        try:
+            self.ports = self.header["ports"]
+            self.analog = self.header.get("analog")
+            self.block_frames = self.header["block_frames"]
+            self.first_frame = self.header["first_frame"]
+            self._columns = [
+                (column["name"], column["type"], TYPECODE_SIZES[column["type"]])
+                for column in self.header["columns"]
+            ]
+        except KeyError as e:
+            raise ColumnarFormatError(
+                f"Columnar header lacks the key or column type {e}"
+            ) from e
+        except (AttributeError, TypeError) as e:
+            raise ColumnarFormatError(f"Invalid columnar header: {e}") from e
+        if not (
+            isinstance(self.ports, list)
+            and isinstance(self.block_frames, int)
+            and self.block_frames > 0
+            and isinstance(self.first_frame, int)
+        ):
+            raise ColumnarFormatError("Invalid columnar header")
+        if not self._columns:
+            raise ColumnarFormatError("Columnar header lists no columns")
+        self._column_idx = {name: idx for idx, (name, _, _) in enumerate(self._columns)}
+        self.frame_size = sum(size for _, _, size in self._columns)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._frames_count
+
+    def close(self):
+        """Unmap and close the file."""
+        self._map.close()
+        self._file.close()
+
+    def _column_offset(self, frame_idx, column_idx):
+        """Return the file offset of one value of one column."""
+        block_idx, idx_in_block = divmod(frame_idx, self.block_frames)
+        block_start = block_idx * self.block_frames
+        block_len = min(self.block_frames, self._frames_count - block_start)
+        offset = self._data_offset + block_start * self.frame_size
+        for _, _, size in self._columns[:column_idx]:
+            offset += size * block_len
+        return offset + idx_in_block * self._columns[column_idx][2]
+
+    def column(self, name, start=0, stop=None):
+        """Return the values of one column for the frame index range [start, stop) as an array."""
+        start, stop, _ = slice(start, stop).indices(self._frames_count)
+        column_idx = self._column_idx[name]
+        _, typecode, size = self._columns[column_idx]
+        values = array.array(typecode)
+        while start < stop:
+            block_end = min(stop, (start // self.block_frames + 1) * self.block_frames)
+            offset = self._column_offset(start, column_idx)
+            values.frombytes(self._map[offset : offset + (block_end - start) * size])
+            start = block_end
+        return _to_little_endian(values)
+
+    def _zip_columns(self, names, start, stop):
+        """
+        Return an iterator of tuples holding the values of the given columns
+        per frame of the frame index range [start, stop) within one block.
+        """
+        if not names:
+            return itertools.repeat((), stop - start)
+        return zip(*(self.column(name, start, stop).tolist() for name in names))
+
+    def pressed_buttons(self, port_pos, digital):
+        """
+        Return the list of pressed buttons of the port at position `port_pos` of `ports`.
+
+        Lists are cached and shared, so they must not be modified by the caller.
+        """
+        cache = self._pressed_cache[port_pos]
+        pressed = cache.get(digital)
+        if pressed is None:
+            pressed = [
+                name
+                for mask, name in self.ports[port_pos]["buttons"]
+                if digital & mask == mask
+            ]
+            cache[digital] = pressed
+        return pressed
+
+    def frames(self, start=0, stop=None):
+        """
+        Yield the frames in the frame index range [start, stop) as dicts.
+
+        The dicts are the same as the ones in the JSON output of inp2json.py;
+        note that frame numbers ("f") start at `first_frame` whereas frame
+        indexes start at 0. Frames are decoded one block at a time.
+        """
+        start, stop, _ = slice(start, stop).indices(self._frames_count)
+        port_indexes = [port["index"] for port in self.ports]
+        digital_names = [f"p{port_idx}" for port_idx in port_indexes]
+        analog_fields = self.analog or []
+        analog_names = [
+            name
+            for field in analog_fields
+            for name in (field["accum"], field["previous"])
+        ]
+        while start < stop:
+            block_end = min(stop, (start // self.block_frames + 1) * self.block_frames)
+            timing = self._zip_columns(
+                [name for name, _ in TIMING_COLUMNS], start, block_end
+            )
+            digital = self._zip_columns(digital_names, start, block_end)
+            analog = self._zip_columns(analog_names, start, block_end)
+            for idx, (seconds, attoseconds, curspeed), values, analog_values in zip(
+                range(start + self.first_frame, block_end + self.first_frame),
+                timing,
+                digital,
+                analog,
+            ):
+                frame = {
+                    "f": idx,
+                    "s": seconds,
+                    "as": attoseconds,
+                    "cs": curspeed,
+                    "p": {
+                        port_idx: self.pressed_buttons(port_pos, value)
+                        for port_pos, (port_idx, value) in enumerate(
+                            zip(port_indexes, values)
+                        )
+                    },
+                }
+                if self.analog is not None:
+                    frame_analog = {}
+                    for pos, field in enumerate(analog_fields):
+                        frame_analog.setdefault(field["port"], {})[
+                            field["name"]
+                        ] = list(analog_values[2 * pos : 2 * pos + 2])
+                    frame["a"] = frame_analog
+                yield frame
+            start = block_end
+
+    def frame(self, idx):
+        """Return the frame at frame index `idx` as a dict (see frames)."""
+        if not 0 <= idx < self._frames_count:
+            raise IndexError("frame index out of range")
+        return next(self.frames(idx, idx + 1))
+
+    def write_json(self, f, start=0, stop=None):
+        """Write frames as a JSON array to the text file `f`, as inp2json.py would."""
+        separator = "["
+        for frame in self.frames(start, stop):
+            f.write(separator)
+            f.write(json.dumps(frame))
+            separator = ", "
+        if separator == "[":
+            f.write("[")
+        f.write("]")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=sys.modules[__name__].__doc__)
+    parser.add_argument("path", type=str, help="Path to a columnar file.")
+    parser.add_argument(
+        "--start", type=int, default=0, help="Index of the first frame. (default: 0)"
+    )
+    parser.add_argument(
+        "--stop",
+        type=int,
+        help="Index of the frame to stop before. (default: convert up to the end)",
+    )
+    return parser.parse_args()
+
+
+def main(_args):
+    try:
+        with ColumnarReader(_args.path) as reader:
+            reader.write_json(sys.stdout, _args.start, _args.stop)
+    except (OSError, ValueError, ColumnarFormatError) as e:
+        print(
+            f"Fatal: could not read columnar file '{_args.path}': {e}", file=sys.stderr
+        )
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    sys.exit(main(args))
@@ -0,0 +1,524 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Find the frames at which two MAME input files (INP) of the same game diverge.
+
+Two recordings of the same game, such as a verification run and the reference
+run it is checked against, are compared block by block: their uncompressed
+payloads are split into blocks of whole frame records, and only blocks whose
+contents differ are decoded, so that long identical stretches take next to no
+time. If both INP files have an up-to-date sidecar index (see inp2json.py
+--index) built using the same block size, the block hashes of the indexes are
+compared, and identical blocks are not even decompressed. Decompressed copies
+(see inp2json.py -d/--write-decompressed and --cache-dir) are read straight
+from memory-mapped files; otherwise, both payloads are decompressed side by
+side.
+
+Frames are compared by timestamp and by the digital inputs of the checked
+ports (and their analog inputs, with --analog). The current speed depends on
+the machine a recording has been made on, so it is ignored unless
+--compare-speed is given. A divergence is a run of consecutive frames that
+differ; for each one, its first and last frame, the timestamp of its first
+frame and, for each differing port, the buttons pressed in either recording
+are reported. Frames beyond the end of the shorter recording do not count as
+a divergence, but a difference in frame count is reported.
+
+The exit status is 0 if the recordings do not differ, 1 if they do, and 2 on
+failure, as with diff(1).
+"""
+
+import argparse
+import collections
+import itertools
+import json
+import os
+import sys
+
+import inp2json
+import inpindex
+
+MAX_DIVERGENCES_DEF = 1
+# The current speed follows the timestamp in every frame record.
+SPEED_OFFSET = inpindex.TIMESTAMP_STRUCT.size
+SPEED_SIZE = inp2json.FRAME_STRUCT_SIZE - SPEED_OFFSET
+
+# Frame numbers (starting at 1) of the first and last frame of a run of
+# differing frames, and the records of the first frame in either recording.
+Divergence = collections.namedtuple(
+    "Divergence", ["first_frame", "last_frame", "record_a", "record_b"]
+)
+
+
+class ReplayMismatchError(Exception):
+    """This exception is raised when two INP files cannot be compared frame by frame."""
+
+
+def mask_speed(block, record_size):
+    """Return a copy of a block of whole frame records with the current speed zeroed."""
+    masked = bytearray(block)
+    for offset in range(SPEED_OFFSET, SPEED_OFFSET + SPEED_SIZE):
+        masked[offset::record_size] = bytes(
+            len(range(offset, len(masked), record_size))
+        )
+    return masked
+
+
+class ReplayDiff:
+    """
+    Compare the payloads of two INP files of the same game.
+
+    `reader_a` and `reader_b` are InpReaders, whose input port reference data
+    is resolved on creation. Iterating yields a Divergence per run of
+    consecutive differing frames, in frame order; a run is only yielded once
+    its end is known. Frames are compared as described in the module
+    documentation, taking the ports checked by `reader_a` into account;
+    analog inputs are compared if the readers decode them. If
+    `compare_speed` is true, the current speed is compared as well.
+
+    Once iteration has come to an end, `frames` holds the number of whole
+    frame records of either payload, and `truncated` tells for each one
+    whether its compressed payload ended prematurely.
+
+    Raise ReplayMismatchError if the INP files are not recordings of the
+    same game or their frame layouts differ.
+    """
+
+    def __init__(self, reader_a, reader_b, compare_speed=False):
+        if reader_a.sysname != reader_b.sysname:
+            raise ReplayMismatchError(
+                f"recordings of different games: '{reader_a.sysname}' and "
+                f"'{reader_b.sysname}'"
+            )
+        self.layout = reader_a.layout
+        if (
+            reader_a.ports != reader_b.ports
+            or self.layout.record_size != reader_b.layout.record_size
+        ):
+            raise ReplayMismatchError("input ports or frame layouts differ")
+
+        self.readers = (reader_a, reader_b)
+        self.compare_speed = compare_speed
+        self.indexed = False
+        self.frames = None
+        self.truncated = [False, False]
+        self._payload_sizes = [0, 0]
+
+        ports_to_check = list(reader_a.ports_to_check)
+        self._get_digital = inp2json.tuple_getter(ports_to_check)
+        self._get_analog = inp2json.tuple_getter(
+            [
+                value_idx
+                for _, _, analog_idx in reader_a.decoder.analog_fields_of(
+                    ports_to_check
+                )
+                for value_idx in (2 * analog_idx, 2 * analog_idx + 1)
+            ]
+            if self.layout.analog
+            else []
+        )
+
+    def use_indexes(self):
+        """
+        Try to compare the block hashes of the sidecar indexes of the INP files.
+
+        Return True if both have an up-to-date index (see
+        InpReader.open_index) built using the same block size, else False.
+        """
+        if not all(reader.open_index() for reader in self.readers):
+            return False
+        block_frames = {reader.index.meta["block_frames"] for reader in self.readers}
+        self.indexed = len(block_frames) == 1
+        return self.indexed
+
+    def _record_key(self, record):
+        """Return the parts of a frame record that are compared."""
+        seconds, attoseconds, curspeed, digital, analog = record
+        return (
+            seconds,
+            attoseconds,
+            curspeed if self.compare_speed else None,
+            self._get_digital(digital),
+            self._get_analog(analog),
+        )
+
+    def _payload_blocks(self, reader_idx, block_size):
+        """
+        Yield the uncompressed payload of one INP file in blocks of `block_size` bytes.
+
+        Raise InpPayloadCorruptError, naming the INP file, if the payload is corrupt.
+        """
+        buf = bytearray()
+        try:
+            for chunk in self.readers[reader_idx].payload_chunks():
+                self._payload_sizes[reader_idx] += len(chunk)
+                buf += chunk
+                while len(buf) >= block_size:
+                    yield bytes(buf[:block_size])
+                    del buf[:block_size]
+        except inp2json.UnexpectedInpPayloadEndError:
+            self.truncated[reader_idx] = True
+        except inp2json.InpPayloadCorruptError as e:
+            raise inp2json.InpPayloadCorruptError(
+                f"'{self.readers[reader_idx].path}': {e}"
+            ) from e
+        if buf:
+            yield bytes(buf)
+
+    def _block_pairs(self):
+        """
+        Yield (index of the first frame, block A, block B) tuples.
+
+        Blocks hold the same frames of either payload, and are None if block
+        hashes tell that they are identical. Only the frames both payloads
+        have are covered; `frames` is set once all have been yielded.
+        """
+        if self.indexed:
+            index_a, index_b = (reader.index for reader in self.readers)
+            for block_idx, (hash_a, hash_b) in enumerate(
+                zip(index_a.block_hashes, index_b.block_hashes)
+            ):
+                first_frame_idx = index_a.checkpoints[block_idx][0]
+                if hash_a == hash_b:
+                    yield first_frame_idx, None, None
+                else:
+                    yield (
+                        first_frame_idx,
+                        index_a.read_block(block_idx),
+                        index_b.read_block(block_idx),
+                    )
+            self.frames = (index_a.frames, index_b.frames)
+            return
+
+        record_size = self.layout.record_size
+        block_frames = max(1, inpindex.BLOCK_SIZE_DEF // record_size)
+        blocks_a = self._payload_blocks(0, block_frames * record_size)
+        blocks_b = self._payload_blocks(1, block_frames * record_size)
+        for block_idx, (block_a, block_b) in enumerate(zip(blocks_a, blocks_b)):
+            yield block_idx * block_frames, block_a, block_b
+        # Run the longer payload to its end, to tell its length.
+        for _ in itertools.chain(blocks_a, blocks_b):
+            pass
+        self.frames = tuple(size // record_size for size in self._payload_sizes)
+
+    def __iter__(self):
+        layout = self.layout
+        record_size = layout.record_size
+        record_key = self._record_key
+        # First frame number and records of the ongoing divergence, if any
+        divergence_start = None
+        for first_frame_idx, block_a, block_b in self._block_pairs():
+            if block_a is not None and block_a != block_b and not self.compare_speed:
+                masked_a = mask_speed(block_a, record_size)
+                if masked_a == mask_speed(block_b, record_size):
+                    block_a = block_b = None
+            if block_a is None or block_a == block_b:
+                if divergence_start is not None:
+                    yield Divergence(
+                        divergence_start[0], first_frame_idx, *divergence_start[1:]
+                    )
+                    divergence_start = None
+                continue
+
+            size = min(len(block_a), len(block_b))
+            size -= size % record_size
+            records_a = layout.iter_records([memoryview(block_a)[:size]])
+            records_b = layout.iter_records([memoryview(block_b)[:size]])
+            for frame_no, record_a, record_b in zip(
+                itertools.count(first_frame_idx + 1), records_a, records_b
+            ):
+                if record_key(record_a) != record_key(record_b):
+                    if divergence_start is None:
+                        divergence_start = (frame_no, record_a, record_b)
+                elif divergence_start is not None:
+                    yield Divergence(
+                        divergence_start[0], frame_no - 1, *divergence_start[1:]
+                    )
+                    divergence_start = None
+
+        if divergence_start is not None:
+            yield Divergence(
+                divergence_start[0], min(self.frames), *divergence_start[1:]
+            )
+
+
+def describe_divergence(decoder, ports_to_check, divergence):
+    """
+    Build the dict describing a Divergence in the JSON output.
+
+    It holds the first and last frame number and the timestamp of the first
+    frame, along with the values that differ in that frame, each as a list of
+    the values in either recording: the timestamps, the current speeds, the
+    pressed buttons of each differing port and the [accum, previous] values
+    of each differing analog field, by port index and field name.
+    """
+    seconds, attoseconds, curspeed_a, digital_a, analog_a = divergence.record_a
+    _, _, curspeed_b, digital_b, analog_b = divergence.record_b
+    description = {
+        "first_frame": divergence.first_frame,
+        "last_frame": divergence.last_frame,
+        "s": seconds,
+        "as": attoseconds,
+    }
+    if divergence.record_a[:2] != divergence.record_b[:2]:
+        description["timestamps"] = [
+            list(divergence.record_a[:2]),
+            list(divergence.record_b[:2]),
+        ]
+    if curspeed_a != curspeed_b:
+        description["curspeeds"] = [curspeed_a, curspeed_b]
+    description["ports"] = {
+        port_idx: [
+            decoder.pressed_buttons(port_idx, digital_a[port_idx]),
+            decoder.pressed_buttons(port_idx, digital_b[port_idx]),
+        ]
+        for port_idx in ports_to_check
+        if digital_a[port_idx] != digital_b[port_idx]
+    }
+    if analog_a:
+        analog = {}
+        for port_idx, name, analog_idx in decoder.analog_fields_of(ports_to_check):
+            values = slice(2 * analog_idx, 2 * analog_idx + 2)
+            if analog_a[values] != analog_b[values]:
+                analog.setdefault(port_idx, {})[name] = [
+                    list(analog_a[values]),
+                    list(analog_b[values]),
+                ]
+        description["analog"] = analog
+    return description
+
+
+def print_divergence(decoder, description):
+    """Print a divergence as described by describe_divergence, diff(1) style."""
+    first_frame = description["first_frame"]
+    last_frame = description["last_frame"]
+    seconds = description["s"] + description["as"] / 10**18
+    if first_frame == last_frame:
+        print(f"Frame #{first_frame} differs, at {seconds:.6f} s")
+    else:
+        print(f"Frames #{first_frame} to #{last_frame} differ, from {seconds:.6f} s on")
+
+    lines = []
+    if "timestamps" in description:
+        lines.append(
+            (
+                "timestamp",
+                [f"{s} {attoseconds}" for s, attoseconds in description["timestamps"]],
+            )
+        )
+    if "curspeeds" in description:
+        lines.append(("curspeed", description["curspeeds"]))
+    for port_idx, buttons in description["ports"].items():
+        lines.append(
+            (
+                decoder.port_names[port_idx],
+                [",".join(pressed) or "(none)" for pressed in buttons],
+            )
+        )
+    for port_idx, fields in description.get("analog", {}).items():
+        for name, values in fields.items():
+            lines.append(
+                (
+                    f"{decoder.port_names[port_idx]} {name}",
+                    [f"{accum} {previous}" for accum, previous in values],
+                )
+            )
+    for label, (value_a, value_b) in lines:
+        print(f"  {label} - {value_a}")
+        print(f"  {label} + {value_b}")
+
+
+def open_reader(input_file_path, _args, cache):
+    """
+    Open one of the INP files to compare and resolve its input port reference data.
+
+    Return the InpReader. Raise the exceptions of InpReader and of
+    InpReader.resolve_ports, or InpReader.detect_layout with --auto-detect.
+    """
+    reader = inp2json.InpReader(
+        input_file_path,
+        _args.inputport_ref_path,
+        _args.check_ports,
+        _args.shmupmame_compat,
+        cache=cache,
+        analog=_args.analog,
+    )
+    reader.open_decompressed()
+    if _args.auto_detect:
+        reader.detect_layout()
+    reader.resolve_ports()
+    return reader
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=sys.modules[__name__].__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("path_a", type=str, help="Path to the first INP file.")
+    parser.add_argument("path_b", type=str, help="Path to the second INP file.")
+    parser.add_argument(
+        "-n",
+        "--max-divergences",
+        type=int,
+        default=MAX_DIVERGENCES_DEF,
+        help="Maximum number of divergences to report; 0 reports all of them. A "
+        "divergence lasting until the end of the shorter recording takes decoding "
+        f"all of it. (default: {MAX_DIVERGENCES_DEF})",
+    )
+    parser.add_argument(
+        "-p",
+        "--check-ports",
+        action="extend",
+        nargs="*",
+        type=int,
+        help="Whitespace-separated list of port numbers to compare, as for "
+        "inp2json.py. (default: compare all available ports)",
+    )
+    parser.add_argument(
+        "-m",
+        "--inputport-ref-path",
+        type=str,
+        default=inp2json.INPUTPORT_REF_PATH_DEF,
+        help="Path to the input port reference file or store, as for inp2json.py. "
+        f"(default: {inp2json.INPUTPORT_REF_PATH_DEF})",
+    )
+    parser.add_argument(
+        "-s",
+        "--shmupmame-compat",
+        action="store_true",
+        default=False,
+        help="Compatibility mode for INP files created using ShmupMAME or MAME Plus, "
+        "see inp2json.py -s.",
+    )
+    parser.add_argument(
+        "--auto-detect",
+        action="store_true",
+        default=False,
+        help="Detect the payload layout of each INP file, see inp2json.py "
+        "--auto-detect.",
+    )
+    parser.add_argument(
+        "--analog",
+        action="store_true",
+        default=False,
+        help="Compare the values of analog inputs as well.",
+    )
+    parser.add_argument(
+        "--compare-speed",
+        action="store_true",
+        default=False,
+        help="Compare the current speed of frames as well.",
+    )
+    parser.add_argument(
+        "--json",
+        action="store_true",
+        default=False,
+        help="Write the result as a JSON object instead: the frame counts of both "
+        "INP files (null if not compared up to the end), whether their payloads are "
+        "truncated, and the list of divergences.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=os.environ.get("INP2JSON_CACHE_DIR"),
+        help="Cache directory of inp2json.py to look up input port reference data "
+        "and decompressed payloads in. (default: INP2JSON_CACHE_DIR environment "
+        "variable; no caching if unset)",
+    )
+    parser.add_argument(
+        "--cache-max-size",
+        type=int,
+        default=inp2json.CACHE_MAX_SIZE_DEF,
+        help="Size limit of the cache directory in MiB. "
+        f"(default: {inp2json.CACHE_MAX_SIZE_DEF})",
+    )
+    _args = parser.parse_args()
+    if _args.max_divergences < 0:
+        parser.error("-n/--max-divergences must not be negative")
+    return _args
+
+
+def main(_args):
+    cache = (
+        inp2json.FileCache(_args.cache_dir, _args.cache_max_size << 20)
+        if _args.cache_dir
+        else None
+    )
+    paths = (_args.path_a, _args.path_b)
+    try:
+        readers = [open_reader(path, _args, cache) for path in paths]
+        for check_port in _args.check_ports or ():
+            if not 0 <= check_port < readers[0].decoder.ports_count:
+                raise ReplayMismatchError(
+                    f"requested port {check_port} is unavailable for game "
+                    f"'{readers[0].sysname}'"
+                )
+        diff = ReplayDiff(*readers, compare_speed=_args.compare_speed)
+        diff.use_indexes()
+        divergences = list(itertools.islice(diff, _args.max_divergences or None))
+    except (OSError, UnicodeDecodeError, inp2json.InpHeaderError) as e:
+        print(f"Fatal: could not read INP file: {e}", file=sys.stderr)
+        return 2
+    except (
+        inp2json.InputPortRefError,
+        inp2json.UnsupportedGameError,
+        inp2json.UnsupportedMameVersionError,
+    ) as e:
+        print(
+            f"Fatal: could not resolve input port reference data: {e}", file=sys.stderr
+        )
+        return 2
+    except (
+        ReplayMismatchError,
+        inp2json.InpPayloadSanityCheckError,
+        inpindex.IndexFormatError,
+    ) as e:
+        print(f"Fatal: {e}", file=sys.stderr)
+        return 2
+    except inp2json.InpPayloadCorruptError as e:
+        print(f"Fatal: INP payload is corrupt: {e}", file=sys.stderr)
+        return 2
+
+    decoder = readers[0].decoder
+    ports_to_check = readers[0].ports_to_check
+    descriptions = [
+        describe_divergence(decoder, ports_to_check, divergence)
+        for divergence in divergences
+    ]
+    differ = bool(divergences) or (
+        diff.frames is not None and diff.frames[0] != diff.frames[1]
+    )
+
+    if _args.json:
+        json.dump(
+            {
+                "frames": diff.frames,
+                "truncated": diff.truncated,
+                "divergences": descriptions,
+            },
+            sys.stdout,
+        )
+        print()
+        return int(differ)
+
+    print(f"--- {paths[0]}")
+    print(f"+++ {paths[1]}")
+    for description in descriptions:
+        print_divergence(decoder, description)
+    for path, truncated in zip(paths, diff.truncated):
+        if truncated:
+            print(f"Payload of '{path}' is truncated")
+    if diff.frames is None:
+        print(
+            f"Stopped looking after {len(divergences)} divergence(s) "
+            "(see -n/--max-divergences)"
+        )
+    elif diff.frames[0] != diff.frames[1]:
+        print(f"Frame counts differ: {diff.frames[0]} vs {diff.frames[1]}")
+    elif not differ:
+        print(f"No differences in {diff.frames[0]} frames")
+    return int(differ)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    sys.exit(main(args))
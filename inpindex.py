@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Build and read the seekable sidecar index of INP files used by inp2json.py.
+
+The payload of an INP file is a single zlib stream, so reaching a frame in the
+middle of a recording normally means decompressing everything before it. A
+sidecar index holds the uncompressed payload once more, split into blocks of
+whole frame records that are compressed independently of each other, together
+with a checkpoint per block: the index of the block's first frame, that
+frame's timestamp, the location of the block within the index file and a hash
+of its uncompressed contents. Seeking to a frame or an emulated time then only
+takes decompressing from the nearest preceding checkpoint.
+
+An index file starts with the magic bytes, the format version and the offset
+of the trailer, which is a JSON document holding the metadata and the
+checkpoint table. The compressed blocks lie in between.
+
+When run as a script, print the metadata and checkpoints of an index file.
+"""
+
+import argparse
+import bisect
+import hashlib
+import json
+import os
+import struct
+import sys
+import zlib
+
+MAGIC = b"INPINDEX"
+VERSION = 1
+PREAMBLE_FMT = "<8sHQ"  # magic, version, trailer offset
+PREAMBLE_SIZE = struct.calcsize(PREAMBLE_FMT)
+SUFFIX = ".inpidx"
+BLOCK_SIZE_DEF = 64 << 10
+
+# Every frame record starts with its timestamp (seconds, attoseconds).
+TIMESTAMP_STRUCT = struct.Struct("<LQ")
+
+
+class IndexFormatError(Exception):
+    """This exception is raised when a file is not an index file of a supported version."""
+
+
+def source_info(input_file_path, header_bytes):
+    """
+    Return the description of an INP file that an index is valid for.
+
+    The file is identified by its size, modification time and header, so
+    that a stale index is recognized without reading the payload.
+    """
+    st = os.stat(input_file_path)
+    return {
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "header_sha256": hashlib.sha256(header_bytes).hexdigest(),
+    }
+
+
+def block_hash(data):
+    """Return the hash of the uncompressed contents of a block as a hex string."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class IndexWriter:
+    """
+    Incrementally write an index file while the payload is being decompressed.
+
+    `f` is a seekable binary file, `record_size` the size of one frame record
+    of the payload, and `source` the description of the INP file as returned
+    by source_info. Each block holds as many whole records as fit into
+    `block_size` bytes (at least one); the last block additionally holds a
+    truncated trailing record, if any.
+    """
+
+    def __init__(self, f, record_size, source, block_size=BLOCK_SIZE_DEF):
+        self._f = f
+        self.record_size = record_size
+        self.block_frames = max(1, block_size // record_size)
+        self._block_bytes = self.block_frames * record_size
+        self._source = source
+        self._buf = bytearray()
+        self._frames = 0
+        self._payload_size = 0
+        self._timestamp = (0, 0)
+        self.checkpoints = []
+
+        f.write(struct.pack(PREAMBLE_FMT, MAGIC, VERSION, 0))
+
+    def feed(self, chunk):
+        """Append a chunk of the uncompressed payload."""
+        self._buf += chunk
+        self._payload_size += len(chunk)
+        # A block is only written once it is certain not to be the last one,
+        # which may have to take a truncated record.
+        while len(self._buf) >= self._block_bytes + self.record_size:
+            self._write_block(self._block_bytes)
+
+    def wrap(self, chunks):
+        """Feed every chunk of an iterable of payload chunks, yielding it on."""
+        for chunk in chunks:
+            self.feed(chunk)
+            yield chunk
+
+    def _write_block(self, size):
+        data = bytes(self._buf[:size])
+        del self._buf[:size]
+        if len(data) >= TIMESTAMP_STRUCT.size:
+            self._timestamp = TIMESTAMP_STRUCT.unpack_from(data)
+        offset = self._f.tell()
+        compressed = zlib.compress(data)
+        self._f.write(compressed)
+        self.checkpoints.append(
+            [
+                self._frames,
+                *self._timestamp,
+                offset,
+                len(compressed),
+                len(data),
+                block_hash(data),
+            ]
+        )
+        self._frames += len(data) // self.record_size
+
+    def close(self):
+        """Write the pending blocks and the trailer."""
+        if self._buf:
+            self._write_block(len(self._buf))
+
+        trailer_offset = self._f.tell()
+        trailer = {
+            "source": self._source,
+            "record_size": self.record_size,
+            "block_frames": self.block_frames,
+            "frames": self._frames,
+            "payload_size": self._payload_size,
+            "checkpoints": self.checkpoints,
+        }
+        self._f.write(json.dumps(trailer, separators=(",", ":")).encode())
+        self._f.seek(0)
+        self._f.write(struct.pack(PREAMBLE_FMT, MAGIC, VERSION, trailer_offset))
+        self._f.flush()
+
+
+class IndexReader:
+    """
+    Read an index file.
+
+    `meta` holds the trailer (see IndexWriter.close), `checkpoints` its
+    checkpoint table. Each checkpoint is a list of the block's first frame
+    index, the seconds and attoseconds of that frame, the offset, compressed
+    size and uncompressed size of the block, and the block hash.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            preamble = f.read(PREAMBLE_SIZE)
+            if len(preamble) < PREAMBLE_SIZE:
+                raise IndexFormatError("Not an index file")
+            magic, version, trailer_offset = struct.unpack(PREAMBLE_FMT, preamble)
+            if magic != MAGIC or not trailer_offset:
+                raise IndexFormatError("Not an index file")
+            if version != VERSION:
+                raise IndexFormatError(f"Unsupported index format version {version}")
+            f.seek(trailer_offset)
+            self.meta = json.loads(f.read())
+
+        self.path = path
+        self.checkpoints = self.meta["checkpoints"]
+        self.record_size = self.meta["record_size"]
+        self.frames = self.meta["frames"]
+        self._first_frames = [checkpoint[0] for checkpoint in self.checkpoints]
+        self._timestamps = [
+            (checkpoint[1], checkpoint[2]) for checkpoint in self.checkpoints
+        ]
+
+    def is_valid_for(self, source, record_size):
+        """Tell whether the index matches an INP file and frame record size."""
+        return self.meta["source"] == source and self.record_size == record_size
+
+    @property
+    def block_hashes(self):
+        """The list of block hashes, in block order."""
+        return [checkpoint[6] for checkpoint in self.checkpoints]
+
+    def block_for_frame(self, frame_idx):
+        """Return the index of the block holding the frame at 0-based index `frame_idx`."""
+        return max(0, bisect.bisect_right(self._first_frames, frame_idx) - 1)
+
+    def block_for_time(self, seconds, attoseconds):
+        """
+        Return the index of the block to start from to find the first frame at
+        or after the given emulated time.
+        """
+        return max(0, bisect.bisect_left(self._timestamps, (seconds, attoseconds)) - 1)
+
+    def iter_blocks(self, block_idx=0):
+        """Yield the uncompressed blocks from the block at index `block_idx` on."""
+        with open(self.path, "rb") as f:
+            for checkpoint in self.checkpoints[block_idx:]:
+                yield self._read_block(f, checkpoint)
+
+    def read_block(self, block_idx):
+        """Return the uncompressed block at index `block_idx`."""
+        with open(self.path, "rb") as f:
+            return self._read_block(f, self.checkpoints[block_idx])
+
+    @staticmethod
+    def _read_block(f, checkpoint):
+        f.seek(checkpoint[3])
+        data = f.read(checkpoint[4])
+        try:
+            return zlib.decompress(data)
+        except zlib.error as e:
+            raise IndexFormatError(f"Corrupt block in index file: {e}") from e
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=sys.modules[__name__].__doc__)
+    parser.add_argument("path", type=str, help="Path to an index file.")
+    return parser.parse_args()
+
+
+def main(_args):
+    try:
+        index = IndexReader(_args.path)
+    except (OSError, ValueError, KeyError, IndexFormatError) as e:
+        print(f"Fatal: could not read index file '{_args.path}': {e}", file=sys.stderr)
+        return 1
+
+    meta = {key: value for key, value in index.meta.items() if key != "checkpoints"}
+    print(json.dumps(meta, indent=2))
+    print("frame seconds attoseconds offset compressed uncompressed hash")
+    for checkpoint in index.checkpoints:
+        print(*checkpoint)
+
+    return 0
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    sys.exit(main(args))
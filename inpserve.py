@@ -0,0 +1,904 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Serve decoded MAME input files (INP) over HTTP and WebSocket.
+
+Input port reference data is loaded once per game, and decoded replays are
+kept in a memory-bounded, least-recently-used cache keyed by file path,
+modification time and decoding options, so that opening a replay again does
+not require decoding it again. A replay that is not cached yet is decoded in
+the background, and its first frames are streamed while the rest is still
+being decoded.
+
+Endpoints (paths of INP files are relative to the --root directory):
+
+  GET /info?path=PATH
+      JSON object describing the replay: header data, ports and buttons, the
+      number of frames decoded so far and whether decoding is complete.
+
+  GET /replay?path=PATH[&format=FORMAT][&start=N][&count=N][&ports=I,J,...]
+      The replay in one of the output formats of inp2json.py (json, ndjson,
+      events, columnar or stats; default: json), optionally restricted to
+      `count` frames starting at frame number `start` and to the given ports.
+
+  GET /ws
+      WebSocket endpoint. Each text message sent by the client is a JSON
+      object with the same keys as the query parameters above, plus "op"
+      ("info" or "replay"; default: "replay"). Replay data is sent as binary
+      messages whose concatenation is the same document as the body of
+      /replay; text messages are JSON control messages: the "info" object,
+      {"done": true, "frames": N} after the last binary message of a replay,
+      or {"error": MESSAGE}.
+
+Both /info and /replay (and their WebSocket counterparts) accept
+`shmupmame_compat=1` (true in WebSocket requests), see inp2json.py -s, and
+`analog=1`, see inp2json.py --analog.
+"""
+
+import argparse
+import array
+import asyncio
+import base64
+import collections
+import hashlib
+import http
+import io
+import itertools
+import json
+import os
+import struct
+import sys
+import urllib.parse
+
+import inp2json
+
+HOST_DEF = "127.0.0.1"
+PORT_DEF = 8080
+CACHE_SIZE_DEF = 256  # MiB
+MAX_DECODES_DEF = 4
+DECODE_BATCH_FRAMES = 4096
+SEND_BUFFER_SIZE = 1 << 16
+MAX_REQUEST_HEAD_SIZE = 1 << 16
+MAX_WEBSOCKET_MESSAGE_SIZE = 1 << 20
+# Output format -> Content-Type of /replay responses
+CONTENT_TYPES = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+    "events": "application/json",
+    "stats": "application/json",
+}
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+WS_OP_CONTINUATION = 0x0
+WS_OP_TEXT = 0x1
+WS_OP_BINARY = 0x2
+WS_OP_CLOSE = 0x8
+WS_OP_PING = 0x9
+WS_OP_PONG = 0xA
+
+
+class RequestError(Exception):
+    """This exception is raised when a request cannot be served; it carries the HTTP status."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class DecodedReplay:
+    """
+    The frames of one INP file, decoded into one array per column.
+
+    `reader` is the inp2json.InpReader of the INP file, with its input port
+    reference data already resolved. The arrays are filled incrementally by
+    decode; consumers wait for frames using wait_for_frames.
+    """
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.seconds = array.array("I")
+        self.attoseconds = array.array("Q")
+        self.curspeed = array.array("I")
+        self.digital = [array.array("I") for _ in range(reader.decoder.ports_count)]
+        # Accumulated and previous value of each analog field, if decoded
+        self.analog = [
+            array.array("i")
+            for _ in range(
+                2 * reader.decoder.analog_fields_count if reader.analog else 0
+            )
+        ]
+        self.complete = False
+        self.failed = False
+        self.error = None
+        self._changed = asyncio.Condition()
+
+    def __len__(self):
+        return len(self.seconds)
+
+    @property
+    def nbytes(self):
+        """The memory taken by the decoded frames, in bytes."""
+        return sum(
+            column.itemsize * len(column)
+            for column in (
+                self.seconds,
+                self.attoseconds,
+                self.curspeed,
+                *self.digital,
+                *self.analog,
+            )
+        )
+
+    def records(self, start, stop):
+        """Return an iterator of frame records for the 0-based index range [start, stop)."""
+        digital = (
+            zip(*(column[start:stop] for column in self.digital))
+            if self.digital
+            else itertools.repeat((), stop - start)
+        )
+        analog = (
+            zip(*(column[start:stop] for column in self.analog))
+            if self.analog
+            else itertools.repeat((), stop - start)
+        )
+        return zip(
+            self.seconds[start:stop],
+            self.attoseconds[start:stop],
+            self.curspeed[start:stop],
+            digital,
+            analog,
+        )
+
+    def info(self):
+        """Return the JSON-serializable description of the replay."""
+        reader = self.reader
+        decoder = reader.decoder
+        return {
+            "sysname": reader.sysname,
+            "basetime": reader.basetime,
+            "appdesc": reader.appdesc,
+            "version": reader.version,
+            "inp_version": list(reader.inp_version),
+            "mame_build": reader.mame_build,
+            "mame_config": reader.mame_config,
+            "ports": [
+                {
+                    "index": port_idx,
+                    "name": decoder.port_names[port_idx],
+                    "buttons": decoder.field_names[port_idx],
+                    "analog": [
+                        name
+                        for analog_port_idx, name in decoder.analog_fields
+                        if analog_port_idx == port_idx
+                    ],
+                }
+                for port_idx in range(decoder.ports_count)
+            ],
+            "frames": len(self),
+            "complete": self.complete,
+            "error": self.error,
+        }
+
+    async def wait_for_frames(self, count):
+        """Wait until at least `count` frames have been decoded, or decoding has ended."""
+        async with self._changed:
+            await self._changed.wait_for(lambda: len(self) >= count or self.complete)
+
+    async def decode(self, on_batch=None):
+        """
+        Decode all frames, in batches within the default executor.
+
+        `on_batch`, if given, is called after each batch has been appended.
+        """
+        loop = asyncio.get_running_loop()
+        records = self.reader.records()
+        ports_count = len(self.digital)
+        analog_count = len(self.analog)
+
+        def decode_batch():
+            # Frames decoded before an error are kept, as list.extend appends
+            # them one by one.
+            batch = []
+            error = None
+            try:
+                batch.extend(itertools.islice(records, DECODE_BATCH_FRAMES))
+            except (
+                inp2json.UnexpectedInpPayloadEndError,
+                inp2json.InpPayloadSanityCheckError,
+                inp2json.InpPayloadCorruptError,
+                OSError,
+            ) as e:
+                error = e
+            if not batch:
+                return None, error
+            seconds, attoseconds, curspeed, digital, analog = zip(*batch)
+            columns = (
+                array.array("I", seconds),
+                array.array("Q", attoseconds),
+                array.array("I", curspeed),
+                [array.array("I", values) for values in zip(*digital)]
+                if ports_count
+                else [],
+                [array.array("i", values) for values in zip(*analog)]
+                if analog_count
+                else [],
+            )
+            return columns, error
+
+        try:
+            while True:
+                columns, error = await loop.run_in_executor(None, decode_batch)
+                if columns is not None:
+                    seconds, attoseconds, curspeed, digital, analog = columns
+                    self.seconds.extend(seconds)
+                    self.attoseconds.extend(attoseconds)
+                    self.curspeed.extend(curspeed)
+                    for column, values in zip(self.digital, digital):
+                        column.extend(values)
+                    for column, values in zip(self.analog, analog):
+                        column.extend(values)
+                    if on_batch is not None:
+                        on_batch()
+                    async with self._changed:
+                        self._changed.notify_all()
+                if error is not None:
+                    raise error
+                if columns is None:
+                    break
+        except inp2json.UnexpectedInpPayloadEndError as e:
+            # Like inp2json.py, keep what could be decoded.
+            self.error = f"INP payload ended unexpectedly: {e}"
+        except (
+            inp2json.InpPayloadSanityCheckError,
+            inp2json.InpPayloadCorruptError,
+            OSError,
+        ) as e:
+            self.failed = True
+            self.error = f"Could not decode INP payload: {e}"
+        finally:
+            self.complete = True
+            async with self._changed:
+                self._changed.notify_all()
+
+
+def parse_request_options(params):
+    """
+    Validate the options of a replay or info request.
+
+    `params` maps option names to values, as strings (query parameters) or
+    JSON values (WebSocket requests). Return a dict of the path, output
+    format, start frame number, frame count, list of ports (or None),
+    ShmupMAME compatibility flag and analog flag. Raise RequestError if an
+    option is invalid.
+    """
+
+    def flag(value):
+        return value in (True, 1, "1", "true", "yes")
+
+    def number(name, default, minimum):
+        value = params.get(name)
+        if value is None or value == "":
+            return default
+        try:
+            value = int(value)
+        except (TypeError, ValueError) as e:
+            raise RequestError(
+                http.HTTPStatus.BAD_REQUEST, f"invalid {name}: {value!r}"
+            ) from e
+        if value < minimum:
+            raise RequestError(
+                http.HTTPStatus.BAD_REQUEST, f"{name} must be at least {minimum}"
+            )
+        return value
+
+    path = params.get("path")
+    if not path or not isinstance(path, str):
+        raise RequestError(http.HTTPStatus.BAD_REQUEST, "path is required")
+
+    output_format = params.get("format") or inp2json.OUTPUT_FORMAT_DEF
+    if output_format not in inp2json.OUTPUT_FORMATS:
+        raise RequestError(
+            http.HTTPStatus.BAD_REQUEST, f"unknown format: {output_format!r}"
+        )
+
+    ports = params.get("ports")
+    if isinstance(ports, str):
+        ports = [port for port in ports.split(",") if port]
+    if ports is not None:
+        try:
+            ports = [int(port) for port in ports]
+        except (TypeError, ValueError) as e:
+            raise RequestError(
+                http.HTTPStatus.BAD_REQUEST, f"invalid ports: {ports!r}"
+            ) from e
+
+    return {
+        "path": path,
+        "format": output_format,
+        "start": number("start", 1, 1),
+        "count": number("count", None, 0),
+        "ports": ports,
+        "shmupmame_compat": flag(params.get("shmupmame_compat")),
+        "analog": flag(params.get("analog")),
+    }
+
+
+class ReplayServer:
+    """
+    Decode INP files below the directory `root` on request and keep them cached.
+
+    `inputport_ref_path` is the input port reference file; the reference data
+    of each game is read from it only once. At most `cache_max_bytes` bytes of
+    decoded frames are kept, counting replays that are still being decoded;
+    least recently used replays that are fully decoded are dropped first. At
+    most `max_decodes` replays are decoded at a time, and no new decode is
+    started while the replays being decoded take up `cache_max_bytes` on
+    their own, so that memory usage stays bounded however many replays are
+    requested at once. If `allow_origin` is given, it is sent as the
+    Access-Control-Allow-Origin header, allowing browser applications from
+    that origin to use the server.
+    """
+
+    def __init__(
+        self,
+        inputport_ref_path,
+        root,
+        cache_max_bytes,
+        allow_origin=None,
+        max_decodes=MAX_DECODES_DEF,
+    ):
+        self.inputport_ref_path = inputport_ref_path
+        self.root = os.path.realpath(root)
+        self.cache_max_bytes = cache_max_bytes
+        self.max_decodes = max_decodes
+        self.allow_origin = allow_origin
+        # (sysname, MAME version if taken from a reference store) -> what
+        # inp2json.read_ports_ref returned
+        self._ports_refs = {}
+        # Definition hash -> parsed definition, see inp2json.parse_ports_ref_def
+        self._ports_ref_defs = {}
+        # (real path, modification time, size, ShmupMAME compatibility,
+        # analog) -> future of DecodedReplay, in order of use
+        self._replays = collections.OrderedDict()
+
+    def resolve_path(self, path):
+        """Return the real path of an INP file below the root directory, or raise RequestError."""
+        real_path = os.path.realpath(os.path.join(self.root, path))
+        if os.path.commonpath([self.root, real_path]) != self.root:
+            raise RequestError(http.HTTPStatus.FORBIDDEN, "path outside of root")
+        if not os.path.isfile(real_path):
+            raise RequestError(http.HTTPStatus.NOT_FOUND, "no such file")
+        return real_path
+
+    def _open_reader(self, real_path, shmupmame_compat, analog):
+        """Open an INP file and resolve its input port reference data (blocking)."""
+        try:
+            with open(real_path, "rb") as f:
+                header = inp2json.read_header(f)
+            mame_version = (
+                header.bare_build_version
+                if inp2json.is_ports_ref_store(self.inputport_ref_path)
+                else None
+            )
+            ports_ref_key = (header.sysname, mame_version)
+            ports_ref_data = self._ports_refs.get(ports_ref_key)
+            if ports_ref_data is None:
+                ports_ref_data = inp2json.read_ports_ref(
+                    self.inputport_ref_path,
+                    header.sysname,
+                    mame_version,
+                    self._ports_ref_defs,
+                )
+                self._ports_refs[ports_ref_key] = ports_ref_data
+            reader = inp2json.InpReader(
+                real_path,
+                self.inputport_ref_path,
+                shmupmame_compat=shmupmame_compat,
+                ports_ref_data=ports_ref_data,
+                analog=analog,
+            )
+            reader.resolve_ports()
+        except (OSError, UnicodeDecodeError, inp2json.InpHeaderError) as e:
+            raise RequestError(
+                http.HTTPStatus.UNPROCESSABLE_ENTITY, f"no INP file: {e}"
+            ) from e
+        except inp2json.UnsupportedGameError as e:
+            raise RequestError(
+                http.HTTPStatus.UNPROCESSABLE_ENTITY,
+                f"game '{header.sysname}' is not supported: {e}",
+            ) from e
+        except inp2json.UnsupportedMameVersionError as e:
+            raise RequestError(
+                http.HTTPStatus.UNPROCESSABLE_ENTITY,
+                f"MAME version {e} is not supported",
+            ) from e
+        except inp2json.InputPortRefError as e:
+            raise RequestError(
+                http.HTTPStatus.INTERNAL_SERVER_ERROR,
+                f"could not load input port reference data: {e}",
+            ) from e
+        return reader
+
+    async def open_replay(self, path, shmupmame_compat, analog):
+        """
+        Return the DecodedReplay of the INP file at `path` (relative to the root).
+
+        A cached replay is returned right away; otherwise, the INP file is
+        opened and decoding is started in the background.
+        """
+        real_path = self.resolve_path(path)
+        st = os.stat(real_path)
+        key = (real_path, st.st_mtime_ns, st.st_size, shmupmame_compat, analog)
+        future = self._replays.get(key)
+        if future is not None:
+            self._replays.move_to_end(key)
+            return await asyncio.shield(future)
+
+        self._trim()
+        if self._decoding_count() >= self.max_decodes:
+            raise RequestError(
+                http.HTTPStatus.SERVICE_UNAVAILABLE,
+                "too many replays are being decoded, try again later",
+            )
+        if self._cached_bytes() >= self.cache_max_bytes:
+            raise RequestError(
+                http.HTTPStatus.SERVICE_UNAVAILABLE,
+                "replays being decoded exhaust the cache, try again later",
+            )
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._replays[key] = future
+        try:
+            reader = await loop.run_in_executor(
+                None, self._open_reader, real_path, shmupmame_compat, analog
+            )
+        except Exception as e:
+            del self._replays[key]
+            future.set_exception(e)
+            # Retrieve the exception, as there might be no other waiter.
+            future.exception()
+            raise
+
+        replay = DecodedReplay(reader)
+        future.set_result(replay)
+        task = asyncio.ensure_future(replay.decode(self._trim))
+        task.add_done_callback(lambda _: self._decoded(key, replay))
+        return replay
+
+    def _decoded(self, key, replay):
+        """Drop failed replays, and trim the cache once a replay has been decoded."""
+        if replay.failed:
+            self._replays.pop(key, None)
+            return
+        self._trim()
+
+    def _opened_replays(self):
+        """Return a list of (key, DecodedReplay) pairs of the opened replays, in order of use."""
+        return [
+            (key, future.result())
+            for key, future in self._replays.items()
+            if future.done() and not future.exception()
+        ]
+
+    def _decoding_count(self):
+        """Return the number of replays being opened or decoded."""
+        return sum(
+            not future.done()
+            or (not future.exception() and not future.result().complete)
+            for future in self._replays.values()
+        )
+
+    def _cached_bytes(self):
+        """Return the memory taken by all replays, including partially decoded ones."""
+        return sum(replay.nbytes for _, replay in self._opened_replays())
+
+    def _trim(self):
+        """
+        Drop least recently used, fully decoded replays while the memory
+        taken by all replays exceeds the limit.
+        """
+        total = self._cached_bytes()
+        for key, replay in self._opened_replays():
+            if total <= self.cache_max_bytes:
+                break
+            if replay.complete:
+                del self._replays[key]
+                total -= replay.nbytes
+
+    async def stream_replay(self, replay, options, send):
+        """
+        Write (part of) a replay in an output format of inp2json.py.
+
+        `send` is a coroutine function that is passed the output piece by
+        piece, as bytes. Frames are sent as soon as they have been decoded.
+        Return the number of frames written.
+        """
+        decoder = replay.reader.decoder
+        ports = options["ports"]
+        if ports is not None:
+            for port_idx in ports:
+                if not 0 <= port_idx < decoder.ports_count:
+                    raise RequestError(
+                        http.HTTPStatus.BAD_REQUEST,
+                        f"port {port_idx} is unavailable",
+                    )
+        writer_cls = inp2json.OUTPUT_FORMATS[options["format"]][0]
+        buf = io.BytesIO() if writer_cls.binary else io.StringIO()
+        writer = writer_cls(buf, decoder, ports, replay.reader.analog)
+
+        async def send_pending(force=False):
+            if force and not writer_cls.binary:
+                # The columnar format only allows an incomplete block at the end.
+                writer.flush()
+            if buf.tell() and (force or buf.tell() >= SEND_BUFFER_SIZE):
+                data = buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+                await send(data if writer_cls.binary else data.encode())
+
+        idx = options["start"] - 1
+        stop = None if options["count"] is None else idx + options["count"]
+        written = 0
+        while stop is None or idx < stop:
+            if idx >= len(replay):
+                if replay.complete:
+                    break
+                # Let the client have what has been decoded so far.
+                await send_pending(force=True)
+                await replay.wait_for_frames(idx + 1)
+                continue
+            end = len(replay) if stop is None else min(stop, len(replay))
+            end = min(end, idx + DECODE_BATCH_FRAMES)
+            for frame_no, record in enumerate(replay.records(idx, end), idx + 1):
+                writer.write(frame_no, record)
+            written += end - idx
+            idx = end
+            await send_pending()
+
+        if replay.failed:
+            # Leave the document unterminated, so that it cannot be mistaken
+            # for a complete one.
+            raise RequestError(http.HTTPStatus.UNPROCESSABLE_ENTITY, replay.error)
+        writer.close()
+        await send_pending(force=True)
+        return written
+
+    async def handle_connection(self, reader, writer):
+        """Serve one HTTP request, or one WebSocket connection."""
+        try:
+            try:
+                head = await reader.readuntil(b"\r\n\r\n")
+            except asyncio.LimitOverrunError:
+                await self.send_error(
+                    writer,
+                    http.HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE,
+                    "request head too large",
+                )
+                return
+            except asyncio.IncompleteReadError:
+                return
+
+            lines = head.decode("latin-1").split("\r\n")
+            try:
+                method, target, _ = lines[0].split(" ", 2)
+            except ValueError:
+                await self.send_error(
+                    writer, http.HTTPStatus.BAD_REQUEST, "malformed request line"
+                )
+                return
+            headers = {}
+            for line in lines[1:]:
+                name, sep, value = line.partition(":")
+                if sep:
+                    headers[name.strip().lower()] = value.strip()
+
+            url = urllib.parse.urlsplit(target)
+            params = dict(urllib.parse.parse_qsl(url.query))
+            if method != "GET":
+                await self.send_error(
+                    writer, http.HTTPStatus.METHOD_NOT_ALLOWED, "only GET is supported"
+                )
+            elif url.path == "/ws":
+                await self.handle_websocket(reader, writer, headers)
+            elif url.path in ("/info", "/replay"):
+                await self.handle_http(writer, url.path, params)
+            else:
+                await self.send_error(writer, http.HTTPStatus.NOT_FOUND, "not found")
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _head(self, status, headers):
+        status = http.HTTPStatus(status)
+        lines = [f"HTTP/1.1 {status.value} {status.phrase}"]
+        if self.allow_origin:
+            headers = {**headers, "Access-Control-Allow-Origin": self.allow_origin}
+        lines.extend(f"{name}: {value}" for name, value in headers.items())
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+    async def send_error(self, writer, status, message):
+        """Send an error response with a JSON body."""
+        body = json.dumps({"error": message}).encode()
+        writer.write(
+            self._head(
+                status,
+                {
+                    "Content-Type": "application/json",
+                    "Content-Length": len(body),
+                    "Connection": "close",
+                },
+            )
+        )
+        writer.write(body)
+        await writer.drain()
+
+    async def handle_http(self, writer, path, params):
+        """Serve an /info or /replay request."""
+        try:
+            options = parse_request_options(params)
+            replay = await self.open_replay(
+                options["path"], options["shmupmame_compat"], options["analog"]
+            )
+        except RequestError as e:
+            await self.send_error(writer, e.status, str(e))
+            return
+
+        if path == "/info":
+            body = json.dumps(replay.info()).encode()
+            writer.write(
+                self._head(
+                    http.HTTPStatus.OK,
+                    {
+                        "Content-Type": "application/json",
+                        "Content-Length": len(body),
+                        "Connection": "close",
+                    },
+                )
+            )
+            writer.write(body)
+            await writer.drain()
+            return
+
+        content_type = CONTENT_TYPES.get(options["format"], "application/octet-stream")
+        started = False
+
+        async def send(data):
+            nonlocal started
+            if not started:
+                # The body is delimited by closing the connection, so that it
+                # can be streamed before its length is known.
+                writer.write(
+                    self._head(
+                        http.HTTPStatus.OK,
+                        {"Content-Type": content_type, "Connection": "close"},
+                    )
+                )
+                started = True
+            writer.write(data)
+            await writer.drain()
+
+        try:
+            await self.stream_replay(replay, options, send)
+        except RequestError as e:
+            if not started:
+                await self.send_error(writer, e.status, str(e))
+
+    async def handle_websocket(self, reader, writer, headers):
+        """Perform the WebSocket handshake and serve requests until the connection is closed."""
+        key = headers.get("sec-websocket-key")
+        if headers.get("upgrade", "").lower() != "websocket" or not key:
+            await self.send_error(
+                writer, http.HTTPStatus.BAD_REQUEST, "WebSocket upgrade expected"
+            )
+            return
+        accept = base64.b64encode(
+            hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()
+        ).decode()
+        writer.write(
+            self._head(
+                http.HTTPStatus.SWITCHING_PROTOCOLS,
+                {
+                    "Upgrade": "websocket",
+                    "Connection": "Upgrade",
+                    "Sec-WebSocket-Accept": accept,
+                },
+            )
+        )
+        await writer.drain()
+
+        async def send_binary(data):
+            writer.write(websocket_frame(WS_OP_BINARY, data))
+            await writer.drain()
+
+        async def send_json(obj):
+            writer.write(websocket_frame(WS_OP_TEXT, json.dumps(obj).encode()))
+            await writer.drain()
+
+        while True:
+            opcode, payload = await read_websocket_message(reader, writer)
+            if opcode == WS_OP_CLOSE:
+                writer.write(websocket_frame(WS_OP_CLOSE, payload[:2]))
+                await writer.drain()
+                return
+            if opcode != WS_OP_TEXT:
+                await send_json({"error": "requests must be text messages"})
+                continue
+
+            try:
+                try:
+                    params = json.loads(payload)
+                except ValueError as e:
+                    raise RequestError(
+                        http.HTTPStatus.BAD_REQUEST, "request is not valid JSON"
+                    ) from e
+                if not isinstance(params, dict):
+                    raise RequestError(
+                        http.HTTPStatus.BAD_REQUEST, "request must be a JSON object"
+                    )
+                options = parse_request_options(params)
+                replay = await self.open_replay(
+                    options["path"], options["shmupmame_compat"], options["analog"]
+                )
+                if params.get("op", "replay") == "info":
+                    await send_json({"info": replay.info()})
+                else:
+                    frames = await self.stream_replay(replay, options, send_binary)
+                    await send_json({"done": True, "frames": frames})
+            except RequestError as e:
+                await send_json({"error": str(e)})
+
+
+def websocket_frame(opcode, payload):
+    """Return a single, unmasked WebSocket frame (as sent by servers)."""
+    length = len(payload)
+    if length < 126:
+        head = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 1 << 16:
+        head = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        head = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    return head + payload
+
+
+async def read_websocket_message(reader, writer):
+    """
+    Read one message from a WebSocket client, reassembling fragments.
+
+    Pings are answered and pongs are ignored on the way. Return the opcode and
+    the (unmasked) payload of the message; a close frame ends the message
+    immediately. Raise ConnectionError if the client violates the protocol.
+    """
+    opcode = None
+    payload = bytearray()
+    while True:
+        first, second = await reader.readexactly(2)
+        frame_opcode = first & 0x0F
+        length = second & 0x7F
+        if not second & 0x80:
+            raise ConnectionError("unmasked client frame")
+        if length == 126:
+            (length,) = struct.unpack("!H", await reader.readexactly(2))
+        elif length == 127:
+            (length,) = struct.unpack("!Q", await reader.readexactly(8))
+        if len(payload) + length > MAX_WEBSOCKET_MESSAGE_SIZE:
+            raise ConnectionError("message too large")
+        mask = await reader.readexactly(4)
+        data = await reader.readexactly(length)
+        # XOR with the mask repeated to the payload length, in one go.
+        data = (
+            int.from_bytes(data, "big")
+            ^ int.from_bytes((mask * (length // 4 + 1))[:length], "big")
+        ).to_bytes(length, "big")
+
+        if frame_opcode == WS_OP_PING:
+            writer.write(websocket_frame(WS_OP_PONG, data))
+            await writer.drain()
+            continue
+        if frame_opcode == WS_OP_PONG:
+            continue
+        if frame_opcode == WS_OP_CLOSE:
+            return frame_opcode, data
+        if frame_opcode != WS_OP_CONTINUATION:
+            opcode = frame_opcode
+        elif opcode is None:
+            raise ConnectionError("unexpected continuation frame")
+        payload += data
+        if first & 0x80:
+            return opcode, bytes(payload)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=sys.modules[__name__].__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "-m",
+        "--inputport-ref-path",
+        type=str,
+        default=inp2json.INPUTPORT_REF_PATH_DEF,
+        help="Path to the input port reference file, as for inp2json.py. "
+        f"(default: {inp2json.INPUTPORT_REF_PATH_DEF})",
+    )
+    parser.add_argument(
+        "--host",
+        type=str,
+        default=HOST_DEF,
+        help=f"Address to listen on. (default: {HOST_DEF})",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=PORT_DEF,
+        help=f"Port to listen on. (default: {PORT_DEF})",
+    )
+    parser.add_argument(
+        "--root",
+        type=str,
+        default=".",
+        help="Directory that INP file paths are relative to; files outside of it "
+        "are not served. (default: the current directory)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=CACHE_SIZE_DEF,
+        help="Memory limit for decoded replays in MiB; least recently used replays "
+        "are dropped when it is exceeded. Replays still being decoded count towards "
+        "it; no new replay is decoded while they exceed it on their own. "
+        f"(default: {CACHE_SIZE_DEF})",
+    )
+    parser.add_argument(
+        "--max-decodes",
+        type=int,
+        default=MAX_DECODES_DEF,
+        help="Maximum number of replays decoded at a time; requests for further "
+        "replays that are not cached are refused with status 503 meanwhile. "
+        f"(default: {MAX_DECODES_DEF})",
+    )
+    parser.add_argument(
+        "--allow-origin",
+        type=str,
+        help="Value of the Access-Control-Allow-Origin header, to allow browser "
+        "applications served from another origin to use the server. (default: "
+        "no such header)",
+    )
+    return parser.parse_args()
+
+
+async def serve(_args):
+    replay_server = ReplayServer(
+        _args.inputport_ref_path,
+        _args.root,
+        _args.cache_size << 20,
+        _args.allow_origin,
+        _args.max_decodes,
+    )
+    server = await asyncio.start_server(
+        replay_server.handle_connection,
+        _args.host,
+        _args.port,
+        limit=MAX_REQUEST_HEAD_SIZE,
+    )
+    for sock in server.sockets:
+        print(f"Serving on {sock.getsockname()}")
+    async with server:
+        await server.serve_forever()
+
+
+def main(_args):
+    try:
+        asyncio.run(serve(_args))
+    except OSError as e:
+        print(f"Fatal: could not serve: {e}", file=sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    sys.exit(main(args))
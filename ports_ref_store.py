@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Merge input port reference files of several MAME builds into a reference store.
+
+Port layouts drift between MAME releases, so an INP file is best decoded using
+the input port reference data of the build it has been recorded with. A
+reference store holds the reference data of any number of builds; given one
+via -m/--inputport-ref-path, inp2json.py picks the build closest to the one of
+each INP file: the same build if present, else the most recent preceding one.
+Definitions of machines that did not change between builds are stored only
+once, so a store of many builds is barely larger than a reference file of one.
+
+Inputs are reference files as generated by filter_convert_mamexml.py, in the
+gzipped JSON lines or in the indexed format, or existing stores, so that a
+store can be extended with new builds. Reference files need to state their
+MAME build version. Should a build occur more than once, its machines are
+merged, the later input winning.
+
+With -l/--list, print the builds a store holds data of instead.
+"""
+
+import argparse
+import gzip
+import json
+import os
+import struct
+import sys
+import zlib
+
+import inp2json
+
+
+class SourceError(Exception):
+    """This exception is raised when an input cannot be read."""
+
+
+def iter_index_machines(ports_ref_path):
+    """
+    Yield the (sysname, JSON-encoded ports) pairs of an indexed reference file.
+
+    As in the gzipped JSON lines format, ports are a reference to the
+    definition by hash if it has been yielded before.
+    """
+    def_prefix = inp2json.PORTS_REF_DEF_PREFIX.encode()
+    def_ref = inp2json.PORTS_REF_DEF_REF
+    # Definitions not yielded yet; each one precedes its first machine.
+    pending_defs = {}
+    with open(ports_ref_path, "rb") as f:
+        _, table_offset, slots_count = inp2json.read_ports_ref_index_header(f)
+        for key, ports in inp2json.iter_ports_ref_index_records(
+            f, table_offset, slots_count
+        ):
+            if key.startswith(def_prefix):
+                pending_defs[key[len(def_prefix) :]] = ports
+                continue
+            if ports.startswith(def_ref):
+                ports = pending_defs.pop(ports[len(def_ref) :], ports)
+            yield key.decode("ascii"), ports
+
+
+def iter_lines_machines(ports_ref_path):
+    """Yield the (sysname, JSON-encoded ports) pairs of a gzipped JSON lines file."""
+    with gzip.open(ports_ref_path, "rb") as f:
+        inp2json.read_ports_ref_lines_header(f, ports_ref_path)
+        for line in f:
+            sysname, ports, _ = inp2json.split_ports_ref_line(line)
+            yield sysname.decode("ascii"), ports
+
+
+def read_store(f):
+    """
+    Read all records of an opened reference store.
+
+    Return the metadata dict and a dict mapping each sysname to a dict mapping
+    builds to definitions (JSON-encoded ports).
+    """
+    meta, table_offset, slots_count = inp2json.read_ports_ref_index_header(
+        f, inp2json.PORTS_REF_STORE_MAGIC
+    )
+    definitions = {}
+    machine_builds = {}
+    def_prefix = inp2json.PORTS_REF_DEF_PREFIX.encode()
+    for key, payload in inp2json.iter_ports_ref_index_records(
+        f, table_offset, slots_count
+    ):
+        if key.startswith(def_prefix):
+            definitions[key[len(def_prefix) :].decode("ascii")] = payload
+        else:
+            machine_builds[key.decode("ascii")] = json.loads(payload)
+
+    machines = {
+        sysname: {
+            mame_build: definitions[def_hash] for mame_build, def_hash in builds.items()
+        }
+        for sysname, builds in machine_builds.items()
+    }
+    return meta, machines
+
+
+def read_sources(ports_ref_path):
+    """
+    Open an input for write_ports_ref_store.
+
+    Return a list of (mame_build, mame_config, machines) tuples. Machines of
+    reference files are read lazily. Raise SourceError on failure.
+    """
+    try:
+        with open(ports_ref_path, "rb") as f:
+            magic = f.read(len(inp2json.PORTS_REF_INDEX_MAGIC))
+            if magic == inp2json.PORTS_REF_STORE_MAGIC:
+                meta, machines = read_store(f)
+                return [
+                    (
+                        mame_build,
+                        mame_config,
+                        [
+                            (sysname, builds[mame_build])
+                            for sysname, builds in machines.items()
+                            if mame_build in builds
+                        ],
+                    )
+                    for mame_build, mame_config in meta["builds"].items()
+                ]
+            if magic == inp2json.PORTS_REF_INDEX_MAGIC:
+                meta, _, _ = inp2json.read_ports_ref_index_header(f)
+                machines = iter_index_machines(ports_ref_path)
+            else:
+                with gzip.open(ports_ref_path, "rb") as gz_f:
+                    first_line = next(gz_f)
+                try:
+                    meta = json.loads(first_line)
+                except ValueError:
+                    # No header line
+                    meta = None
+                machines = iter_lines_machines(ports_ref_path)
+    except OSError as e:
+        raise SourceError(f"could not read '{ports_ref_path}': {e}") from e
+    except (struct.error, zlib.error, ValueError, KeyError, StopIteration) as e:
+        raise SourceError(
+            f"failed to parse input port reference data at '{ports_ref_path}'"
+        ) from e
+
+    if not isinstance(meta, dict) or not meta.get("mame_build"):
+        raise SourceError(f"no MAME build version given in '{ports_ref_path}'")
+    if meta.get("format", 1) not in inp2json.PORTS_REF_LINES_FORMATS_SUPPORTED:
+        raise SourceError(
+            f"unsupported input port reference format {meta['format']!r} "
+            f"at '{ports_ref_path}'"
+        )
+
+    return [(meta["mame_build"], meta.get("mame_config"), machines)]
+
+
+def list_store(ports_ref_path):
+    """Print the builds a reference store holds data of, oldest first."""
+    with open(ports_ref_path, "rb") as f:
+        meta, machines = read_store(f)
+
+    mame_builds = sorted(meta["builds"], key=inp2json.mame_version_key)
+    definitions = set()
+    for builds in machines.values():
+        definitions.update(builds.values())
+    print(
+        f"{len(mame_builds)} builds, {len(machines)} machines, "
+        f"{len(definitions)} distinct definitions"
+    )
+    print("build mameconfig machines")
+    for mame_build in mame_builds:
+        count = sum(1 for builds in machines.values() if mame_build in builds)
+        print(f"{mame_build!r} {meta['builds'][mame_build]!r} {count}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=sys.modules[__name__].__doc__)
+    parser.add_argument(
+        "input_paths",
+        nargs="+",
+        type=str,
+        help="Paths to input port reference files or stores to merge, or, with "
+        "-l/--list, to stores to list.",
+    )
+    parser.add_argument(
+        "-o",
+        "--output-path",
+        type=str,
+        help="Path to write the reference store to. It may be one of the inputs.",
+    )
+    parser.add_argument(
+        "-l",
+        "--list",
+        action="store_true",
+        default=False,
+        help="List the builds of the given stores instead of merging.",
+    )
+    return parser.parse_args()
+
+
+def main(_args):
+    if _args.list:
+        for ports_ref_path in _args.input_paths:
+            try:
+                list_store(ports_ref_path)
+            except (OSError, struct.error, zlib.error, ValueError, KeyError) as e:
+                print(
+                    f"Fatal: could not read reference store '{ports_ref_path}': {e}",
+                    file=sys.stderr,
+                )
+                return 1
+        return 0
+
+    if not _args.output_path:
+        print("Fatal: -o/--output-path is required for merging", file=sys.stderr)
+        return 1
+
+    tmp_path = _args.output_path + ".tmp"
+    try:
+        sources = []
+        for ports_ref_path in _args.input_paths:
+            sources.extend(read_sources(ports_ref_path))
+        with open(tmp_path, "wb") as f:
+            machines_count, definitions_count = inp2json.write_ports_ref_store(
+                f, sources
+            )
+        os.replace(tmp_path, _args.output_path)
+    except (SourceError, OSError, struct.error, zlib.error, ValueError) as e:
+        print(f"Fatal: {e}", file=sys.stderr)
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return 1
+
+    print(
+        f"Stored {definitions_count} distinct of {machines_count} machine "
+        f"definitions of {len({source[0] for source in sources})} builds "
+        f"in '{_args.output_path}'"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    sys.exit(main(args))
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""Checks of the NumPy decoding path of FrameLayout against the struct one."""
+
+import os
+import struct
+import sys
+import unittest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, "benchmarks"))
+
+# pylint: disable=wrong-import-position
+import inp2json
+import inpsynth
+
+FRAMES_COUNT = 3000
+# Not a multiple of any record size, so that records straddle chunks.
+CHUNK_SIZE = 1000
+
+
+@unittest.skipUnless(inp2json.numpy, "NumPy is not available")
+class NumpyDecodingTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        ports_ref = inpsynth.make_ports_ref(3, 2, 2)
+        cls.decoder = inp2json.PortDecoder(ports_ref)
+        cls.payloads = {
+            shmupmame_compat: b"".join(
+                inpsynth.iter_payload(
+                    ports_ref, FRAMES_COUNT, shmupmame_compat, density=0.3
+                )
+            )
+            for shmupmame_compat in (False, True)
+        }
+
+    def decode(self, payload, shmupmame_compat, analog, use_numpy):
+        """
+        Decode `payload` in chunks of CHUNK_SIZE bytes.
+
+        Return the records and the type and message of the exception raised,
+        if any.
+        """
+        layout = inp2json.FrameLayout.for_decoder(
+            self.decoder, shmupmame_compat, analog
+        )
+        self.assertIsNotNone(layout.record_dtype)
+        if not use_numpy:
+            layout.record_dtype = None
+        chunks = (
+            payload[offset : offset + CHUNK_SIZE]
+            for offset in range(0, len(payload), CHUNK_SIZE)
+        )
+        records = []
+        try:
+            for record in layout.iter_records(chunks):
+                records.append(record)
+        except (
+            inp2json.InpPayloadSanityCheckError,
+            inp2json.UnexpectedInpPayloadEndError,
+        ) as e:
+            return records, (type(e), str(e))
+        return records, None
+
+    def check_payload(self, payload, shmupmame_compat, expected_error=None):
+        """Compare both decoding paths on `payload`, with and without analog values."""
+        for analog in (False, True):
+            with self.subTest(shmupmame_compat=shmupmame_compat, analog=analog):
+                expected = self.decode(payload, shmupmame_compat, analog, False)
+                actual = self.decode(payload, shmupmame_compat, analog, True)
+                self.assertEqual(actual, expected)
+                self.assertEqual(
+                    None if expected[1] is None else expected[1][0], expected_error
+                )
+
+    def record_size(self, shmupmame_compat):
+        return inp2json.FrameLayout.for_decoder(
+            self.decoder, shmupmame_compat
+        ).record_size
+
+    def test_whole_payload(self):
+        for shmupmame_compat, payload in self.payloads.items():
+            self.check_payload(payload, shmupmame_compat)
+            self.assertEqual(
+                len(self.decode(payload, shmupmame_compat, True, True)[0]),
+                FRAMES_COUNT,
+            )
+
+    def test_truncated_record(self):
+        for shmupmame_compat, payload in self.payloads.items():
+            # Cut off within the digital input data of the last record
+            self.check_payload(
+                payload[: -self.record_size(shmupmame_compat) + 20],
+                shmupmame_compat,
+                inp2json.UnexpectedInpPayloadEndError,
+            )
+        # Cut off within the extra ports of MAME Plus based forks, which is
+        # tolerated
+        self.check_payload(self.payloads[True][:-4], True)
+
+    def test_timestamp_decrease(self):
+        frame_struct = struct.Struct(inp2json.FRAME_STRUCT_FMT)
+        for shmupmame_compat, payload in self.payloads.items():
+            record_size = self.record_size(shmupmame_compat)
+            # Frames in the middle of a run of records, at the start of a run
+            # (the first record that begins within the second chunk) and last
+            frame_indexes = (2, 1234, -(-CHUNK_SIZE // record_size), FRAMES_COUNT - 1)
+            for frame_idx in frame_indexes:
+                seconds_prev, attoseconds_prev, _ = frame_struct.unpack_from(
+                    payload, (frame_idx - 1) * record_size
+                )
+                _, _, curspeed = frame_struct.unpack_from(
+                    payload, frame_idx * record_size
+                )
+                # An earlier second, and the same second as the previous frame
+                for seconds, attoseconds in (
+                    (0, 0),
+                    (seconds_prev, attoseconds_prev - 1),
+                ):
+                    regressed = bytearray(payload)
+                    frame_struct.pack_into(
+                        regressed,
+                        frame_idx * record_size,
+                        seconds,
+                        attoseconds,
+                        curspeed,
+                    )
+                    with self.subTest(frame_idx=frame_idx, seconds=seconds):
+                        self.check_payload(
+                            bytes(regressed),
+                            shmupmame_compat,
+                            inp2json.InpPayloadSanityCheckError,
+                        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+"""Round-trip checks of the columnar output format."""
+
+import itertools
+import json
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import unittest
+import zlib
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, "benchmarks"))
+
+# pylint: disable=wrong-import-position
+import inp2json
+import inpcolumns
+import inpsynth
+
+FRAMES_COUNT = 10000
+
+
+class ColumnarRoundTripTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # pylint: disable-next=consider-using-with
+        cls._tmp_dir = tempfile.TemporaryDirectory()
+        cls.inp_path = os.path.join(cls._tmp_dir.name, "synth.inp")
+        cls.ref_path = os.path.join(cls._tmp_dir.name, "synth.gz")
+        ports_ref = inpsynth.make_ports_ref(3, 1)
+        inpsynth.write_inp(cls.inp_path, ports_ref, FRAMES_COUNT, density=0.2)
+        inpsynth.write_ports_ref(
+            cls.ref_path, inpsynth.iter_machines(inpsynth.SYSNAME_DEF, ports_ref, 0)
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._tmp_dir.cleanup()
+
+    def round_trip(self, start_frame=1, frame_count=None, analog=False):
+        """Write frames as columnar and JSON; return both as read back."""
+        reader = inp2json.InpReader(self.inp_path, self.ref_path, analog=analog)
+        cols_path = os.path.join(self._tmp_dir.name, "synth.inpcols")
+        with open(cols_path, "wb") as f:
+            writer = inpcolumns.ColumnarWriter(f, reader.decoder, analog=analog)
+            for frame_no, record in itertools.islice(
+                reader.numbered_records(start_frame=start_frame), frame_count
+            ):
+                writer.write(frame_no, record)
+            writer.close()
+        expected = list(
+            itertools.islice(reader.frames(start_frame=start_frame), frame_count)
+        )
+        with inpcolumns.ColumnarReader(cols_path) as cols_reader:
+            # JSON turns port indexes into strings on either side alike.
+            return (
+                json.loads(json.dumps(list(cols_reader.frames()))),
+                json.loads(json.dumps(expected)),
+            )
+
+    def test_from_first_frame(self):
+        actual, expected = self.round_trip()
+        self.assertEqual(len(actual), FRAMES_COUNT)
+        self.assertEqual(actual, expected)
+
+    def test_from_later_frame(self):
+        actual, expected = self.round_trip(start_frame=5000, analog=True)
+        self.assertEqual(actual[0]["f"], 5000)
+        self.assertEqual(actual, expected)
+
+    def test_frame_range(self):
+        actual, expected = self.round_trip(start_frame=4095, frame_count=3)
+        self.assertEqual([frame["f"] for frame in actual], [4095, 4096, 4097])
+        self.assertEqual(actual, expected)
+
+    def test_no_frames(self):
+        actual, expected = self.round_trip(start_frame=FRAMES_COUNT + 1)
+        self.assertEqual(actual, [])
+        self.assertEqual(expected, [])
+
+    def test_invalid_header(self):
+        self.round_trip(frame_count=10)
+        cols_path = os.path.join(self._tmp_dir.name, "synth.inpcols")
+        with open(cols_path, "rb") as f:
+            data = f.read()
+        _, version, header_len = struct.unpack_from(inpcolumns.PREAMBLE_FMT, data)
+        header = json.loads(
+            data[inpcolumns.PREAMBLE_SIZE : inpcolumns.PREAMBLE_SIZE + header_len]
+        )
+        frames = data[inpcolumns.PREAMBLE_SIZE + header_len :]
+        bad_headers = {
+            "no first frame": {
+                key: value for key, value in header.items() if key != "first_frame"
+            },
+            "no columns": dict(header, columns=[]),
+        }
+        bad_path = os.path.join(self._tmp_dir.name, "bad.inpcols")
+        for problem, bad_header in bad_headers.items():
+            header_bytes = json.dumps(bad_header).encode()
+            with open(bad_path, "wb") as f:
+                f.write(
+                    struct.pack(
+                        inpcolumns.PREAMBLE_FMT,
+                        inpcolumns.MAGIC,
+                        version,
+                        len(header_bytes),
+                    )
+                )
+                f.write(header_bytes)
+                f.write(frames)
+            with self.subTest(problem=problem):
+                with self.assertRaises(inpcolumns.ColumnarFormatError):
+                    inpcolumns.ColumnarReader(bad_path)
+
+    def test_chunks(self):
+        reader = inp2json.InpReader(self.inp_path, self.ref_path)
+        chunks_path = os.path.join(self._tmp_dir.name, "synth.chunks")
+        writer = inp2json.ChunkedWriter(
+            chunks_path,
+            inpcolumns.ColumnarWriter,
+            ".inpcols",
+            reader.decoder,
+            chunk_frames=3000,
+        )
+        for frame_no, record in reader.numbered_records(start_frame=1500):
+            writer.write(frame_no, record)
+        writer.close()
+
+        with open(os.path.join(chunks_path, "manifest.json"), "rb") as f:
+            manifest = json.load(f)
+        self.assertEqual(
+            [
+                (chunk["first_frame"], chunk["last_frame"])
+                for chunk in manifest["chunks"]
+            ],
+            [(1500, 3000), (3001, 6000), (6001, 9000), (9001, FRAMES_COUNT)],
+        )
+        for chunk in manifest["chunks"]:
+            with inpcolumns.ColumnarReader(
+                os.path.join(chunks_path, chunk["path"])
+            ) as cols_reader:
+                frames = list(cols_reader.frames())
+            self.assertEqual(frames[0]["f"], chunk["first_frame"])
+            self.assertEqual(frames[-1]["f"], chunk["last_frame"])
+            self.assertEqual(
+                [frame["s"] for frame in (frames[0], frames[-1])],
+                [chunk["start"][0], chunk["end"][0]],
+            )
+
+    def convert(self, output_path, *options):
+        """Run inp2json.py on the synthetic INP file."""
+        subprocess.run(
+            [
+                sys.executable,
+                os.path.join(ROOT_DIR, "inp2json.py"),
+                "-i",
+                self.inp_path,
+                "-m",
+                self.ref_path,
+                "-o",
+                output_path,
+                *options,
+            ],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+
+    def test_seeking(self):
+        # Build the sidecar index, so that seeking starts at its checkpoints.
+        self.convert(os.devnull, "-f", "stats", "--index")
+        json_path = os.path.join(self._tmp_dir.name, "seek.json")
+        unindexed_path = os.path.join(self._tmp_dir.name, "seek-unindexed.json")
+        cols_path = os.path.join(self._tmp_dir.name, "seek.inpcols")
+        reader = inp2json.InpReader(self.inp_path, self.ref_path)
+        for seek in (["--start-frame", "7000"], ["--start-time", "100.5"]):
+            options = ["--frame-count", "100"] + seek
+            self.convert(json_path, "--index", *options)
+            self.convert(cols_path, "-f", "columnar", "--index", *options)
+            self.convert(unindexed_path, *options)
+            with open(json_path, "rb") as f:
+                expected = json.load(f)
+            with open(unindexed_path, "rb") as f:
+                unindexed = json.load(f)
+            with inpcolumns.ColumnarReader(cols_path) as cols_reader:
+                actual = json.loads(json.dumps(list(cols_reader.frames())))
+            self.assertEqual(len(actual), 100)
+            self.assertEqual(actual, expected)
+            self.assertEqual(actual, unindexed)
+
+            first_frame = actual[0]
+            if seek[0] == "--start-frame":
+                self.assertEqual(first_frame["f"], 7000)
+            else:
+                previous_frame = next(reader.frames(start_frame=first_frame["f"] - 1))
+                self.assertGreaterEqual(
+                    (first_frame["s"], first_frame["as"]), (100, 5 * 10**17)
+                )
+                self.assertLess(
+                    (previous_frame["s"], previous_frame["as"]), (100, 5 * 10**17)
+                )
+
+
+def make_field(field_type, analog=False):
+    """Return the reference data of one field of a hand-built game."""
+    return {
+        "analog": analog,
+        "type": field_type,
+        "defvalue": 0,
+        "specific_name": None,
+        "player": 0,
+    }
+
+
+class AnalogLayoutTest(unittest.TestCase):
+    """Decode a hand-built payload, analog structs following their digital struct."""
+
+    # Per frame and port: the digital value and the (accum, previous) values of
+    # the port's analog fields.
+    FRAMES = [
+        [(0x1, [(5, 0), (-7, 0)]), (0x0, [(1000, 0)]), (0x2, [])],
+        [(0x0, [(-3, 5), (9, -7)]), (0x1, [(-0x80000000, 1000)]), (0x0, [])],
+        [(0x1, [(0x7FFFFFFF, -3), (0, 9)]), (0x1, [(42, -0x80000000)]), (0x2, [])],
+    ]
+
+    @classmethod
+    def setUpClass(cls):
+        # pylint: disable-next=consider-using-with
+        cls._tmp_dir = tempfile.TemporaryDirectory()
+        cls.inp_path = os.path.join(cls._tmp_dir.name, "analog.inp")
+        cls.ref_path = os.path.join(cls._tmp_dir.name, "analog.gz")
+        ports_ref = {
+            ":IN0": {
+                "fields": {
+                    "1": make_field("P1_BUTTON1"),
+                    "65280": make_field("AD_STICK_X", analog=True),
+                    "16711680": make_field("AD_STICK_Y", analog=True),
+                },
+                "legacy_order": 1,
+            },
+            ":IN1": {
+                "fields": {
+                    "1": make_field("P1_BUTTON2"),
+                    "65280": make_field("PADDLE", analog=True),
+                },
+                "legacy_order": 2,
+            },
+            ":IN2": {"fields": {"2": make_field("COIN1")}, "legacy_order": 3},
+        }
+        frame_struct = struct.Struct(inp2json.FRAME_STRUCT_FMT)
+        digital_struct = struct.Struct(inp2json.DIGITAL_STRUCT_FMT)
+        analog_struct = struct.Struct("<llL?")
+        payload = bytearray()
+        for frame_idx, ports in enumerate(cls.FRAMES):
+            payload += frame_struct.pack(frame_idx, 0, 100)
+            for digital, analog in ports:
+                payload += digital_struct.pack(0, digital)
+                for accum, previous in analog:
+                    payload += analog_struct.pack(accum, previous, 100, False)
+        with open(cls.inp_path, "wb") as f:
+            f.write(inpsynth.make_header())
+            f.write(zlib.compress(bytes(payload)))
+        inpsynth.write_ports_ref(
+            cls.ref_path, inpsynth.iter_machines(inpsynth.SYSNAME_DEF, ports_ref, 0)
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._tmp_dir.cleanup()
+
+    def expected_frames(self):
+        """Return the frames of FRAMES as decoded with analog fields."""
+        field_names = [["AD_STICK_X", "AD_STICK_Y"], ["PADDLE"], []]
+        pressed = [["P1_BUTTON1"], ["P1_BUTTON2"], ["COIN1"]]
+        return [
+            {
+                "f": frame_idx + 1,
+                "s": frame_idx,
+                "as": 0,
+                "cs": 100,
+                "p": {
+                    port_idx: pressed[port_idx] if digital else []
+                    for port_idx, (digital, _) in enumerate(ports)
+                },
+                "a": {
+                    port_idx: {
+                        name: list(values)
+                        for name, values in zip(field_names[port_idx], analog)
+                    }
+                    for port_idx, (_, analog) in enumerate(ports)
+                    if analog
+                },
+            }
+            for frame_idx, ports in enumerate(self.FRAMES)
+        ]
+
+    def test_frames(self):
+        reader = inp2json.InpReader(self.inp_path, self.ref_path, analog=True)
+        self.assertEqual(list(reader.frames()), self.expected_frames())
+
+    def test_columnar(self):
+        reader = inp2json.InpReader(self.inp_path, self.ref_path, analog=True)
+        cols_path = os.path.join(self._tmp_dir.name, "analog.inpcols")
+        with open(cols_path, "wb") as f:
+            writer = inpcolumns.ColumnarWriter(f, reader.decoder, analog=True)
+            for frame_no, record in reader.numbered_records():
+                writer.write(frame_no, record)
+            writer.close()
+        with inpcolumns.ColumnarReader(cols_path) as cols_reader:
+            self.assertEqual(list(cols_reader.frames()), self.expected_frames())
+
+
+if __name__ == "__main__":
+    unittest.main()
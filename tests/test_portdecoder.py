@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""Checks of PortDecoder against the plain mask check of the reference decoding."""
+
+import os
+import random
+import sys
+import unittest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+# pylint: disable=wrong-import-position
+import inp2json
+
+
+def make_ports_ref(masks):
+    """Return the reference data of a game with one port holding fields of `masks`."""
+    return {
+        ":IN0": {
+            "fields": {
+                str(mask): {
+                    "analog": False,
+                    "type": f"FIELD{field_idx}",
+                    "defvalue": 0,
+                    "specific_name": None,
+                    "player": None,
+                }
+                for field_idx, mask in enumerate(masks)
+            },
+            "legacy_order": 1,
+        }
+    }
+
+
+def reference_pressed_buttons(masks, digital):
+    """Return the fields active in `digital` as the reference decoding does."""
+    return [
+        f"FIELD{field_idx}"
+        for field_idx, mask in enumerate(masks)
+        if digital & mask == mask
+    ]
+
+
+class PortDecoderTest(unittest.TestCase):
+    def check_masks(self, masks, width=32):
+        """Compare pressed_buttons with the plain mask check for many values."""
+        decoder = inp2json.PortDecoder(make_ports_ref(masks))
+        rng = random.Random(width)
+        values = [0, (1 << width) - 1]
+        for mask in masks:
+            values.extend((mask, mask | rng.getrandbits(width)))
+            # The mask with any one of its bits missing
+            values.extend(mask & ~(1 << bit) for bit in range(mask.bit_length()))
+        values.extend(rng.getrandbits(width) for _ in range(1000))
+        for digital in values:
+            with self.subTest(digital=hex(digital)):
+                self.assertEqual(
+                    decoder.pressed_buttons(0, digital),
+                    reference_pressed_buttons(masks, digital),
+                )
+
+    def test_single_byte_masks(self):
+        self.check_masks([0x1, 0x2, 0x80, 0x0C, 0x300, 0x4000, 0xF0000, 0x80000000])
+
+    def test_multi_byte_masks(self):
+        self.check_masks([0x1, 0x180, 0xFF00, 0x18000, 0xFFFFFF, 0x80000001])
+
+    def test_wide_masks(self):
+        self.check_masks(
+            [0x1, 0x100000000, 0x3FF00000000, 0x80000000FF, 0xFFFFFFFFFF], width=48
+        )
+
+    def test_zero_mask(self):
+        self.check_masks([0x0, 0x1, 0x100, 0x10000])
+        decoder = inp2json.PortDecoder(make_ports_ref([0x0]))
+        self.assertEqual(decoder.pressed_buttons(0, 0), ["FIELD0"])
+
+
+if __name__ == "__main__":
+    unittest.main()